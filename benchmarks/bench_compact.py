@@ -0,0 +1,137 @@
+"""Throughput of the compact command: parallel sort and deduplication of saved day files.
+
+Writes --events new format events over --days day files the way overlapping windows and restarts leave them:
+batches written late (out of order) and repeated ends of previous batches (duplicates). Then compacts copies
+of the files with every --workers value and checks that the files are sorted, have no repeated lines and
+keep every record, and that the query index finds all records after reindexing.
+
+Usage: python benchmarks/bench_compact.py --events 2000000 --days 30 --workers 1,4 --compression zstd
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import mock_api  # noqa: E402
+import run_import  # noqa: E402
+
+
+def make_settings(directory: str):
+    dir_paths = {"mail": Path(directory, "mail"), "all": Path(directory, "all")}
+    for path in dir_paths.values():
+        path.mkdir(parents=True, exist_ok=True)
+    return run_import.SettingParams(oauth_token="benchmark", organization_id=1, dir_paths=dir_paths, ext="json",
+                                    file_names={"mail": "mail_audit", "all": "y360_audit"}, timezone_shift=0,
+                                    parquet_dir=Path(directory, "parquet"))
+
+
+def write_day_files(settings, args):
+    """Write unsorted day files with duplicates. Returns the number of unique events."""
+    rng = random.Random(1)
+    codec = run_import._CODECS.get(args.compression)
+    start_us = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp() * 1000000)
+    step_us = int(args.days * 86400 * 1000000 / args.events)
+    batches = {}
+    for start in range(0, args.events, args.batch):
+        lines = [mock_api.make_events(number, start_us + number * step_us)[1][1] for number in range(start, min(start + args.batch, args.events))]
+        date = json.loads(lines[0])["event"]["occurred_at"][:10]
+        batches.setdefault(date, []).append(lines)
+    for date, day_batches in batches.items():
+        written = []
+        for number, lines in enumerate(day_batches):
+            if written and rng.random() < args.late_rate:
+                # Окно, записанное позже следующего
+                written.insert(len(written) - 1, lines)
+            else:
+                written.append(lines)
+            if number and rng.random() < args.duplicate_rate:
+                # Перекрытие окон: конец предыдущего окна записан ещё раз
+                written.append(day_batches[number - 1][-rng.randint(1, len(day_batches[number - 1])):])
+        with open(run_import._day_file_path(settings, "all", date), "wb") as f:
+            for lines in written:
+                data = "".join(f"{line}\n" for line in lines).encode("utf8")
+                f.write(data if codec is None else codec.compress(data))
+    return args.events
+
+
+def read_lines(file_path: str):
+    codec = run_import._codec_of_file(file_path)
+    with open(file_path, "rb") as f:
+        return [line for data, _, _ in run_import._iter_appended_data(f, 0, codec) for line in data.split(b"\n") if line]
+
+
+def check(settings, events: int):
+    names = sorted(run_import._log_file_names(settings, "all"))
+    unique, problems, count = set(), [], 0
+    for name in names:
+        lines = read_lines(os.path.join(settings.dir_paths["all"], name))
+        keys = [run_import._compaction_key("all", line) for line in lines]
+        unique.update(lines)
+        count += len(lines)
+        if name != names[-1]:
+            if keys != sorted(keys):
+                problems.append(f"{name} is not sorted")
+            if len(set(lines)) != len(lines):
+                problems.append(f"{name} has {len(lines) - len(set(lines))} duplicates")
+    if len(unique) != events:
+        problems.append(f"{len(unique)} unique records instead of {events}")
+    return problems, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of parallel compaction of day files")
+    parser.add_argument("--events", type=int, default=500000)
+    parser.add_argument("--days", type=float, default=10)
+    parser.add_argument("--batch", type=int, default=1000, help="events per written window")
+    parser.add_argument("--late-rate", type=float, default=0.05, help="share of windows written after the next one")
+    parser.add_argument("--duplicate-rate", type=float, default=0.2, help="share of windows followed by a repeated end of the previous one")
+    parser.add_argument("--compression", choices=("none", "gzip", "zstd"), default="none")
+    parser.add_argument("--workers", default="1,4", help="comma separated numbers of worker processes")
+    parser.add_argument("--memory-mb", type=int, default=run_import.COMPACT_MEMORY_MB)
+    args = parser.parse_args()
+
+    run_import.OUTPUT_COMPRESSION = args.compression
+    run_import.LOGS_SOURCES = ["all"]
+    with tempfile.TemporaryDirectory() as directory:
+        # Журнал загрузки пишется во временный каталог, а не в текущий
+        run_import.set_log_file(os.path.join(directory, run_import.LOG_FILE))
+        source = make_settings(os.path.join(directory, "source"))
+        started = time.perf_counter()
+        events = write_day_files(source, args)
+        data_bytes = sum(Path(source.dir_paths["all"], name).stat().st_size for name in run_import._log_file_names(source, "all"))
+        print(f"wrote {events} events with duplicates and late windows in {time.perf_counter() - started:.1f} sec, "
+              f"day files {data_bytes / 1024 / 1024:.1f} MB ({args.compression})")
+
+        for workers in [int(value) for value in args.workers.split(",")]:
+            target = os.path.join(directory, f"workers{workers}")
+            shutil.copytree(os.path.join(directory, "source"), target)
+            settings = make_settings(target)
+            # Индекс строится до сжатия и перестраивается для заменённых файлов при следующем запуске
+            run_import.USE_QUERY_INDEX = True
+            run_import.create_runtime_data(settings).close()
+            totals = run_import.compact_log_files(settings, "all", workers, args.memory_mb)
+            seconds = totals["seconds"]
+            print(f"{workers} workers: {totals['files']} files, {totals['rewritten']} rewritten, {totals['skipped']} skipped in {seconds:.2f} sec "
+                  f"({totals['bytes'] / 1024 / 1024 / seconds:.1f} MB/s, {totals['lines'] / seconds:.0f} lines/s), "
+                  f"{totals['duplicates']} duplicates, {totals['out_of_order']} out of order")
+            problems, count = check(settings, events)
+            run_import.create_runtime_data(settings).close()
+            found = len(list(run_import.query_audit_logs(settings, "all")))
+            if found != count:
+                problems.append(f"query index finds {found} records instead of {count}")
+            print("  check: " + ("ok" if not problems else "; ".join(problems)))
+            shutil.rmtree(target)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Cost of saving records with and without filter rules, and an end-to-end download with rules.
+
+Saves --events parsed records of each source into day files without rules and with rules that keep
+--keep-mailboxes of the 50 mailboxes of benchmarks/mock_api.py and redact or project fields, and prints
+records per second and written bytes. Then downloads from the mock API with the same rules and checks
+that the files contain only kept records with redacted fields and that the per-rule counters match.
+
+Usage: python benchmarks/bench_filter.py --events 200000 --keep-mailboxes 10
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import bench_sync  # noqa: E402
+import mock_api  # noqa: E402
+import run_import  # noqa: E402
+
+
+def make_rules(keep_mailboxes: int):
+    mail_users = [f"user{number}@domain.ru" for number in range(keep_mailboxes, 50)]
+    new_users = [f"user{number}" for number in range(keep_mailboxes, 50)]
+    return [
+        {"name": "mail_other_mailboxes", "source": "mail", "action": "exclude", "match": {"mailbox": mail_users}},
+        {"name": "mail_redact", "source": "mail", "action": "redact", "fields": ["subject", "from", "ip"]},
+        {"name": "all_other_actors", "source": "all", "action": "exclude", "match": {"actor": new_users}},
+        {"name": "all_project", "source": "all", "action": "project", "fields": ["event_type", "service", "actor", "event.idempotency_id", "event.uid"]},
+    ]
+
+
+def make_records(events: int):
+    records = {"mail": [], "all": []}
+    start_us = 1735689600 * 1000000
+    for number in range(events):
+        mail, new = mock_api.make_events(number, start_us + number * 100000)
+        records["mail"].append(json.loads(mail[1]))
+        records["all"].append(json.loads(new[1]))
+    return records
+
+
+def save_all(settings, records: dict):
+    runtime_data = run_import.RuntimeData(last_records={"mail": run_import.DedupIndex(), "all": run_import.DedupIndex()},
+                                          oldest_datetime={"mail": None, "all": None}, writers=run_import.DayFileWriterPool())
+    results = {}
+    for source, items in records.items():
+        # Записи создаются так же, как при разборе страницы ответа API
+        parsed = [run_import.AuditRecord.from_mail(dict(data)) if source == "mail" else run_import.AuditRecord.from_new(json.loads(json.dumps(data))) for data in items]
+        started = time.perf_counter()
+        run_import._save_records(settings, source, parsed, runtime_data)
+        runtime_data.writers.commit()
+        seconds = time.perf_counter() - started
+        size = sum(path.stat().st_size for path in Path(settings.dir_paths[source]).iterdir())
+        results[source] = (seconds, size)
+    runtime_data.close()
+    return results
+
+
+def check_files(settings, keep_mailboxes: int):
+    problems = []
+    kept_users = {f"user{number}" for number in range(keep_mailboxes)}
+    counts = {}
+    for source in ("mail", "all"):
+        counts[source] = 0
+        for name in run_import._log_file_names(settings, source):
+            with open(os.path.join(settings.dir_paths[source], name), "rb") as f:
+                for line in f:
+                    record = json.loads(line)
+                    counts[source] += 1
+                    user = record["userLogin"].split("@")[0] if source == "mail" else record["user_login"]
+                    if user not in kept_users:
+                        problems.append(f"{source} record of {user} is not filtered")
+                    elif source == "mail" and (record["subject"] != run_import.FILTER_REDACTED_VALUE or record["clientIp"] != run_import.FILTER_REDACTED_VALUE):
+                        problems.append("mail record is not redacted")
+                    elif source == "all" and (set(record) != {"event", "user_login"} or "ip" in record["event"] or "occurred_at" not in record["event"]):
+                        problems.append(f"all record is not projected: {sorted(record['event'])}")
+                    if len(problems) > 5:
+                        return problems, counts
+    return problems, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost of filter rules applied before writing records")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--keep-mailboxes", type=int, default=10, help="mailboxes (of 50) kept by the rules")
+    parser.add_argument("--sync-events", type=int, default=20000, help="events of the end-to-end download")
+    args = parser.parse_args()
+
+    records = make_records(args.events)
+    with tempfile.TemporaryDirectory() as directory:
+        # Журнал загрузки пишется во временный каталог, а не в текущий
+        run_import.set_log_file(os.path.join(directory, run_import.LOG_FILE))
+        rules_path = os.path.join(directory, "filters.json")
+        with open(rules_path, "w", encoding="utf8") as f:
+            json.dump(make_rules(args.keep_mailboxes), f)
+        for label, file_path in (("no rules", None), ("rules", rules_path)):
+            os.mkdir(os.path.join(directory, label.replace(" ", "_")))
+            settings = bench_sync.make_settings(os.path.join(directory, label.replace(" ", "_")))
+            settings.event_filters = run_import.load_event_filters(file_path)
+            for source, (seconds, size) in save_all(settings, records).items():
+                print(f"{label:8} {source}: {args.events / seconds:9.0f} records/s, {size / 1024 / 1024:6.1f} MB written")
+
+        mock_args = argparse.Namespace(events=args.sync_events, days=2, seed=1, burst_share=0.0, latency_ms=0, latency_jitter_ms=0,
+                                       error_rate=0, throttle_rate=0, rate_limit=0, live_rate=0)
+        process, base_url, _ = bench_sync.start_mock(mock_args)
+        run_import.DEFAULT_360_API_URL = base_url
+        run_import.NEW_360_API_URL = f"{base_url}/v1"
+        run_import.STATUS_OUTPUT = "none"
+        try:
+            os.mkdir(os.path.join(directory, "sync"))
+            settings = bench_sync.make_settings(os.path.join(directory, "sync"))
+            settings.event_filters = run_import.load_event_filters(rules_path)
+            runtime_data = run_import.create_runtime_data(settings)
+            run_import.download_scheduler(settings, runtime_data, cycles=1)
+            runtime_data.close()
+        finally:
+            process.kill()
+        problems, counts = check_files(settings, args.keep_mailboxes)
+        for source in ("mail", "all"):
+            dropped = settings.event_filters[source].dropped
+            print(f"sync {source}: {counts[source]} records saved, dropped by rules: {dropped}")
+            if counts[source] + sum(dropped.values()) != args.sync_events:
+                problems.append(f"{source}: {counts[source]} saved + {sum(dropped.values())} dropped != {args.sync_events} events")
+        print("check: " + ("ok" if not problems else "; ".join(problems)))
+
+
+if __name__ == "__main__":
+    main()
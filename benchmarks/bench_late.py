@@ -0,0 +1,168 @@
+"""Late events: appending them to day files versus sorted side runs merged into the day files.
+
+Saves --events new format events of --days days by windows of --batch events; --late-rate of the windows
+arrive after --delay later windows (late events). Every mode (LATE_EVENTS_MODE append and merge) writes the
+windows with commits as the download does and prints the time, then checks that every record is saved once,
+that day files are sorted (merge) and that the query index finds all records and the records of a time range.
+Then merges a sorted day file of --merge-mb MB with --runs late runs and prints the merge speed and the memory
+peak for the day file and a day file 4 times larger (memory does not depend on the size).
+
+Usage: python benchmarks/bench_late.py --events 500000 --days 5 --late-rate 0.1 --merge-mb 64
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import mock_api  # noqa: E402
+import run_import  # noqa: E402
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def make_settings(directory: str):
+    dir_paths = {"mail": Path(directory, "mail"), "all": Path(directory, "all")}
+    for path in dir_paths.values():
+        path.mkdir(parents=True, exist_ok=True)
+    return run_import.SettingParams(oauth_token="benchmark", organization_id=1, dir_paths=dir_paths, ext="json",
+                                    file_names={"mail": "mail_audit", "all": "y360_audit"}, timezone_shift=0,
+                                    parquet_dir=Path(directory, "parquet"))
+
+
+def make_windows(args):
+    """Windows of event lines in the order they arrive: some windows arrive after later ones."""
+    rng = random.Random(1)
+    start_us = int(START.timestamp() * 1000000)
+    step_us = int(args.days * 86400 * 1000000 / args.events)
+    windows = [[mock_api.make_events(number, start_us + number * step_us)[1][1] for number in range(start, min(start + args.batch, args.events))]
+               for start in range(0, args.events, args.batch)]
+    arrived, delayed = [], []
+    for number, window in enumerate(windows):
+        if rng.random() < args.late_rate:
+            delayed.append((number + args.delay, window))
+        else:
+            arrived.append(window)
+        arrived += [late for due, late in delayed if due <= number]
+        delayed = [(due, late) for due, late in delayed if due > number]
+    return arrived + [late for _, late in delayed], step_us
+
+
+def save_windows(settings, windows: list):
+    runtime_data = run_import.create_runtime_data(settings)
+    started = time.perf_counter()
+    for window in windows:
+        records = [run_import.AuditRecord.from_new(json.loads(line)) for line in window]
+        run_import._save_records(settings, "all", records, runtime_data)
+        run_import._checkpoint_commit(runtime_data, "all", records[-1].event_time)
+    committed = time.perf_counter() - started
+    runtime_data.close()
+    return committed, time.perf_counter() - started
+
+
+def read_lines(file_path: str):
+    codec = run_import._codec_of_file(file_path)
+    with open(file_path, "rb") as f:
+        return [line for data, _, _ in run_import._iter_appended_data(f, 0, codec) for line in data.split(b"\n") if line]
+
+
+def check(settings, events: int, step_us: int, sorted_files: bool):
+    problems, lines_count, unsorted = [], 0, 0
+    for name in sorted(run_import._log_file_names(settings, "all")):
+        lines = read_lines(os.path.join(settings.dir_paths["all"], name))
+        keys = [run_import._compaction_key("all", line) for line in lines]
+        lines_count += len(lines)
+        unsorted += sum(1 for previous, key in zip(keys, keys[1:]) if key < previous)
+    if run_import._late_run_names(settings, "all"):
+        problems.append(f"{len(run_import._late_run_names(settings, 'all'))} late runs are not merged")
+    if lines_count != events:
+        problems.append(f"{lines_count} records instead of {events}")
+    if sorted_files and unsorted:
+        problems.append(f"{unsorted} records out of order")
+    found = sum(1 for _ in run_import.query_audit_logs(settings, "all"))
+    if found != events:
+        problems.append(f"query index finds {found} records instead of {events}")
+    # Интервал в середине данных: число событий в нём известно из шага времени событий
+    started_at = START + timedelta(microseconds=step_us * (events // 2))
+    ended_at = started_at + timedelta(microseconds=step_us * 999)
+    found = sum(1 for _ in run_import.query_audit_logs(settings, "all", started_at, ended_at))
+    if found != 1000:
+        problems.append(f"query of a time range finds {found} records instead of 1000")
+    return problems, unsorted
+
+
+def merge_once(directory: str, day_mb: int, runs: int, measure_memory: bool):
+    """Merge a sorted day file of about day_mb MB with runs late runs of 2000 events. Returns MB, seconds and memory peak."""
+    start_us = int(START.timestamp() * 1000000)
+    file_path = os.path.join(directory, "y360_audit_2025-01-01.json")
+    number = 0
+    with open(file_path, "wb") as f:
+        while f.tell() < day_mb * 1024 * 1024:
+            f.write("".join(mock_api.make_events(n, start_us + n * 1000)[1][1] + "\n" for n in range(number, number + 10000)).encode("utf8"))
+            number += 10000
+    run_paths = []
+    for run in range(runs):
+        run_path = f"{file_path}{run_import.LATE_RUN_SUFFIX}-{run + 1:06d}"
+        # Число запоздавших событий зависит от задержек API, а не от размера дня
+        moments = sorted(random.Random(run).randrange(number) for _ in range(2000))
+        with open(run_path, "wb") as f:
+            f.write("".join(mock_api.make_events(number + run * number + n, start_us + moment * 1000 + 1)[1][1] + "\n"
+                            for n, moment in enumerate(moments)).encode("utf8"))
+        run_paths.append(run_path)
+    size = sum(os.path.getsize(path) for path in [file_path] + run_paths)
+    if measure_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    run_import._merge_late_runs(file_path, "all", run_paths, f"{file_path}.merge", None)
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if measure_memory else 0
+    if measure_memory:
+        tracemalloc.stop()
+    for path in [file_path, f"{file_path}.merge"] + run_paths:
+        os.remove(path)
+    return size / 1024 / 1024, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Late events written to day files directly or through sorted side runs")
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--days", type=float, default=5)
+    parser.add_argument("--batch", type=int, default=1000, help="events per downloaded window")
+    parser.add_argument("--late-rate", type=float, default=0.1, help="share of windows that arrive late")
+    parser.add_argument("--delay", type=int, default=5, help="windows arriving before a late window")
+    parser.add_argument("--merge-mb", type=int, default=32, help="size of the day file of the merge benchmark")
+    parser.add_argument("--runs", type=int, default=run_import.LATE_MERGE_MAX_RUNS, help="late runs of the merge benchmark")
+    args = parser.parse_args()
+
+    run_import.LOGS_SOURCES = ["all"]
+    run_import.USE_QUERY_INDEX = True
+    windows, step_us = make_windows(args)
+    with tempfile.TemporaryDirectory() as directory:
+        # Журнал загрузки пишется во временный каталог, а не в текущий
+        run_import.set_log_file(os.path.join(directory, run_import.LOG_FILE))
+        for mode in ("append", "merge"):
+            run_import.LATE_EVENTS_MODE = mode
+            settings = make_settings(os.path.join(directory, mode))
+            committed, seconds = save_windows(settings, windows)
+            problems, unsorted = check(settings, args.events, step_us, mode == "merge")
+            print(f"{mode:6}: {args.events / committed:8.0f} records/s with commits, {seconds:.2f} sec with close, "
+                  f"{unsorted} order breaks in day files")
+            print("  check: " + ("ok" if not problems else "; ".join(problems)))
+
+        for day_mb in (args.merge_mb, args.merge_mb * 4):
+            size, seconds, _ = merge_once(directory, day_mb, args.runs, False)
+            _, _, peak = merge_once(directory, day_mb, args.runs, True)
+            print(f"merge of {size:.0f} MB with {args.runs} runs: {size / seconds:.1f} MB/s, memory peak {peak / 1024 / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Benchmark of lookups in saved audit files with and without the query index.
+
+Writes --events new format events spread over --days days through the real writer (with the query index
+enabled), then runs lookups by user with and without a time range and compares the time and results
+with a full scan of the day files.
+
+Usage: python benchmarks/bench_query.py --events 1000000 --days 90 --users 20000 --compression gzip
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import mock_api  # noqa: E402
+import run_import  # noqa: E402
+
+
+def make_settings(directory: str):
+    dir_paths = {"mail": Path(directory, "mail"), "all": Path(directory, "all")}
+    for path in dir_paths.values():
+        path.mkdir()
+    return run_import.SettingParams(oauth_token="benchmark", organization_id=1, dir_paths=dir_paths, ext="json",
+                                    file_names={"mail": "mail_audit", "all": "y360_audit"}, timezone_shift=0)
+
+
+def write_events(settings, args, started_at: datetime):
+    runtime_data = run_import.create_runtime_data(settings)
+    step_us = int(args.days * 86400 * 1000000 / args.events)
+    start_us = int(started_at.timestamp() * 1000000)
+    batch = []
+    for number in range(args.events):
+        data = json.loads(mock_api.make_events(number, start_us + number * step_us)[1][1])
+        data["user_login"] = f"user{(number * 7919) % args.users}"
+        data["event"]["uid"] = 1130000000000 + (number * 7919) % args.users
+        batch.append(run_import.AuditRecord.from_new(data))
+        if len(batch) == args.batch or number == args.events - 1:
+            run_import.save_new_logs_to_file(batch, settings, runtime_data)
+            run_import._checkpoint_commit(runtime_data, "all", batch[-1].event_time)
+            batch = []
+    runtime_data.close()
+
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of lookups in saved audit logs with the query index")
+    parser.add_argument("--events", type=int, default=300000)
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=5000, help="events per commit")
+    parser.add_argument("--compression", choices=("none", "gzip", "zstd"), default="none")
+    parser.add_argument("--queries", type=int, default=5)
+    args = parser.parse_args()
+
+    run_import.OUTPUT_COMPRESSION = args.compression
+    run_import.USE_QUERY_INDEX = True
+    run_import.LOGS_SOURCES = ["all"]
+    started_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    with tempfile.TemporaryDirectory() as directory:
+        # Журнал загрузки пишется во временный каталог, а не в текущий
+        run_import.set_log_file(os.path.join(directory, run_import.LOG_FILE))
+        settings = make_settings(directory)
+        _, write_seconds = timed(lambda: write_events(settings, args, started_at))
+        index_path = run_import._query_index_path(settings, "all")
+        data_bytes = sum(Path(settings.dir_paths["all"], name).stat().st_size for name in run_import._log_file_names(settings, "all"))
+        print(f"wrote {args.events} events in {write_seconds:.1f} sec, day files {data_bytes / 1024 / 1024:.1f} MB, "
+              f"index {os.path.getsize(index_path) / 1024 / 1024:.1f} MB")
+
+        day = timedelta(days=1)
+        for number in range(args.queries):
+            user = f"user{(number * 104729) % args.users}"
+            day_started_at = started_at + day * (number % max(int(args.days) - 1, 1))
+            ranged = {"started_at": day_started_at, "ended_at": day_started_at + day}
+            for name, query in (("all time", {}), ("one day", ranged)):
+                found, seconds = timed(lambda: list(run_import.query_audit_logs(settings, "all", user=user, **query)))
+                print(f"{user} {name}: {len(found)} records in {seconds * 1000:.1f} ms (index)")
+
+        # Полный просмотр тех же файлов без индекса
+        os.rename(index_path, f"{index_path}.off")
+        user = "user0"
+        found, seconds = timed(lambda: list(run_import.query_audit_logs(settings, "all", user=user)))
+        print(f"{user} all time: {len(found)} records in {seconds * 1000:.1f} ms (full scan)")
+        os.rename(f"{index_path}.off", index_path)
+        found, seconds = timed(lambda: list(run_import.query_audit_logs(settings, "all", user=user)))
+        print(f"{user} all time: {len(found)} records in {seconds * 1000:.1f} ms (index)")
+
+
+if __name__ == "__main__":
+    main()
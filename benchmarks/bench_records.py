@@ -0,0 +1,104 @@
+"""Records/sec of each record processing stage: legacy multi-parse path versus single-parse AuditRecord path.
+
+Usage: python benchmarks/bench_records.py [pages]
+"""
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import run_import  # noqa: E402
+
+
+def make_pages(pages: int):
+    bodies = []
+    for page in range(pages):
+        events = [{
+            "eventType": "message_receive", "date": f"2025-04-23T04:{page % 60:02d}:{i % 60:02d}.118Z", "orgId": 1234567,
+            "userUid": "11300000620000", "userLogin": "ivanov@domain.ru", "userName": "Иванов Сергей", "requestId": "",
+            "uniqId": f"{page}{i}", "source": "server", "mid": "1894326593262728", "folderName": "Inbox", "folderType": "inbox",
+            "labels": [], "msgId": "<ilulvmxokjkijlnlno@calendar.yandex.ru>", "subject": "Сегодня, 23-го апреля, «Время на дорогу»",
+            "from": "info@calendar.yandex.ru", "to": "", "cc": "", "bcc": "", "clientIp": "2a02:6b8:c37:bb43:0:0000:61:0",
+        } for i in range(100)]
+        bodies.append(json.dumps({"events": events, "nextPageToken": "token"}).encode("utf8"))
+    return bodies
+
+
+def legacy_parse(bodies):
+    # response.json() вызывался для каждой проверки поля ответа
+    pages = []
+    for body in bodies:
+        if json.loads(body)["events"] is not None and json.loads(body)["events"] != []:
+            pages.append(json.loads(body)["events"])
+            json.loads(body)["nextPageToken"]
+            json.loads(body)["nextPageToken"]
+    return pages
+
+
+def legacy_serialize(pages):
+    records = set()
+    for events in pages:
+        records.update(json.dumps(d, ensure_ascii=False).encode('utf8') for d in sorted(events, key=lambda x: x["date"], reverse=True))
+    return records
+
+
+def legacy_dates(records):
+    decoded = [r.decode() for r in records]
+    newest = sorted((json.loads(r) for r in decoded), key=lambda x: x["date"], reverse=True)[0]["date"]
+    days = [re.search(r".+\"date\"\:\s\"(.+)\".+", r).group(1)[0:10] for r in decoded]
+    return newest, days
+
+
+def new_parse(bodies):
+    return [[run_import.AuditRecord.from_mail(d) for d in run_import._json_loads(body)["events"]] for body in bodies]
+
+
+def new_serialize(pages):
+    return [r.line for records in pages for r in records]
+
+
+def new_dates(pages):
+    records = [r for page in pages for r in page]
+    return max(r.event_time for r in records), [r.event_time[0:10] for r in records]
+
+
+def new_identity(pages):
+    return [run_import._event_identity(r.line) for records in pages for r in records]
+
+
+def measure(name: str, func, argument, records: int):
+    started = time.perf_counter()
+    result = func(argument)
+    elapsed = time.perf_counter() - started
+    print(f"  {name:<30} {records / elapsed:14,.0f} records/sec")
+    return result, elapsed
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    bodies = make_pages(pages)
+    records = pages * 100
+    print(f"{records} records in {pages} pages, JSON backend for parsing: {run_import._import_json_backend()}")
+
+    print("legacy path:")
+    parsed, t1 = measure("parse (response.json() x5)", legacy_parse, bodies, records)
+    serialized, t2 = measure("serialize to bytes", legacy_serialize, parsed, records)
+    _, t3 = measure("decode + json.loads + regex", legacy_dates, serialized, records)
+    legacy_total = t1 + t2 + t3
+    print(f"  {'total':<30} {records / legacy_total:14,.0f} records/sec")
+
+    print("single-parse path:")
+    parsed, t1 = measure("parse once", new_parse, bodies, records)
+    _, t2 = measure("serialize line", new_serialize, parsed, records)
+    _, t3 = measure("event time by slicing", new_dates, parsed, records)
+    _, t4 = measure("dedup identity", new_identity, parsed, records)
+    new_total = t1 + t2 + t3
+    print(f"  {'total (without identity)':<30} {records / new_total:14,.0f} records/sec")
+    print(f"speedup x{legacy_total / new_total:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Cold start of one-shot runs: interpreter and module import, time to the first API request and whole run time.
+
+Starts benchmarks/mock_api.py in this process and runs `run_import.py sync` --runs times in new processes
+(settings are passed in environment variables, API addresses are replaced before the command is called).
+The first request time is measured from the process start to the moment the mock API receives a request.
+The first run downloads --events events into empty catalogs; the measured runs resume from the checkpoint,
+as a cron job does. Also prints which heavy modules are imported by `import run_import`.
+
+Usage: python benchmarks/bench_startup.py --runs 10 --source all
+"""
+import argparse
+import os
+import py_compile
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCH_DIR, "..")
+sys.path.insert(0, BENCH_DIR)
+
+import mock_api  # noqa: E402
+
+HEAVY_MODULES = ("requests", "urllib3", "dateutil", "dotenv", "asyncio", "http.server", "concurrent.futures.process", "pyarrow")
+
+DRIVER = """
+import sys
+sys.path.insert(0, {root!r})
+import run_import
+run_import.DEFAULT_360_API_URL = {base_url!r}
+run_import.NEW_360_API_URL = {base_url!r} + "/v1"
+run_import.STATUS_OUTPUT = "none"
+sys.exit(run_import.sync_main({argv!r}))
+"""
+
+
+class FirstRequestApi(mock_api.MockAuditApi):
+    """Mock API that remembers the time of the first request after reset()."""
+
+    first_request_at = None
+
+    def reset(self):
+        self.first_request_at = None
+
+    def count(self, **counters):
+        if counters.get("requests") and self.first_request_at is None:
+            self.first_request_at = time.perf_counter()
+        super().count(**counters)
+
+
+def median_ms(values: list):
+    return f"{statistics.median(values) * 1000:7.1f} ms (min {min(values) * 1000:.1f})"
+
+
+def run_times(command: list, runs: int, cwd: str = None, env: dict = None):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=cwd, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time of one-shot sync runs")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--days", type=float, default=3)
+    parser.add_argument("--source", choices=("mail", "all"), default="all")
+    args = parser.parse_args()
+
+    # Как после установки: байт-код модуля уже скомпилирован (при PYTHONDONTWRITEBYTECODE он иначе компилируется при каждом запуске)
+    py_compile.compile(os.path.join(ROOT_DIR, "run_import.py"))
+    imported = subprocess.run([sys.executable, "-c", f"import sys; sys.path.insert(0, {ROOT_DIR!r}); import run_import; "
+                               f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"], capture_output=True, text=True, check=True)
+    print(f"heavy modules after import run_import: {imported.stdout.strip() or 'none'}")
+    print(f"python -c pass:          {median_ms(run_times([sys.executable, '-c', 'pass'], args.runs))}")
+    print(f"import run_import:       {median_ms(run_times([sys.executable, '-c', f'import sys; sys.path.insert(0, {ROOT_DIR!r}); import run_import'], args.runs))}")
+
+    server = FirstRequestApi(("127.0.0.1", 0), mock_api.MockConfig(events=args.events, days=args.days, burst_share=0.0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("mail", "all"):
+            os.mkdir(os.path.join(directory, name))
+        env = dict(os.environ, OAUTH_TOKEN_ARG="benchmark", ORGANIZATION_ID_ARG="1", LOG_FILE_EXTENSION="json",
+                   MAIL_LOG_CATALOG_LOCATION=os.path.join(directory, "mail"), NEW_LOG_CATALOG_LOCATION=os.path.join(directory, "all"),
+                   MAIL_LOG_FILE_BASE_NAME="mail_audit", NEW_LOG_FILE_BASE_NAME="y360_audit", TIMEZONE_SHIFT_IN_HOURS="0")
+        command = [sys.executable, "-c", DRIVER.format(root=ROOT_DIR, base_url=base_url, argv=["--source", args.source])]
+        started = time.perf_counter()
+        subprocess.run(command, cwd=directory, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        print(f"first sync of {args.events} {args.source} events: {time.perf_counter() - started:.2f} sec")
+
+        first_request, whole_run = [], []
+        for _ in range(args.runs):
+            server.reset()
+            started = time.perf_counter()
+            subprocess.run(command, cwd=directory, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            whole_run.append(time.perf_counter() - started)
+            first_request.append(server.first_request_at - started)
+        print(f"sync from checkpoint, first request: {median_ms(first_request)}")
+        print(f"sync from checkpoint, whole run:     {median_ms(whole_run)}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
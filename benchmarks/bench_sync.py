@@ -0,0 +1,279 @@
+"""End-to-end benchmark of the real download scheduler against the local mock API.
+
+Starts benchmarks/mock_api.py in a separate process, runs one cycle of download_scheduler
+(or async_download_scheduler) into temporary directories and reports events/sec, requests per event,
+peak RSS of the downloader and duplicate/missed/out-of-order event counts.
+With --tail-seconds the run continues in tail mode while the mock produces --live-rate events per second,
+and the delay between the moment of an event and its write to a file is reported.
+With --sinks the records are also delivered to local stand-ins of the receivers (benchmarks/mock_sinks.py)
+and received records are checked for duplicates and gaps.
+
+Usage: python benchmarks/bench_sync.py --events 100000 --days 7 --latency-ms 20 --rate-limit 50 --mode async
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import mock_api  # noqa: E402
+import mock_sinks  # noqa: E402
+import run_import  # noqa: E402
+
+
+def start_mock(args):
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_api.py"), "--port", "0"]
+    for name in ("events", "days", "seed", "burst_share", "latency_ms", "latency_jitter_ms", "error_rate", "throttle_rate", "rate_limit", "live_rate"):
+        command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    banner = process.stdout.readline()
+    # "Mock audit API on http://127.0.0.1:PORT, N events until ISO"
+    base_url = banner.split(" on ")[1].split(",")[0]
+    now = datetime.fromisoformat(banner.strip().rsplit(" until ", 1)[1])
+    return process, base_url, now
+
+
+def make_settings(directory: str, sink_urls: list = None):
+    shift = round(datetime.now().astimezone().utcoffset().total_seconds() / 3600)
+    dir_paths = {"mail": Path(directory, "mail"), "all": Path(directory, "all")}
+    for path in dir_paths.values():
+        path.mkdir()
+    return run_import.SettingParams(oauth_token="benchmark", organization_id=1, dir_paths=dir_paths, ext="json",
+                                    file_names={"mail": "mail_audit", "all": "y360_audit"}, timezone_shift=shift,
+                                    parquet_dir=Path(directory, "parquet"), sink_urls=sink_urls or [])
+
+
+def get_server_stats(base_url: str):
+    with urllib.request.urlopen(f"{base_url}/_stats") as response:
+        return json.load(response)
+
+
+def install_latency_probe(since: float, latencies: list):
+    """Wrap run_import._save_records to measure the delay between an event and its write for events after since."""
+    save_records = run_import._save_records
+
+    def probe(settings, label, log_records, runtime_data):
+        dedup_index = runtime_data.last_records[label]
+        fresh = [r for r in log_records if run_import._event_identity(r.line) not in dedup_index]
+        result = save_records(settings, label, log_records, runtime_data)
+        written_at = time.time()
+        for r in fresh:
+            moment = mock_api._to_micros(r.event_time) / 1000000
+            if moment >= since:
+                latencies.append(written_at - moment)
+        return result
+
+    run_import._save_records = probe
+
+
+def percentile(values: list, share: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * share))], 3)
+
+
+def read_day_file(file_path: Path):
+    codec = run_import._codec_of_file(str(file_path))
+    with open(file_path, "rb") as f:
+        if codec is None:
+            data = f.read()
+        else:
+            data = b"".join(run_import._iter_decompressed(f, codec, os.path.getsize(file_path)))
+    return data.decode("utf8").splitlines()
+
+
+def check_output(settings, source: str, expected: set, ignore_after: str = None):
+    found, lines, out_of_order, size = set(), 0, 0, 0
+    for name in sorted(run_import._log_file_names(settings, source)):
+        file_path = Path(settings.dir_paths[source], name)
+        size += file_path.stat().st_size
+        previous = ""
+        for line in read_day_file(file_path):
+            record = json.loads(line)
+            if source == "mail":
+                identity, moment = record["uniqId"], record["date"]
+            else:
+                identity, moment = record["event"]["idempotency_id"], record["event"]["occurred_at"]
+            if moment < previous:
+                out_of_order += 1
+            previous = moment
+            if ignore_after is not None and moment[:23] > ignore_after:
+                continue
+            found.add(identity)
+            lines += 1
+    return {"lines": lines, "duplicates": lines - len(found), "missed": len(expected - found),
+            "unexpected": len(found - expected), "out_of_order": out_of_order, "bytes": size}
+
+
+def check_parquet(settings, expected: set, ignore_after: str = None):
+    import pyarrow.dataset
+
+    dataset = pyarrow.dataset.dataset(str(settings.parquet_dir), format="parquet", partitioning="hive")
+    table = dataset.to_table(columns=["idempotency_id", "occurred_at"])
+    identities = table.column("idempotency_id").to_pylist()
+    if ignore_after is not None:
+        moments = [moment.strftime("%Y-%m-%dT%H:%M:%S.%f")[:23] for moment in table.column("occurred_at").to_pylist()]
+        identities = [identity for identity, moment in zip(identities, moments) if moment <= ignore_after]
+    found = set(identities)
+    return {"rows": len(identities), "duplicates": len(identities) - len(found), "missed": len(expected - found),
+            "files": len(dataset.files), "bytes": sum(os.path.getsize(name) for name in dataset.files)}
+
+
+def check_sink(received, kind: str, expected: set, ignore_after: str = None):
+    identities = [identity for identity, moment in received.records.get(kind, []) if ignore_after is None or moment[:23] <= ignore_after]
+    found = set(identities)
+    return {"records": len(identities), "duplicates": len(identities) - len(found), "missed": len(expected - found)}
+
+
+def stage_seconds():
+    """Total seconds and count of every duration histogram of run_import.metrics, summed over labels."""
+    stages = {}
+    for line in run_import.metrics.render().splitlines():
+        name, _, value = line.rpartition(" ")
+        for suffix in ("_sum", "_count"):
+            metric = name.split("{")[0]
+            if metric.endswith(f"_seconds{suffix}"):
+                stage = stages.setdefault(metric[:-len(f"_seconds{suffix}")].removeprefix("audit_"), {"sum": 0.0, "count": 0})
+                stage[suffix[1:]] += float(value)
+    return {stage: {"seconds": round(item["sum"], 3), "count": int(item["count"])} for stage, item in stages.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of audit log download against the local mock API")
+    mock_api.add_arguments(parser)
+    parser.add_argument("--mode", choices=("sequential", "async"), default="sequential")
+    parser.add_argument("--sources", default="mail,all")
+    parser.add_argument("--workers", type=int, default=run_import.BACKFILL_MAX_WORKERS)
+    parser.add_argument("--fixed-windows", action="store_true", help="disable adaptive window sizing")
+    parser.add_argument("--compression", choices=("none", "gzip", "zstd"), default=run_import.OUTPUT_COMPRESSION)
+    parser.add_argument("--parquet", action="store_true", help="export new format log to Parquet files (requires pyarrow)")
+    parser.add_argument("--tail-seconds", type=float, default=0, help="follow the sources in tail mode after the first pass")
+    parser.add_argument("--sinks", default="", help="deliver records to stand-in receivers: comma separated syslog, bulk, hec, kafka")
+    parser.add_argument("--sink-latency-ms", type=float, default=0)
+    parser.add_argument("--sink-error-rate", type=float, default=0, help="share of 503 answers of HTTP receivers")
+    parser.add_argument("--sink-item-error-rate", type=float, default=0, help="share of rejected bulk documents and Kafka batches")
+    parser.add_argument("--sink-outage-seconds", type=float, default=0, help="HTTP receivers answer 503 for the first seconds")
+    parser.add_argument("--sink-backlog-mb", type=float, default=run_import.SINK_MAX_BACKLOG_MB)
+    parser.add_argument("--metrics", action="store_true", help="print time spent in each stage from the metrics histograms")
+    parser.add_argument("--json", action="store_true", help="print result as JSON")
+    args = parser.parse_args()
+
+    process, base_url, mock_now = start_mock(args)
+    try:
+        run_import.DEFAULT_360_API_URL = base_url
+        run_import.NEW_360_API_URL = f"{base_url}/v1"
+        run_import.MAX_DAYS_AGO_FOR_API_CALLS = math.ceil(args.days) + 1
+        run_import.BACKFILL_MAX_WORKERS = args.workers
+        run_import.ADAPTIVE_WINDOWS = not args.fixed_windows
+        run_import.OUTPUT_COMPRESSION = args.compression
+        run_import.PARQUET_EXPORT = args.parquet
+        run_import.LOGS_SOURCES = args.sources.split(",")
+        run_import.SINK_MAX_BACKLOG_MB = args.sink_backlog_mb
+        sink_kinds = [kind for kind in args.sinks.split(",") if kind]
+        sink_urls = []
+        if sink_kinds:
+            sink_config = mock_sinks.SinkConfig(latency_ms=args.sink_latency_ms, error_rate=args.sink_error_rate, item_error_rate=args.sink_item_error_rate)
+            syslog_server, http_server, received = mock_sinks.start_sinks(sink_config)
+            http_server.set_outage(args.sink_outage_seconds)
+            sink_urls = mock_sinks.sink_urls(syslog_server, http_server, sink_kinds)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Журнал загрузки пишется во временный каталог, а не в текущий
+            run_import.set_log_file(os.path.join(directory, run_import.LOG_FILE))
+            settings = make_settings(directory, sink_urls)
+            runtime_data = run_import.create_runtime_data(settings)
+            started = time.perf_counter()
+            if args.mode == "async":
+                asyncio.run(run_import.async_download_scheduler(settings, runtime_data, cycles=1))
+            else:
+                run_import.download_scheduler(settings, runtime_data, cycles=1)
+            elapsed = time.perf_counter() - started
+            server_stats = get_server_stats(base_url)
+
+            tail = None
+            cutoff = datetime.now(timezone.utc)
+            if args.tail_seconds > 0:
+                latencies = []
+                install_latency_probe(time.time(), latencies)
+                run_import.tail_scheduler(settings, runtime_data, duration_sec=args.tail_seconds)
+                tail_stats = get_server_stats(base_url)
+                # Последний опрос забирает события до текущего момента; события, появившиеся во время опроса, не проверяются
+                cutoff = datetime.now(timezone.utc) - timedelta(seconds=1)
+                for source in run_import.LOGS_SOURCES:
+                    run_import.poll_source_head(settings, runtime_data, source)
+                tail = {"seconds": args.tail_seconds, "requests": tail_stats["requests"] - server_stats["requests"],
+                        "events_served": tail_stats["events_served"] - server_stats["events_served"], "live_events": tail_stats["live_events"], "latency_p50_sec": percentile(latencies, 0.5),
+                        "latency_p95_sec": percentile(latencies, 0.95), "latency_max_sec": percentile(latencies, 1.0)}
+            runtime_data.close()
+            peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+            config = mock_api.config_from_arguments(args)
+            mail_events, new_events, _ = mock_api.generate_events(config, now=mock_now)
+            live_mail, live_new = mock_api.live_events(config, mock_now, cutoff)
+            expected = {
+                "mail": {json.loads(item[1])["uniqId"] for item in mail_events + live_mail},
+                "all": {json.loads(item[1])["event"]["idempotency_id"] for item in new_events + live_new},
+            }
+            ignore_after = cutoff.strftime("%Y-%m-%dT%H:%M:%S.%f")[:23] if tail else None
+            checks = {source: check_output(settings, source, expected[source], ignore_after) for source in run_import.LOGS_SOURCES}
+            parquet = check_parquet(settings, expected["all"], ignore_after) if args.parquet and "all" in run_import.LOGS_SOURCES else None
+            expected_sinks = set().union(*(expected[source] for source in run_import.LOGS_SOURCES))
+            sinks = {kind: check_sink(received, kind, expected_sinks, ignore_after) for kind in sink_kinds}
+    finally:
+        process.terminate()
+        process.wait()
+
+    # Скорость и количество запросов считаются только для первого прохода по истории
+    events = args.events * len(run_import.LOGS_SOURCES)
+    result = {
+        "mode": args.mode,
+        "elapsed_sec": round(elapsed, 3),
+        "events": events,
+        "events_per_sec": round(events / elapsed, 1),
+        "requests": server_stats["requests"],
+        "requests_per_event": round(server_stats["requests"] / max(events, 1), 4),
+        "throttled": server_stats["throttled"],
+        "server_errors": server_stats["errors"],
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "sources": checks,
+        "tail": tail,
+        "parquet": parquet,
+        "sinks": sinks,
+        "stages": stage_seconds() if args.metrics else None,
+    }
+    if args.json:
+        print(json.dumps(result))
+        return
+    print(f"mode {result['mode']}: {events} events in {elapsed:.2f} sec, {result['events_per_sec']:,.0f} events/sec")
+    print(f"requests {result['requests']} ({result['requests_per_event']} per event), throttled {result['throttled']}, server errors {result['server_errors']}")
+    print(f"peak RSS {result['peak_rss_mb']} MB")
+    if tail:
+        print(f"tail {tail['seconds']} sec: {tail['live_events']} live events, {tail['requests']} requests, {tail['events_served']} events served, "
+              f"write delay p50 {tail['latency_p50_sec']} sec, p95 {tail['latency_p95_sec']} sec, max {tail['latency_max_sec']} sec")
+    for source, check in checks.items():
+        print(f"{source}: lines {check['lines']}, duplicates {check['duplicates']}, missed {check['missed']}, "
+              f"unexpected {check['unexpected']}, out of order {check['out_of_order']}, files {check['bytes'] / 1024 / 1024:.1f} MB")
+    if parquet:
+        print(f"parquet: rows {parquet['rows']}, duplicates {parquet['duplicates']}, missed {parquet['missed']}, "
+              f"{parquet['files']} files {parquet['bytes'] / 1024 / 1024:.1f} MB")
+    for kind, check in sinks.items():
+        print(f"sink {kind}: records {check['records']}, duplicates {check['duplicates']}, missed {check['missed']}")
+    if result["stages"]:
+        print("stages: " + ", ".join(f"{stage} {item['seconds']} sec / {item['count']}" for stage, item in sorted(result["stages"].items())))
+
+
+if __name__ == "__main__":
+    main()
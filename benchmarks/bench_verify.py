@@ -0,0 +1,91 @@
+"""Speed and accuracy of the verify command against the local mock API.
+
+Downloads --events events of --days days from benchmarks/mock_api.py with the real scheduler, then removes
+one hour of records from one day file and every --scatter-rate record from another (holes), and runs
+verification: report only, with refill, and again to check that nothing is missing. Prints the time of
+counting day files (cold and cached), API requests and found and refilled records.
+
+Usage: python benchmarks/bench_verify.py --events 300000 --days 90 --sample-rate 0.05
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+import bench_sync  # noqa: E402
+import run_import  # noqa: E402
+
+
+def make_holes(settings, source: str, scatter_rate: float):
+    rng = random.Random(3)
+    names = sorted(run_import._log_file_names(settings, source))
+    removed = 0
+    for name, whole_hour in ((names[len(names) // 3], True), (names[len(names) // 2], False)):
+        path = os.path.join(settings.dir_paths[source], name)
+        with open(path, "rb") as f:
+            lines = f.read().split(b"\n")[:-1]
+        if whole_hour:
+            hour = run_import._event_time_of_line(source, lines[len(lines) // 2])[:13]
+            kept = [line for line in lines if run_import._event_time_of_line(source, line)[:13] != hour]
+        else:
+            kept = [line for line in lines if rng.random() >= scatter_rate]
+        removed += len(lines) - len(kept)
+        with open(path, "wb") as f:
+            f.write(b"".join(line + b"\n" for line in kept))
+    return removed
+
+
+def api_requests(base_url: str):
+    with urllib.request.urlopen(f"{base_url}/_stats") as response:
+        return json.load(response)["requests"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed and accuracy of verification of saved logs against the API")
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--days", type=float, default=10)
+    parser.add_argument("--scatter-rate", type=float, default=0.002, help="share of records removed from one day file")
+    parser.add_argument("--sample-rate", type=float, default=run_import.VERIFY_SAMPLE_RATE)
+    parser.add_argument("--max-buckets", type=int, default=run_import.VERIFY_MAX_BUCKETS)
+    args = parser.parse_args()
+
+    mock_args = argparse.Namespace(events=args.events, days=args.days, seed=1, burst_share=0.0, latency_ms=0, latency_jitter_ms=0,
+                                   error_rate=0, throttle_rate=0, rate_limit=0, live_rate=0)
+    process, base_url, _ = bench_sync.start_mock(mock_args)
+    run_import.DEFAULT_360_API_URL = base_url
+    run_import.NEW_360_API_URL = f"{base_url}/v1"
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            # Журнал загрузки пишется во временный каталог, а не в текущий
+            run_import.set_log_file(os.path.join(directory, run_import.LOG_FILE))
+            settings = bench_sync.make_settings(directory)
+            runtime_data = run_import.create_runtime_data(settings)
+            run_import.download_scheduler(settings, runtime_data, cycles=1)
+            runtime_data.close()
+            for source in run_import.LOGS_SOURCES:
+                print(f"{source}: removed {make_holes(settings, source, args.scatter_rate)} records")
+            for label, refill in (("report", False), ("cached", False), ("refill", True), ("after refill", False)):
+                runtime_data = run_import.create_runtime_data(settings) if refill else None
+                for source in run_import.LOGS_SOURCES:
+                    requests_before = api_requests(base_url)
+                    started = time.perf_counter()
+                    totals = run_import.verify_log_files(settings, source, runtime_data=runtime_data, max_buckets=args.max_buckets, sample_rate=args.sample_rate)
+                    print(f"{label} {source}: {time.perf_counter() - started:.2f} sec, {totals['records']} records in {totals['buckets']} buckets, "
+                          f"{totals['suspect']} suspect, {totals['checked']} checked with {api_requests(base_url) - requests_before} API requests, "
+                          f"{totals['missing']} missing in {len(totals['holes'])} buckets, {totals['refilled']} refilled")
+                if runtime_data is not None:
+                    runtime_data.close()
+    finally:
+        process.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Throughput of day file writing: open-per-call appends versus DayFileWriterPool.
+
+Usage: python benchmarks/bench_writers.py [records] [batch_size] [days]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import run_import  # noqa: E402
+
+
+def make_batches(records: int, batch_size: int, days: int):
+    line = '{"eventType": "message_receive", "date": "2025-04-23T04:59:35.118Z", "orgId": 1234567, "userLogin": "ivanov@domain.ru", "subject": "benchmark"}'
+    batches = []
+    for start in range(0, records, batch_size):
+        batch = {}
+        for i in range(start, min(start + batch_size, records)):
+            batch.setdefault(f"2025-04-{1 + i % days:02d}", []).append(line)
+        batches.append(batch)
+    return batches
+
+
+def write_open_per_call(directory: str, batches: list):
+    # Прежняя схема: файл открывается на каждый вызов сохранения, каждая строка пишется отдельным write
+    for batch in batches:
+        for date, lines in batch.items():
+            with open(os.path.join(directory, f"audit_{date}.json"), "a", encoding="utf8") as f:
+                for line in lines:
+                    f.write(f"{line}\n")
+
+
+def write_pooled(directory: str, batches: list, fsync_policy: str):
+    writers = run_import.DayFileWriterPool(fsync_policy=fsync_policy)
+    for number, batch in enumerate(batches, start=1):
+        for date, lines in batch.items():
+            writers.write_lines(os.path.join(directory, f"audit_{date}.json"), lines)
+        # Фиксация отметки последней записи примерно раз в 100 пакетов, как при окнах по несколько страниц
+        if number % 100 == 0:
+            writers.commit()
+    writers.close()
+
+
+def measure(name: str, func, records: int, *args):
+    with tempfile.TemporaryDirectory() as directory:
+        # Журнал загрузки пишется во временный каталог, а не в текущий
+        run_import.set_log_file(os.path.join(directory, run_import.LOG_FILE))
+        started = time.perf_counter()
+        func(directory, *args)
+        elapsed = time.perf_counter() - started
+    print(f"{name:<28} {elapsed:8.3f} sec  {records / elapsed:12,.0f} records/sec")
+    return elapsed
+
+
+def main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    days = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    batches = make_batches(records, batch_size, days)
+    print(f"{records} records, batches of {batch_size} records, {days} day files")
+    baseline = measure("open per call", write_open_per_call, records, batches)
+    for policy in ("none", "commit", "batch"):
+        elapsed = measure(f"writer pool, fsync={policy}", write_pooled, records, batches, policy)
+        print(f"{'':<28} speedup x{baseline / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""Local stand-in for both Yandex 360 audit log endpoints.
+
+Serves synthetic events for:
+  /security/v1/org/{org_id}/audit_log/mail     - pageSize, pageToken, afterDate (exclusive), beforeDate (exclusive),
+                                                 events from newest to oldest, "nextPageToken" is empty on the last page
+  /v1/auditlog/organizations/{org_id}/events   - count, iteration_key, started_at and ended_at (both inclusive),
+                                                 events from oldest to newest, "iteration_key" is null on the last page
+  /_stats                                      - request counters of the server
+
+Latency, random 5xx errors, random 429 answers and a requests/sec limit (429 with Retry-After) are configurable.
+With --live-rate the server keeps producing new events after start (evenly, the given number per second).
+
+Usage: python benchmarks/mock_api.py --port 8765 --events 100000 --days 3 --latency-ms 20 --rate-limit 50
+"""
+import argparse
+import bisect
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+@dataclass
+class MockConfig:
+    events: int = 100000
+    days: float = 3.0
+    seed: int = 1
+    # Доля событий, сосредоточенных в коротких всплесках активности
+    burst_share: float = 0.3
+    latency_ms: float = 0.0
+    latency_jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    # Ограничение количества запросов в секунду на каждый endpoint, 0 - без ограничения
+    rate_limit: float = 0.0
+    retry_after_sec: int = 1
+    # Количество новых событий в секунду после запуска сервера, 0 - набор событий не меняется
+    live_rate: float = 0.0
+
+
+def _to_micros(value: str):
+    """Parse API datetime string (Z or +00:00, optional fraction) to microseconds since epoch."""
+    value = value.strip().replace("Z", "").replace("+00:00", "")
+    main, _, fraction = value.partition(".")
+    moment = datetime.strptime(main, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+    return int(moment.timestamp()) * 1000000 + int((fraction + "000000")[:6])
+
+
+def generate_events(config: MockConfig, now: datetime = None):
+    """Deterministic synthetic events. Returns sorted lists of (micros, JSON) for mail and new format logs and the reference now."""
+    rnd = random.Random(config.seed)
+    now = now or datetime.now(timezone.utc).replace(microsecond=0)
+    end_us = int(now.timestamp()) * 1000000
+    span_us = int(config.days * 86400 * 1000000)
+    bursts = [end_us - rnd.randrange(span_us) for _ in range(max(1, int(config.days * 4)))]
+    moments = []
+    for _ in range(config.events):
+        if rnd.random() < config.burst_share:
+            moment = rnd.choice(bursts) - rnd.randrange(600 * 1000000)
+        else:
+            moment = end_us - rnd.randrange(span_us)
+        moments.append(max(moment, end_us - span_us))
+    moments.sort()
+
+    mail, new = [], []
+    for number, moment in enumerate(moments):
+        mail_event, new_event = make_events(number, moment)
+        mail.append(mail_event)
+        new.append(new_event)
+    mail.sort(key=lambda item: item[0])
+    return mail, new, now
+
+
+def live_events(config: MockConfig, now: datetime, until: datetime):
+    """Events produced by the server after now with config.live_rate per second, up to until (inclusive)."""
+    if config.live_rate <= 0:
+        return [], []
+    start_us = int(now.timestamp()) * 1000000
+    count = int((until - now).total_seconds() * config.live_rate)
+    events = [make_events(config.events + i, start_us + int((i + 1) * 1000000 / config.live_rate)) for i in range(count)]
+    return [item[0] for item in events], [item[1] for item in events]
+
+
+def make_events(number: int, moment: int):
+    """Mail and new format event (as (micros, JSON)) with the given number at moment microseconds since epoch."""
+    moment_dt = datetime.fromtimestamp(moment / 1000000, tz=timezone.utc)
+    user = f"user{number % 50}@domain.ru"
+    # Почтовые события имеют точность до миллисекунд, события нового формата - до микросекунд
+    mail_us = moment - moment % 1000
+    mail = (mail_us, json.dumps({
+        "eventType": "message_receive", "date": moment_dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{moment_dt.microsecond // 1000:03d}Z",
+        "orgId": 1, "userUid": str(1130000000000 + number % 50), "userLogin": user, "userName": "Benchmark User",
+        "requestId": "", "uniqId": f"mail-{number}", "source": "server", "folderName": "Inbox", "folderType": "inbox",
+        "subject": "benchmark", "from": "sender@example.com", "clientIp": "10.0.0.1",
+    }, ensure_ascii=False))
+    new = (moment, json.dumps({
+        "event": {"idempotency_id": f"all-{number}", "ip": "10.0.0.2", "is_system": False, "meta": {},
+                  "occurred_at": moment_dt.strftime("%Y-%m-%dT%H:%M:%S.%f") + "+00:00", "org_id": 1,
+                  "request_id": f"req-{number}", "service": "Web", "status": "Success",
+                  "type": "benchmark.event", "uid": 1130000000000 + number % 50},
+        "user_login": user.split("@")[0], "user_name": "Benchmark User",
+    }, ensure_ascii=False))
+    return mail, new
+
+
+class _TokenBucket:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class MockAuditApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config: MockConfig):
+        super().__init__(address, _Handler)
+        self.config = config
+        self.mail, self.new, self.now = generate_events(config)
+        self.mail_keys = [item[0] for item in self.mail]
+        self.new_keys = [item[0] for item in self.new]
+        self.random = random.Random(config.seed + 1)
+        self.buckets = {"mail": _TokenBucket(config.rate_limit), "all": _TokenBucket(config.rate_limit)}
+        self.stats = {"requests": 0, "mail_requests": 0, "all_requests": 0, "throttled": 0, "errors": 0, "events_served": 0}
+        self.stats_lock = threading.Lock()
+        self.live_count = 0
+        self.live_lock = threading.Lock()
+
+    def advance(self):
+        """Append live events that have occurred by now. Lists are only appended, so readers can use them without the lock."""
+        if self.config.live_rate <= 0:
+            return
+        with self.live_lock:
+            target = int((time.time() - self.now.timestamp()) * self.config.live_rate)
+            for i in range(self.live_count, target):
+                mail_event, new_event = make_events(self.config.events + i, int(self.now.timestamp()) * 1000000 + int((i + 1) * 1000000 / self.config.live_rate))
+                self.mail.append(mail_event)
+                self.mail_keys.append(mail_event[0])
+                self.new.append(new_event)
+                self.new_keys.append(new_event[0])
+            self.live_count = max(self.live_count, target)
+
+    def count(self, **counters):
+        with self.stats_lock:
+            for name, value in counters.items():
+                self.stats[name] += value
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    wbufsize = 64 * 1024
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code: int, body: bytes, headers: dict = None):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path == "/_stats":
+            return self._send(200, json.dumps(dict(server.stats, live_events=server.live_count)).encode("utf8"))
+        if url.path.endswith("/audit_log/mail"):
+            source = "mail"
+        elif url.path.endswith("/events"):
+            source = "all"
+        else:
+            return self._send(404, b'{"message": "not found"}')
+
+        server.count(requests=1, **{f"{source}_requests": 1})
+        server.advance()
+        config = server.config
+        if config.latency_ms or config.latency_jitter_ms:
+            time.sleep((config.latency_ms + server.random.random() * config.latency_jitter_ms) / 1000)
+        if not server.buckets[source].take() or server.random.random() < config.throttle_rate:
+            server.count(throttled=1)
+            return self._send(429, b'{"message": "too many requests"}', {"Retry-After": str(config.retry_after_sec)})
+        if server.random.random() < config.error_rate:
+            server.count(errors=1)
+            return self._send(500, b'{"message": "internal error"}')
+
+        try:
+            if source == "mail":
+                body, served = self._mail_page(query)
+            else:
+                body, served = self._new_page(query)
+        except (KeyError, ValueError) as e:
+            return self._send(400, json.dumps({"message": f"bad request: {e}"}).encode("utf8"))
+        server.count(events_served=served)
+        self._send(200, body)
+
+    def _mail_page(self, query: dict):
+        server = self.server
+        after = _to_micros(query["afterDate"]) if query.get("afterDate") else -1
+        before = _to_micros(query["beforeDate"]) if query.get("beforeDate") else 1 << 62
+        low = bisect.bisect_right(server.mail_keys, after)
+        high = bisect.bisect_left(server.mail_keys, before)
+        offset = int(query.get("pageToken") or 0)
+        size = min(int(query.get("pageSize", 100)), 100)
+        # Новые события первыми: страница offset отсчитывается от конца диапазона
+        page_high = high - offset
+        page_low = max(low, page_high - size)
+        events = [server.mail[i][1] for i in range(page_high - 1, page_low - 1, -1)]
+        next_token = str(offset + size) if page_low > low else ""
+        body = '{"events": [' + ", ".join(events) + '], "nextPageToken": ' + json.dumps(next_token) + "}"
+        return body.encode("utf8"), len(events)
+
+    def _new_page(self, query: dict):
+        server = self.server
+        low = bisect.bisect_left(server.new_keys, _to_micros(query["started_at"]))
+        high = bisect.bisect_right(server.new_keys, _to_micros(query["ended_at"]))
+        offset = int(query.get("iteration_key") or 0)
+        size = min(int(query.get("count", 100)), 100)
+        events = [item[1] for item in server.new[low + offset:min(low + offset + size, high)]]
+        next_key = json.dumps(str(offset + size)) if low + offset + size < high else "null"
+        body = '{"items": [' + ", ".join(events) + '], "iteration_key": ' + next_key + "}"
+        return body.encode("utf8"), len(events)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--events", type=int, default=MockConfig.events)
+    parser.add_argument("--days", type=float, default=MockConfig.days)
+    parser.add_argument("--seed", type=int, default=MockConfig.seed)
+    parser.add_argument("--burst-share", type=float, default=MockConfig.burst_share)
+    parser.add_argument("--latency-ms", type=float, default=MockConfig.latency_ms)
+    parser.add_argument("--latency-jitter-ms", type=float, default=MockConfig.latency_jitter_ms)
+    parser.add_argument("--error-rate", type=float, default=MockConfig.error_rate)
+    parser.add_argument("--throttle-rate", type=float, default=MockConfig.throttle_rate)
+    parser.add_argument("--rate-limit", type=float, default=MockConfig.rate_limit)
+    parser.add_argument("--live-rate", type=float, default=MockConfig.live_rate)
+
+
+def config_from_arguments(args):
+    return MockConfig(events=args.events, days=args.days, seed=args.seed, burst_share=args.burst_share,
+                      latency_ms=args.latency_ms, latency_jitter_ms=args.latency_jitter_ms, error_rate=args.error_rate,
+                      throttle_rate=args.throttle_rate, rate_limit=args.rate_limit, live_rate=args.live_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of Yandex 360 audit log API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = MockAuditApi((args.host, args.port), config_from_arguments(args))
+    print(f"Mock audit API on http://{args.host}:{server.server_address[1]}, {args.events} events until {server.now.isoformat()}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""Local stand-ins for the receivers of delivery sinks.
+
+  syslog TCP server        - RFC 5424 messages with octet counting framing (RFC 6587)
+  HTTP server              - POST /<index>/_bulk (Elasticsearch bulk API, "create" actions with _id, 409 for existing ids),
+                             POST /services/collector/event (Splunk HEC), POST /topics/<topic> (Kafka REST Proxy v2),
+                             GET /_stats - received records and request counters
+
+Latency, random 503 answers, random rejected bulk items (429) and Kafka write errors are configurable; with
+set_outage(seconds) the HTTP server answers 503 to everything for the given time. Received records are kept
+as (identity, event time) of the audit record: uniqId for mail logs, event.idempotency_id for new format logs.
+
+Usage: python benchmarks/mock_sinks.py --syslog-port 5514 --http-port 8766 --error-rate 0.05
+"""
+import argparse
+import json
+import random
+import socketserver
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class SinkConfig:
+    latency_ms: float = 0.0
+    # Доля запросов, на которые отвечает 503
+    error_rate: float = 0.0
+    # Доля документов bulk запроса, отклонённых с кодом 429, и запросов Kafka с ошибкой записи
+    item_error_rate: float = 0.0
+    seed: int = 1
+
+
+class ReceivedRecords:
+    """Records received by every kind of receiver: kind -> list of (identity, event time)."""
+
+    def __init__(self):
+        self.records = {}
+        self.stats = {"requests": 0, "errors": 0, "item_errors": 0, "duplicates_refused": 0}
+        self.ids = set()
+        self.lock = threading.Lock()
+
+    def add(self, kind: str, lines: list):
+        with self.lock:
+            received = self.records.setdefault(kind, [])
+            for line in lines:
+                record = json.loads(line)
+                if "event" in record:
+                    received.append((record["event"]["idempotency_id"], record["event"]["occurred_at"]))
+                else:
+                    received.append((record["uniqId"], record["date"]))
+
+    def count(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                self.stats[name] += value
+
+
+class MockSyslogServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, received: ReceivedRecords):
+        super().__init__(address, _SyslogHandler)
+        self.received = received
+
+
+class _SyslogHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            length = b""
+            while not length.endswith(b" "):
+                char = self.rfile.read(1)
+                if not char:
+                    return
+                length += char
+            message = self.rfile.read(int(length))
+            # <PRI>1 TIMESTAMP HOSTNAME APP-NAME PROCID MSGID STRUCTURED-DATA MSG
+            fields = message.split(b" ", 7)
+            self.server.received.add("syslog", [fields[7]])
+
+
+class MockSinkHttp(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config: SinkConfig, received: ReceivedRecords):
+        super().__init__(address, _HttpHandler)
+        self.config = config
+        self.received = received
+        self.random = random.Random(config.seed)
+        self.outage_until = 0.0
+
+    def set_outage(self, seconds: float):
+        self.outage_until = time.monotonic() + seconds
+
+
+class _HttpHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code: int, body: bytes):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/_stats":
+            received = self.server.received
+            with received.lock:
+                stats = dict(received.stats, records={kind: len(items) for kind, items in received.records.items()})
+            return self._send(200, json.dumps(stats).encode("utf8"))
+        self._send(404, b'{"message": "not found"}')
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server.received.count(requests=1)
+        if server.config.latency_ms:
+            time.sleep(server.config.latency_ms / 1000)
+        if time.monotonic() < server.outage_until or server.random.random() < server.config.error_rate:
+            server.received.count(errors=1)
+            return self._send(503, b'{"message": "unavailable"}')
+        if self.path.endswith("/_bulk"):
+            return self._bulk(body)
+        if self.path.startswith("/services/collector"):
+            return self._hec(body)
+        if self.path.startswith("/topics/"):
+            return self._kafka(body)
+        self._send(404, b'{"message": "not found"}')
+
+    def _bulk(self, body: bytes):
+        server = self.server
+        lines = body.split(b"\n")
+        items, accepted, errors = [], [], False
+        for action, document in zip(lines[0::2], lines[1::2]):
+            key = json.loads(action)["create"]["_id"]
+            if server.random.random() < server.config.item_error_rate:
+                server.received.count(item_errors=1)
+                items.append({"create": {"_id": key, "status": 429, "error": {"type": "es_rejected_execution_exception"}}})
+                errors = True
+                continue
+            with server.received.lock:
+                exists = key in server.received.ids
+                server.received.ids.add(key)
+            if exists:
+                server.received.count(duplicates_refused=1)
+                items.append({"create": {"_id": key, "status": 409, "error": {"type": "version_conflict_engine_exception"}}})
+                errors = True
+                continue
+            accepted.append(document)
+            items.append({"create": {"_id": key, "status": 201}})
+        server.received.add("bulk", accepted)
+        self._send(200, json.dumps({"took": 1, "errors": errors, "items": items}).encode("utf8"))
+
+    def _hec(self, body: bytes):
+        decoder = json.JSONDecoder()
+        text, position, lines = body.decode("utf8"), 0, []
+        while position < len(text):
+            event, position = decoder.raw_decode(text, position)
+            lines.append(json.dumps(event["event"]))
+        self.server.received.add("hec", lines)
+        self._send(200, b'{"text": "Success", "code": 0}')
+
+    def _kafka(self, body: bytes):
+        server = self.server
+        records = json.loads(body)["records"]
+        if server.random.random() < server.config.item_error_rate:
+            # Ошибка записи в раздел: клиент отправляет пакет повторно
+            server.received.count(item_errors=1)
+            offsets = [{"partition": 0, "offset": None, "error_code": 50003, "error": "Not enough replicas"} for _ in records]
+        else:
+            server.received.add("kafka", [json.dumps(record["value"]) for record in records])
+            offsets = [{"partition": 0, "offset": number, "error_code": None, "error": None} for number in range(len(records))]
+        self._send(200, json.dumps({"key_schema_id": None, "value_schema_id": None, "offsets": offsets}).encode("utf8"))
+
+
+def start_sinks(config: SinkConfig, host: str = "127.0.0.1", syslog_port: int = 0, http_port: int = 0):
+    """Start both servers in daemon threads. Returns (syslog server, HTTP server, received records)."""
+    received = ReceivedRecords()
+    syslog_server = MockSyslogServer((host, syslog_port), received)
+    http_server = MockSinkHttp((host, http_port), config, received)
+    for server in (syslog_server, http_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return syslog_server, http_server, received
+
+
+def sink_urls(syslog_server, http_server, kinds: list):
+    """Receiver addresses of run_import (AUDIT_SINK_URLS) for the given kinds: syslog, bulk, hec, kafka."""
+    syslog_host, syslog_port = syslog_server.server_address[:2]
+    http_host, http_port = http_server.server_address[:2]
+    urls = {
+        "syslog": f"syslog://{syslog_host}:{syslog_port}",
+        "bulk": f"http://{http_host}:{http_port}/audit/_bulk",
+        "hec": f"http://x:token@{http_host}:{http_port}/services/collector/event",
+        "kafka": f"kafka+http://{http_host}:{http_port}/audit",
+    }
+    return [urls[kind] for kind in kinds]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-ins for syslog, Elasticsearch bulk, Splunk HEC and Kafka REST receivers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--syslog-port", type=int, default=5514)
+    parser.add_argument("--http-port", type=int, default=8766)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--item-error-rate", type=float, default=0)
+    args = parser.parse_args()
+    config = SinkConfig(latency_ms=args.latency_ms, error_rate=args.error_rate, item_error_rate=args.item_error_rate)
+    syslog_server, http_server, _ = start_sinks(config, args.host, args.syslog_port, args.http_port)
+    print("Mock sinks: " + ", ".join(sink_urls(syslog_server, http_server, ["syslog", "bulk", "hec", "kafka"])), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,252 @@
-from dotenv import load_dotenv
-import requests
 import logging
 import json
-import logging.handlers as handlers
 import os
 from pathlib import Path
 import sys
 import re
 from dataclasses import dataclass
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
 from http import HTTPStatus
 import time
 import traceback
+import random
+import threading
+import heapq
+import hashlib
+import contextvars
+import math
+import functools
+import queue
+from urllib.parse import urlsplit, urlunsplit, quote
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 DEFAULT_360_API_URL = "https://api360.yandex.net"
 NEW_360_API_URL = "https://cloud-api.yandex.net/v1"
 LOG_FILE = "get_audit_logs.log"
 
-# отфильтрованные события и почтовые ящики (не исользуется)
+# Почтовые события (eventType) и почтовые ящики (userLogin), которые не сохраняются. Дополнительные правила фильтрации
+# и проекции полей задаются в JSON файле EVENT_FILTERS_FILE (переменная окружения, может задаваться для каждой организации)
 FILTERED_MAIL_EVENTS = []
 FILTERED_MAILBOXES = []
 
-# Количество страниц для запроса логов последовательно в одном цикле последовательного обращения к API, после чего формируется новый набор стартовой и конечных дат
+# Значение, которым заменяются поля, скрытые правилами redact
+FILTER_REDACTED_VALUE = "***"
+
+# Количество страниц почтовых логов, читаемых по pageToken в одном диапазоне дат. Если их не хватило, оставшаяся часть диапазона
+# делится по времени на части примерно по WINDOW_TARGET_PAGES страниц (по плотности прочитанных страниц, не больше MAIL_SPLIT_MAX_PARTS частей)
 OLD_LOG_MAX_PAGES = 10
+MAIL_SPLIT_MAX_PARTS = 16
+
+# Количество потоков, параллельно загружающих части диапазона почтовых логов
+MAIL_SPLIT_MAX_WORKERS = 4
 
 # На сколько секунд сдвигается назад стартовыя дата запроса логов между последовательными обращениями к API (чтобы не потерять записи)
 OVERLAPPED_SECONDS = 2
 MAX_RETRIES = 3
+# Базовая задержка перед повторной попыткой, далее она растет экспоненциально (со случайным разбросом) до RETRIES_MAX_DELAY_SEC
 RETRIES_DELAY_SEC = 2
+RETRIES_MAX_DELAY_SEC = 60
+
+# Коды ответа API, при которых запрос повторяется (для 429 и 503 учитывается заголовок Retry-After)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Таймауты HTTP запросов к API в секундах: установка соединения и чтение ответа
+HTTP_CONNECT_TIMEOUT_SEC = 10
+HTTP_READ_TIMEOUT_SEC = 60
+
+# Максимальное количество keep-alive соединений в пуле для одного адреса API
+HTTP_POOL_MAXSIZE = 10
 
 # Цикл запроса логов
 SLEEP_MINITS_AFTER_LAST_FETCH = 15
 
+# Режим слежения: после загрузки истории голова каждого источника опрашивается с коротким самонастраивающимся интервалом
+# вместо паузы SLEEP_MINITS_AFTER_LAST_FETCH между полными проходами
+USE_TAIL_MODE = True
+
+# Интервал опроса в режиме слежения: TAIL_MIN_POLL_SEC секунд после получения новых событий,
+# при их отсутствии растет в TAIL_BACKOFF_FACTOR раз за опрос до SLEEP_MINITS_AFTER_LAST_FETCH минут
+TAIL_MIN_POLL_SEC = 5
+TAIL_BACKOFF_FACTOR = 2.0
+
+# Перекрытие запроса в режиме слежения в секундах для событий, попадающих в API с задержкой (не больше DEDUP_WINDOW_SECONDS)
+TAIL_LOOKBACK_SECONDS = 10
+
+# Задержка появления событий в API в секундах: отметка последней записи фиксируется не позже текущего момента минус задержка,
+# чтобы следующий запрос снова захватил недавние события. Растет до наблюдаемой задержки (не больше DEDUP_WINDOW_SECONDS - TAIL_LOOKBACK_SECONDS)
+TAIL_API_DELAY_SECONDS = 60
+
+# Опросы режима слежения запрашивают только новые события: от конца предыдущего запроса (курсор в памяти) до текущего момента.
+# Перекрытие на задержку API (от отметки последней записи) запрашивается раз в TAIL_OVERLAP_POLLS опросов, при росте оценки задержки
+# и до того, как перекрытие выйдет за окно индекса дублей DEDUP_WINDOW_SECONDS
+TAIL_OVERLAP_POLLS = 10
+
 # Количество дней в прошлое для запроса логов, если нет никакой истории выгрузки
 MAX_DAYS_AGO_FOR_API_CALLS = 90
 
 # Время в минутах для сбора логов нового формата в одном цикле обращения к API и сброса полученных данных в файл
+# При ADAPTIVE_WINDOWS = True - начальная длина окна, дальше она подбирается по плотности событий
 NEW_LOG_ONE_FETCH_CYCLE_IN_MINUTES = 180
 
+# Подбор длины окна запроса по наблюдаемой плотности событий: шире на разреженных участках, уже на плотных
+ADAPTIVE_WINDOWS = True
+
+# Целевое количество страниц ответа API на одно окно (для почтовых логов должно быть меньше OLD_LOG_MAX_PAGES)
+WINDOW_TARGET_PAGES = 5
+
+# Границы длины окна в минутах
+WINDOW_MIN_MINUTES = 1
+WINDOW_MAX_MINUTES = 24 * 60
+
+# Во сколько раз окно может вырасти после одного разреженного окна и вес нового наблюдения при снижении плотности
+WINDOW_MAX_GROWTH = 4.0
+WINDOW_DENSITY_SMOOTHING = 0.5
+
+# Количество параллельных потоков при первичной загрузке (backfill) логов нового формата. 1 - последовательная загрузка
+BACKFILL_MAX_WORKERS = 4
+
+# Минимальное количество окон текущей длины в загружаемом диапазоне, начиная с которого включается параллельная загрузка
+BACKFILL_MIN_WINDOWS = 3
+
+# Сколько страниц ответа API окна параллельной загрузки ждут записи в памяти; дальше поток окна ждёт, пока их запишут
+BACKFILL_PREFETCH_PAGES = 10
+
+# Ширина окна в секундах (от самого нового записанного события), в котором запоминаются записанные события для отсечения дублей
+DEDUP_WINDOW_SECONDS = 600
+
+# Объем конца последнего файла логов в байтах, по которому при старте восстанавливается индекс записанных событий
+DEDUP_REBUILD_TAIL_BYTES = 4 * 1024 * 1024
+
+# В файл состояния сохраняются идентификаторы событий не старше отметки последней записи минус столько секунд
+# (должно покрывать перекрытие запросов OVERLAPPED_SECONDS и TAIL_LOOKBACK_SECONDS); остальной индекс дублей не сохраняется
+CHECKPOINT_DEDUP_SECONDS = 30
+
+# Сохранять прогресс загрузки в файл состояния <базовое_имя><CHECKPOINT_FILE_SUFFIX> в каталоге логов источника
+USE_CHECKPOINTS = True
+CHECKPOINT_FILE_SUFFIX = ".state"
+
+# Максимальное количество записей логов нового формата в буфере упорядочивания при потоковой записи окна в файлы
+STREAM_REORDER_BUFFER_RECORDS = 10000
+
+# Через сколько страниц буфер упорядочивания полностью сбрасывается в файлы, а в файл состояния сохраняется курсор страницы (iteration_key)
+STREAM_FLUSH_PAGES = 50
+
+# Максимальное количество одновременно открытых файлов логов (по дням), давно не использованные файлы закрываются
+WRITER_MAX_OPEN_FILES = 8
+
+# Размер буфера записи одного файла логов в байтах
+WRITER_BUFFER_BYTES = 1024 * 1024
+
+# Буферы файлов сбрасываются на диск после стольких записей, по прошествии WRITER_FLUSH_INTERVAL_SEC секунд и перед сдвигом отметки последней записи
+WRITER_FLUSH_RECORDS = 5000
+WRITER_FLUSH_INTERVAL_SEC = 5
+
+# Гарантия сохранности записанных данных: "none" - без fsync, "batch" - fsync при каждом сбросе буферов, "commit" - fsync перед сдвигом отметки последней записи
+WRITER_FSYNC_POLICY = "commit"
+
+# Сжатие файлов логов: "none" - обычные текстовые файлы, "gzip" - файлы .gz, "zstd" - файлы .zst (нужен пакет zstandard).
+# Каждый сброс буферов записывает в файл независимый блок (gzip member / zstd frame), поэтому при сбое теряется не больше одного блока
+OUTPUT_COMPRESSION = "none"
+
+# Закрытые дни (файлы, после которых уже записан следующий день) пережимаются в фоне блоками по SEAL_MEMBER_BYTES несжатых данных
+SEAL_CLOSED_DAYS = True
+SEAL_MEMBER_BYTES = 4 * 1024 * 1024
+
+# Запоздавшие события (старше последней записи файла дня): "append" - дописываются в конец файла дня, "merge" - записываются
+# в отсортированные прогоны <файл дня>.late-<номер> рядом с файлом и периодически сливаются с файлом дня, файлы дней остаются отсортированными
+LATE_EVENTS_MODE = "append"
+
+# Прогоны дня сливаются с файлом, когда самому старому из них LATE_MERGE_INTERVAL_SEC секунд или их стало LATE_MERGE_MAX_RUNS,
+# а также при завершении загрузки
+LATE_MERGE_INTERVAL_SEC = 300
+LATE_MERGE_MAX_RUNS = 16
+LATE_RUN_SUFFIX = ".late"
+
+# Выгрузка общих аудит-логов в Parquet (нужен пакет pyarrow) в каталог PARQUET_CATALOG_LOCATION (по умолчанию - подкаталог parquet каталога логов)
+PARQUET_EXPORT = False
+
+# Разбиение Parquet файлов по каталогам: "day" - date=YYYY-MM-DD, "hour" - date=YYYY-MM-DD/hour=HH
+PARQUET_PARTITIONING = "day"
+
+# Строки файла отсортированы по времени события, поэтому статистика min/max групп строк позволяет читать только нужный интервал времени
+PARQUET_ROW_GROUP_ROWS = 50000
+
+# Новые Parquet файлы записываются, когда накоплено PARQUET_FILE_ROWS строк или прошло PARQUET_FLUSH_INTERVAL_SEC секунд с прошлой записи
+PARQUET_FILE_ROWS = 100000
+PARQUET_FLUSH_INTERVAL_SEC = 900
+PARQUET_COMPRESSION = "zstd"
+PARQUET_STATE_FILE = "_export.state"
+
+# Индекс сохранённых логов для поиска по времени, пользователю, типу события и IP (файл <базовое_имя>.index.db в каталоге логов)
+USE_QUERY_INDEX = False
+
+# Строки обычного файла объединяются в блоки индекса до INDEX_BLOCK_BYTES байт, блок сжатого файла состоит из целых блоков сжатия
+INDEX_BLOCK_BYTES = 64 * 1024
+
+# Изменения индекса записываются одной транзакцией при фиксации окна и при накоплении INDEX_FLUSH_BLOCKS блоков
+INDEX_FLUSH_BLOCKS = 1000
+INDEX_FILE_SUFFIX = ".index.db"
+
+# Доставка записей во внешние системы (SIEM) по адресам из переменной окружения AUDIT_SINK_URLS:
+# syslog:// и syslog+tls:// (TCP), http(s):// (Elasticsearch _bulk, Splunk HEC или NDJSON), kafka+http(s):// (Kafka REST Proxy)
+# Записи отправляются пакетами до SINK_BATCH_RECORDS записей или SINK_BATCH_BYTES байт
+SINK_BATCH_RECORDS = 1000
+SINK_BATCH_BYTES = 1024 * 1024
+
+# Очередь пакетов в памяти для одного получателя; при заполнении чтение останавливается, записи ждут в файлах дней
+SINK_QUEUE_BATCHES = 8
+
+# Неподтверждённый получателем объём, после которого фиксация окон ждёт получателя (0 - ждать подтверждения каждой фиксации)
+SINK_MAX_BACKLOG_MB = 256
+
+# Отправлять новому получателю (без файла состояния) уже сохранённые записи, иначе доставляются только новые
+SINK_SEND_HISTORY = False
+
+# Время ожидания отправки очереди при завершении работы
+SINK_CLOSE_TIMEOUT_SEC = 30
+SINK_STATE_SUFFIX = ".sink.state"
+
+# Команда compact: файлы дней сортируются по времени события и очищаются от повторяющихся строк параллельно в COMPACT_WORKERS процессах (0 - по числу ядер).
+# Память одного процесса для сортировки в МБ; строки большего файла сортируются частями во временных файлах и затем сливаются
+COMPACT_WORKERS = 0
+COMPACT_MEMORY_MB = 256
+COMPACT_TEMP_SUFFIX = ".compact"
+
+# Команда verify: количество сохранённых записей считается по интервалам времени VERIFY_BUCKET_MINUTES минут (делитель суток)
+# и сверяется с API для подозрительных и случайно выбранных интервалов; результат хранится в файле <базовое_имя>.verify.state
+VERIFY_BUCKET_MINUTES = 60
+
+# Интервал подозрителен, если записей в нём меньше VERIFY_SUSPECT_RATIO от медианы VERIFY_NEIGHBOUR_BUCKETS соседних интервалов с каждой стороны
+VERIFY_SUSPECT_RATIO = 0.5
+VERIFY_NEIGHBOUR_BUCKETS = 3
+
+# Доля остальных ещё не проверенных интервалов, случайно выбираемых для сверки, и наибольшее количество интервалов, запрашиваемых у API за запуск
+VERIFY_SAMPLE_RATE = 0.02
+VERIFY_MAX_BUCKETS = 100
+VERIFY_STATE_SUFFIX = ".verify.state"
+
+# Файл блокировки <базовое_имя>.lock в каталоге логов: его держит процесс, записывающий файлы дней (загрузка или compact)
+LOCK_FILE_SUFFIX = ".lock"
+
+# Использовать асинхронный планировщик: источники загружаются одновременно, окна - параллельно с адаптивной (AIMD) конкурентностью
+USE_ASYNC_SCHEDULER = False
+
+# Границы и начальное значение количества одновременно загружаемых окон для одного источника в асинхронном планировщике
+AIMD_MIN_CONCURRENCY = 1
+AIMD_MAX_CONCURRENCY = 8
+AIMD_INITIAL_CONCURRENCY = 2
+
+# Во сколько раз уменьшается конкурентность при ответах 429 или росте задержек API
+AIMD_DECREASE_FACTOR = 0.5
+
+# Рост средней задержки запроса относительно минимальной наблюдаемой, который считается перегрузкой API
+AIMD_LATENCY_TOLERANCE = 2.0
+
+# Средняя задержка запроса в секундах, ниже которой ее рост не считается перегрузкой API
+AIMD_LATENCY_FLOOR_SEC = 1.0
+
 # Время в минутах для сбора логов старого формата и сброса полученных данных в файл (внутри сбора применяется еще OLD_LOG_MAX_PAGES)
 OLD_LOG_ONE_FETCH_CYCLE_IN_MINUTES = 180
 
@@ -52,195 +260,3892 @@ DISK_LOGS_MAX_RECORDS = 100
 # !!! Don't change values in LOGS_NAMES list !!!
 LOGS_SOURCES = ["mail", "all"]
 
+# Загрузка логов нескольких организаций одним процессом: путь к JSON файлу со списком организаций задается
+# переменной окружения ORGANIZATIONS_CONFIG_FILE. Общее для всех организаций ограничение количества одновременных запросов к API
+ORG_MAX_CONCURRENT_REQUESTS = 8
+
+# Интервал вывода метрик организаций в секундах
+ORG_METRICS_INTERVAL_SEC = 300
+
+# Метрики в формате Prometheus: HTTP endpoint http://METRICS_ADDRESS:METRICS_PORT/metrics (0 - не запускается)
+METRICS_PORT = 0
+METRICS_ADDRESS = "127.0.0.1"
+
+# Файл метрик для textfile collector node_exporter ("" - не записывается), обновляется раз в METRICS_TEXTFILE_INTERVAL_SEC секунд
+METRICS_TEXTFILE = ""
+METRICS_TEXTFILE_INTERVAL_SEC = 15
+
+# Границы корзин гистограмм длительности в секундах
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Вывод состояния загрузки в stdout: auto - строка прогресса на терминале и строки JSON без терминала (systemd, файл),
+# bar - только строка прогресса, json - только строки JSON, none - не выводится
+STATUS_OUTPUT = "auto"
+# Строка прогресса обновляется не чаще раза в STATUS_BAR_INTERVAL_SEC секунд, строки JSON выводятся раз в STATUS_JSON_INTERVAL_SEC секунд
+STATUS_BAR_INTERVAL_SEC = 0.5
+STATUS_JSON_INTERVAL_SEC = 60
+
 
 EXIT_CODE = 1
 
+# Организация, для которой выполняется текущий код, и приоритет запросов к API (режим нескольких организаций)
+_organization = contextvars.ContextVar("organization", default="")
+_PRIORITY_TAIL = 0
+_PRIORITY_BACKFILL = 1
+_request_priority = contextvars.ContextVar("request_priority", default=_PRIORITY_TAIL)
+
+
+class _OrganizationLogFilter(logging.Filter):
+    def filter(self, record):
+        organization = _organization.get()
+        record.organization = f"[{organization}] " if organization else ""
+        return True
+
+
 logger = logging.getLogger("get_audit_log")
 logger.setLevel(logging.DEBUG)
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s:\t%(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+console_handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s:\t%(organization)s%(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+console_handler.addFilter(_OrganizationLogFilter())
+
+
+class _LazyRotatingFileHandler(logging.Handler):
+    """Rotating log file: logging.handlers (it imports socket and pickle) is loaded and the file is opened on the first record."""
+
+    def __init__(self, file_path: str, **kwargs):
+        super().__init__()
+        self.baseFilename = os.path.abspath(file_path)
+        self._kwargs = kwargs
+        self._handler = None
+
+    def emit(self, record):
+        if self._handler is None:
+            from logging import handlers
+            self._handler = handlers.RotatingFileHandler(self.baseFilename, delay=True, **self._kwargs)
+            self._handler.setFormatter(self.formatter)
+        self._handler.emit(record)
+
+    def flush(self):
+        if self._handler is not None:
+            self._handler.flush()
+
+    def close(self):
+        # Следующая запись снова откроет файл по baseFilename
+        if self._handler is not None:
+            self._handler.close()
+            self._handler = None
+
+
 #file_handler = handlers.TimedRotatingFileHandler(LOG_FILE, when='D', interval=1, backupCount=30, encoding='utf-8')
-file_handler = handlers.RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024,  backupCount=10, encoding='utf-8')
+# Файл лога открывается при первой записи, а не при импорте модуля
+file_handler = _LazyRotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024,  backupCount=10, encoding='utf-8')
 file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s:\t%(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+file_handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s:\t%(organization)s%(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+file_handler.addFilter(_OrganizationLogFilter())
 logger.addHandler(console_handler)
 logger.addHandler(file_handler)
 
+def set_log_file(file_path: str):
+    # Перенос файла лога (например, во временный каталог нагрузочного теста); файл открывается при следующей записи
+    global LOG_FILE
+    LOG_FILE = file_path
+    file_handler.close()
+    file_handler.baseFilename = os.path.abspath(file_path)
+
+# Разбор JSON выполняется самой быстрой доступной библиотекой (orjson, msgspec или стандартный json).
+# Строки для файлов всегда формируются стандартным json.dumps, чтобы формат записей и их идентификаторы не зависели от установленных библиотек
+JSON_BACKEND = None
+
+def _import_json_backend():
+    # Библиотека разбора JSON выбирается при первом разборе, а не при импорте модуля; дальше _json_loads - сама функция библиотеки
+    global _json_loads, JSON_BACKEND
+    if JSON_BACKEND is None:
+        try:
+            import orjson
+            _json_loads, JSON_BACKEND = orjson.loads, "orjson"
+        except ImportError:
+            try:
+                import msgspec
+                _json_loads, JSON_BACKEND = msgspec.json.Decoder().decode, "msgspec"
+            except ImportError:
+                _json_loads, JSON_BACKEND = json.loads, "json"
+    return JSON_BACKEND
+
+def _json_loads(data):
+    _import_json_backend()
+    return _json_loads(data)
+
+def _import_zstandard():
+    # zstandard загружается только для сжатых файлов .zst
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+def _import_requests():
+    # requests загружается перед первым HTTP запросом: его импорт занимает большую часть времени запуска скрипта
+    global requests
+    if requests is None:
+        import requests as module
+        requests = module
+    return requests
+
+requests = None
+
+def _import_pyarrow():
+    # pyarrow загружается только при включённой выгрузке в Parquet: его импорт заметно увеличивает время запуска
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+class AuditRecord:
+    """Audit log record parsed once: source data, event time and the JSON line written to files.
+
+    The line is serialized lazily on first access and then reused for deduplication and writing.
+    """
+
+    __slots__ = ("data", "event_time", "_line")
+
+    def __init__(self, data: dict, event_time: str, line: str = None):
+        self.data = data
+        self.event_time = event_time
+        self._line = line
+
+    @classmethod
+    def from_mail(cls, data: dict):
+        return cls(data, data["date"])
+
+    @classmethod
+    def from_new(cls, data: dict):
+        return cls(data, data["event"]["occurred_at"])
+
+    @property
+    def line(self):
+        if self._line is None:
+            self._line = json.dumps(self.data, ensure_ascii=False)
+        return self._line
+
+
+def _event_time_prefix(event_time: str):
+    # Дата и время события в виде YYYY-MM-DDTHH:MM:SS[.дробная часть] без часового пояса
+    end = 19
+    if len(event_time) > end and event_time[end] == ".":
+        end += 1
+        while end < len(event_time) and event_time[end].isdigit():
+            end += 1
+    return event_time[:end]
+
+def _event_sort_key(event_time: str):
+    # Время события с дробной частью из 6 цифр, которое сравнивается как текст
+    prefix = _event_time_prefix(event_time)
+    return prefix[0:19] + "." + prefix[20:26].ljust(6, "0")
+
+
+# Короткие имена полей в правилах фильтрации -> путь к полю записи источника (вложенные поля - через точку)
+_FILTER_FIELDS = {
+    "mail": {"event_type": "eventType", "mailbox": "userLogin", "actor": "userLogin", "service": "source", "ip": "clientIp"},
+    "all": {"event_type": "event.type", "service": "event.service", "actor": "user_login", "ip": "event.ip", "status": "event.status"},
+}
+
+# Время события нужно для раскладки записей по файлам дней, проекция его не удаляет
+_FILTER_TIME_FIELDS = {"mail": "date", "all": "event.occurred_at"}
+
+
+def _filter_field_keys(log_source: str, field: str):
+    return _FILTER_FIELDS[log_source].get(field, field).split(".")
+
+def _field_getter(keys: list):
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda data: data.get(key)
+
+    def get(data):
+        for key in keys:
+            if not isinstance(data, dict):
+                return None
+            data = data.get(key)
+        return data
+    return get
+
+def _field_predicate(getter, values: list = None, pattern: str = None):
+    # Значения сравниваются без учета регистра, поле-список совпадает, если совпадает любой его элемент
+    if pattern is not None:
+        regex = re.compile(pattern, re.IGNORECASE)
+        match = lambda value: regex.fullmatch(str(value)) is not None
+    else:
+        expected = frozenset(str(value).casefold() for value in values)
+        match = lambda value: str(value).casefold() in expected
+
+    def test(data):
+        value = getter(data)
+        if value is None:
+            return False
+        if isinstance(value, list):
+            return any(match(item) for item in value)
+        return match(value)
+    return test
+
+def _project_fields(data: dict, tree: dict):
+    # Новый словарь только с полями дерева {ключ: поддерево или None - поле целиком}, порядок полей записи сохраняется
+    result = {}
+    for key, value in data.items():
+        if key not in tree:
+            continue
+        if tree[key] is None:
+            result[key] = value
+        elif isinstance(value, dict):
+            result[key] = _project_fields(value, tree[key])
+    return result
+
+def _remove_field(data: dict, keys: list, redact: bool):
+    parent = data
+    for key in keys[:-1]:
+        parent = parent.get(key)
+        if not isinstance(parent, dict):
+            return data
+    if keys[-1] in parent:
+        if redact:
+            parent[keys[-1]] = FILTER_REDACTED_VALUE
+        else:
+            del parent[keys[-1]]
+    return data
+
+
+class EventFilter:
+    """Filter and projection rules of one log source, compiled once into predicates and field operations.
+
+    A record is dropped if there are include rules and none of them matches, or if an exclude rule matches;
+    dropped records are counted by rule name ("not_included" - by include rules). Fields of kept records are
+    projected, dropped and redacted before the records are deduplicated, serialized and written.
+    """
+
+    def __init__(self, log_source: str, rules: list):
+        # rules - список (имя правила, правило)
+        self.log_source = log_source
+        self.includes = []
+        self.excludes = []
+        self.operations = []
+        self.dropped = {}
+        self._lock = threading.Lock()
+        for name, rule in rules:
+            self._compile(name, rule)
+
+    def _compile(self, name: str, rule: dict):
+        action = rule.get("action", "exclude")
+        if action in ("include", "exclude"):
+            match, patterns = rule.get("match") or {}, rule.get("patterns") or {}
+            if not isinstance(match, dict) or not isinstance(patterns, dict) or not (match or patterns):
+                raise ValueError(f"rule {name} must have match and/or patterns objects {{field: values or regular expression}}")
+            conditions = [_field_predicate(_field_getter(_filter_field_keys(self.log_source, field)), values=values if isinstance(values, list) else [values])
+                          for field, values in match.items()]
+            conditions += [_field_predicate(_field_getter(_filter_field_keys(self.log_source, field)), pattern=pattern) for field, pattern in patterns.items()]
+            # Условия одного правила должны выполняться все
+            test = conditions[0] if len(conditions) == 1 else lambda data: all(condition(data) for condition in conditions)
+            (self.includes if action == "include" else self.excludes).append((name, test))
+            return
+        if action not in ("project", "drop_fields", "redact"):
+            raise ValueError(f"rule {name} has unknown action {action} (include, exclude, project, drop_fields or redact)")
+        fields = rule.get("fields")
+        if not isinstance(fields, list) or not fields:
+            raise ValueError(f"rule {name} must have a non-empty fields list")
+        time_keys = _FILTER_TIME_FIELDS[self.log_source].split(".")
+        paths = [_filter_field_keys(self.log_source, field) for field in fields]
+        if action == "project":
+            tree = {}
+            for keys in paths + [time_keys]:
+                node = tree
+                for key in keys[:-1]:
+                    if key in node and node[key] is None:
+                        break
+                    node = node.setdefault(key, {})
+                else:
+                    node[keys[-1]] = None
+            self.operations.append(functools.partial(_project_fields, tree=tree))
+            return
+        for keys in paths:
+            if time_keys[:len(keys)] == keys:
+                raise ValueError(f"rule {name} can not remove the event time field {'.'.join(time_keys)}")
+            self.operations.append(functools.partial(_remove_field, keys=keys, redact=action == "redact"))
+
+    def apply(self, records: list, count: bool = True):
+        """Records kept by the rules, with projected fields. count - add dropped records to the counters of rules."""
+        kept = []
+        dropped = {}
+        for r in records:
+            data = r.data
+            name = None
+            if self.includes and not any(test(data) for _, test in self.includes):
+                name = "not_included"
+            else:
+                for rule_name, test in self.excludes:
+                    if test(data):
+                        name = rule_name
+                        break
+            if name is not None:
+                dropped[name] = dropped.get(name, 0) + 1
+                continue
+            if self.operations:
+                for operation in self.operations:
+                    data = operation(data)
+                r = AuditRecord(data, r.event_time)
+            kept.append(r)
+        if dropped and count:
+            with self._lock:
+                for name, dropped_count in dropped.items():
+                    self.dropped[name] = self.dropped.get(name, 0) + dropped_count
+            for name, dropped_count in dropped.items():
+                metrics.inc("audit_records_filtered_total", _metric_labels(self.log_source, rule=name), dropped_count)
+        return kept
+
+    def summary(self):
+        with self._lock:
+            return ", ".join(f"{name} - {count}" for name, count in sorted(self.dropped.items()))
+
+
+def load_event_filters(file_path: str = None):
+    """Compile FILTERED_MAIL_EVENTS, FILTERED_MAILBOXES and the rules of the JSON file into {log source: EventFilter}.
+
+    The file contains a list of rules (or an object with the "rules" list); a rule without "source" applies to
+    both sources. Sources without rules are not in the result. Raises OSError or ValueError if the rules are wrong.
+    """
+    rules = []
+    if FILTERED_MAIL_EVENTS:
+        rules.append({"name": "FILTERED_MAIL_EVENTS", "source": "mail", "action": "exclude", "match": {"event_type": list(FILTERED_MAIL_EVENTS)}})
+    if FILTERED_MAILBOXES:
+        rules.append({"name": "FILTERED_MAILBOXES", "source": "mail", "action": "exclude", "match": {"mailbox": list(FILTERED_MAILBOXES)}})
+    if file_path:
+        with open(file_path, "r", encoding="utf8") as f:
+            loaded = json.load(f)
+        if isinstance(loaded, dict):
+            loaded = loaded.get("rules")
+        if not isinstance(loaded, list) or not all(isinstance(rule, dict) for rule in loaded):
+            raise ValueError("the file must contain a list of rule objects")
+        rules.extend(loaded)
+    named = []
+    for number, rule in enumerate(rules, start=1):
+        if rule.get("source") not in (None, "mail", "all"):
+            raise ValueError(f"rule #{number} has unknown source {rule.get('source')} (mail or all)")
+        named.append((str(rule.get("name") or f"rule{number}"), rule))
+    filters = {}
+    for log_source in ("mail", "all"):
+        source_rules = [(name, rule) for name, rule in named if rule.get("source") in (None, log_source)]
+        if source_rules:
+            filters[log_source] = EventFilter(log_source, source_rules)
+    return filters
+
+
+@functools.lru_cache(maxsize=None)
+def _counting_http_adapter_class():
+    """HTTPAdapter that counts newly opened connections (TCP/TLS handshakes) of its pools, created with the first session."""
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class CountingHTTPAdapter(HTTPAdapter):
+        def __init__(self, stats: "ApiSessionStats", **kwargs):
+            self._stats = stats
+            super().__init__(**kwargs)
+
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            stats = self._stats
+
+            class CountingHTTPConnection(HTTPConnection):
+                def connect(self):
+                    stats.add(handshakes=1)
+                    super().connect()
+
+            class CountingHTTPSConnection(HTTPSConnection):
+                def connect(self):
+                    stats.add(handshakes=1)
+                    super().connect()
+
+            class CountingHTTPConnectionPool(HTTPConnectionPool):
+                ConnectionCls = CountingHTTPConnection
+
+            class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+                ConnectionCls = CountingHTTPSConnection
+
+            self.poolmanager.pool_classes_by_scheme = {"http": CountingHTTPConnectionPool, "https": CountingHTTPSConnectionPool}
+
+    return CountingHTTPAdapter
+
+
+@dataclass
+class ApiSessionStats:
+    requests: int = 0
+    handshakes: int = 0
+    retries: int = 0
+    throttled: int = 0
+    failed: int = 0
+    latency_ewma: float = 0.0
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def observe_latency(self, seconds: float):
+        with self._lock:
+            if self.latency_ewma == 0.0:
+                self.latency_ewma = seconds
+            else:
+                self.latency_ewma = self.latency_ewma * 0.8 + seconds * 0.2
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def reuse_rate(self):
+        if self.requests == 0:
+            return 0.0
+        return max(self.requests - self.handshakes, 0) / self.requests
+
+
+class ApiSessionPool:
+    """Shared keep-alive HTTP sessions, one per API base URL, with timeouts and retries.
+
+    Retries are done for connection errors and RETRY_STATUS_CODES with exponential backoff
+    and jitter, the Retry-After header of the response takes precedence over the backoff.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self.stats = {}
+        # Статистика запросов по организациям и общее ограничение одновременных запросов (режим нескольких организаций)
+        self.organization_stats = {}
+        self.budget = None
+
+    def session(self, base_url: str):
+        with self._lock:
+            session = self._sessions.get(base_url)
+            if session is None:
+                stats = self.stats.setdefault(base_url, ApiSessionStats())
+                session = _import_requests().Session()
+                adapter = _counting_http_adapter_class()(stats, pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+                session.mount(base_url, adapter)
+                session.headers.update({"Accept-Encoding": "gzip, deflate"})
+                self._sessions[base_url] = session
+            return session
+
+    def get(self, base_url: str, url: str, headers: dict = None, params: dict = None, source: str = ""):
+        """Execute GET request, returns response with status 200 or None if all attempts failed. source - log source for metrics."""
+        session = self.session(base_url)
+        stats = self.stats[base_url]
+        organization = _organization.get()
+        labels = _metric_labels(source)
+        with self._lock:
+            organization_stats = self.organization_stats.setdefault(organization, ApiSessionStats()) if organization else None
+
+        def count(**counters):
+            stats.add(**counters)
+            if organization_stats is not None:
+                organization_stats.add(**counters)
+
+        for attempt in range(MAX_RETRIES + 1):
+            retry_after = None
+            count(requests=1)
+            metrics.inc("audit_api_requests_total", labels)
+            if self.budget is not None:
+                self.budget.acquire(organization, _request_priority.get())
+            started = time.monotonic()
+            try:
+                response = session.get(url, headers=headers, params=params, timeout=(HTTP_CONNECT_TIMEOUT_SEC, HTTP_READ_TIMEOUT_SEC))
+                stats.observe_latency(time.monotonic() - started)
+            except requests.RequestException as e:
+                metrics.observe("audit_http_request_seconds", labels, time.monotonic() - started)
+                metrics.inc("audit_api_responses_total", {**labels, "code": "error"})
+                logger.error(f"Error during GET request: {type(e).__name__}: {e}")
+                logger.debug(f"Error during GET request. url - {url}. Params - {params}")
+            else:
+                metrics.observe("audit_http_request_seconds", labels, time.monotonic() - started)
+                metrics.inc("audit_api_responses_total", {**labels, "code": str(response.status_code)})
+                if response.status_code == HTTPStatus.OK.value:
+                    return response
+                logger.error(f"Error during GET request: {response.status_code}. Error message: {response.text}")
+                logger.debug(f"Error during GET request. url - {url}. Params - {params}")
+                logger.debug(f'X-Request-Id: {response.headers.get("X-Request-Id","")}')
+                if response.status_code == HTTPStatus.TOO_MANY_REQUESTS.value:
+                    count(throttled=1)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    break
+                retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+            finally:
+                if self.budget is not None:
+                    self.budget.release(organization)
+
+            if attempt == MAX_RETRIES:
+                break
+            delay = retry_after if retry_after is not None else _backoff_delay(attempt)
+            logger.error(f"Retrying ({attempt+1}/{MAX_RETRIES}) in {delay:.1f} sec.")
+            count(retries=1)
+            metrics.inc("audit_api_retries_total", labels)
+            time.sleep(delay)
+
+        count(failed=1)
+        metrics.inc("audit_api_failures_total", labels)
+        return None
+
+    def report(self):
+        for base_url, stats in self.stats.items():
+            logger.info(f"HTTP pool {base_url}: requests - {stats.requests}, handshakes - {stats.handshakes}, "
+                        f"connection reuse - {stats.reuse_rate * 100:.1f}%, retries - {stats.retries}, "
+                        f"throttled (429) - {stats.throttled}, failed - {stats.failed}")
+
+
+class FairRequestBudget:
+    """Limit of simultaneous API requests shared by all organizations of the process.
+
+    A free slot goes to near-real-time (tail) requests before backfill ones, and among them
+    to the organization with the fewest requests in flight, so a long backfill of one
+    organization can not starve the others.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.in_flight = 0
+        self.wait_seconds = {}
+        self._by_organization = {}
+        self._waiters = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, organization: str, priority: int):
+        with self._lock:
+            if self.in_flight < self.limit and not self._waiters:
+                self._grant(organization)
+                return
+            self._sequence += 1
+            waiter = (priority, self._sequence, organization, threading.Event())
+            self._waiters.append(waiter)
+        started = time.monotonic()
+        waiter[3].wait()
+        with self._lock:
+            self.wait_seconds[organization] = self.wait_seconds.get(organization, 0.0) + time.monotonic() - started
+
+    def release(self, organization: str):
+        with self._lock:
+            self.in_flight -= 1
+            self._by_organization[organization] -= 1
+            while self.in_flight < self.limit and self._waiters:
+                waiter = min(self._waiters, key=lambda w: (w[0], self._by_organization.get(w[2], 0), w[1]))
+                self._waiters.remove(waiter)
+                self._grant(waiter[2])
+                waiter[3].set()
+
+    def _grant(self, organization: str):
+        self.in_flight += 1
+        self._by_organization[organization] = self._by_organization.get(organization, 0) + 1
+
+
+def _set_request_priority(backfill: bool):
+    _request_priority.set(_PRIORITY_BACKFILL if backfill else _PRIORITY_TAIL)
+
+
+def _backoff_delay(attempt: int):
+    # Экспоненциальная задержка с разбросом: половина задержки гарантирована, вторая половина случайна
+    delay = min(RETRIES_MAX_DELAY_SEC, RETRIES_DELAY_SEC * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return min(max(float(value), 0.0), RETRIES_MAX_DELAY_SEC)
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return min(max(retry_at.timestamp() - time.time(), 0.0), RETRIES_MAX_DELAY_SEC)
+    except (TypeError, ValueError):
+        return None
+
+
+# Описание метрик: имя -> (тип, справка)
+_METRICS = {
+    "audit_api_requests_total": ("counter", "API requests including retries."),
+    "audit_api_responses_total": ("counter", "API responses by HTTP status code (error - no response)."),
+    "audit_api_retries_total": ("counter", "Retried API requests."),
+    "audit_api_failures_total": ("counter", "API requests failed after all retries."),
+    "audit_pages_total": ("counter", "Received pages of audit log records."),
+    "audit_records_fetched_total": ("counter", "Audit log records received from API."),
+    "audit_records_written_total": ("counter", "Audit log records written to day files."),
+    "audit_duplicates_dropped_total": ("counter", "Already saved audit log records dropped before writing."),
+    "audit_late_records_total": ("counter", "Audit log records older than the end of their day file, written to late runs."),
+    "audit_late_merge_seconds": ("histogram", "Duration of merging late runs into a day file."),
+    "audit_records_filtered_total": ("counter", "Audit log records dropped by filter rules before writing, by rule."),
+    "audit_http_request_seconds": ("histogram", "Duration of API requests."),
+    "audit_parse_seconds": ("histogram", "Duration of parsing API responses into records."),
+    "audit_dedup_seconds": ("histogram", "Duration of deduplication of a batch of records."),
+    "audit_write_seconds": ("histogram", "Duration of writing a batch of records to a day file."),
+    "audit_commit_seconds": ("histogram", "Duration of flushing day files before the watermark is moved."),
+    "audit_follower_seconds": ("histogram", "Duration of reading committed lines by Parquet export, query index or delivery sinks."),
+    "audit_sink_records_total": ("counter", "Audit log records confirmed by delivery sinks."),
+    "audit_sink_rejected_total": ("counter", "Audit log records permanently rejected by delivery sinks."),
+    "audit_sink_batches_total": ("counter", "Batches sent to delivery sinks by result."),
+    "audit_sink_send_seconds": ("histogram", "Duration of sending a batch to a delivery sink."),
+    "audit_sink_backlog_bytes": ("gauge", "Approximate size of committed records not yet confirmed by a delivery sink."),
+    "audit_sink_lag_seconds": ("gauge", "Time between now and the date of the last record confirmed by a delivery sink."),
+    "audit_watermark_lag_seconds": ("gauge", "Time between now and the last committed record date."),
+    "audit_window_backlog": ("gauge", "Fetch windows left to reach now, including windows in flight."),
+}
+
+
+class MetricsRegistry:
+    """Counters, gauges and latency histograms of the process, rendered in Prometheus text format.
+
+    Samples are identified by metric name and labels (dict). A gauge can be set to a function which
+    is called when metrics are rendered; None returned by the function skips the sample.
+    """
+
+    def __init__(self, buckets: tuple = METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def inc(self, name: str, labels: dict, value: float = 1):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._samples.setdefault(name, {})
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name: str, labels: dict, value):
+        # value - число или функция без аргументов
+        with self._lock:
+            self._samples.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, labels: dict, seconds: float):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            samples = self._samples.setdefault(name, {})
+            histogram = samples.get(key)
+            if histogram is None:
+                histogram = samples[key] = [[0] * len(self.buckets), 0.0, 0]
+            for number, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][number] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def render(self):
+        with self._lock:
+            samples = {name: dict(items) for name, items in self._samples.items()}
+        lines = []
+        for name in sorted(samples):
+            kind, description = _METRICS.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(samples[name].items()):
+                labels = dict(key)
+                if kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, value[0]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labels, le=repr(float(bound)))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, le='+Inf')} {value[2]}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {value[1]}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {value[2]}")
+                    continue
+                if callable(value):
+                    try:
+                        value = value()
+                    except Exception as e:
+                        logger.debug(f"Can not compute metric {name}: {type(e).__name__}: {e}")
+                        value = None
+                    if value is None:
+                        continue
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: dict, **extra):
+    items = {**labels, **extra}
+    if not items:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in items.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(items, escaped)) + "}"
+
+
+def _metric_labels(log_source: str, **labels):
+    # Организация указывается только в режиме нескольких организаций, как и в журнале
+    organization = _organization.get()
+    if organization:
+        labels["organization"] = organization
+    labels["source"] = log_source
+    return labels
+
+
+def start_metrics_exporters():
+    """Start the HTTP endpoint (METRICS_PORT) and the textfile writer (METRICS_TEXTFILE) in daemon threads."""
+    if METRICS_PORT:
+        # http.server импортируется только при включённом endpoint, чтобы не увеличивать время запуска
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(HTTPStatus.NOT_FOUND.value)
+                    return
+                body = metrics.render().encode("utf8")
+                self.send_response(HTTPStatus.OK.value)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((METRICS_ADDRESS, METRICS_PORT), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics_http", daemon=True).start()
+        logger.info(f"Metrics are available at http://{METRICS_ADDRESS}:{server.server_address[1]}/metrics")
+    if METRICS_TEXTFILE:
+        threading.Thread(target=_write_metrics_textfile, name="metrics_textfile", daemon=True).start()
+        logger.info(f"Metrics are written to {METRICS_TEXTFILE} every {METRICS_TEXTFILE_INTERVAL_SEC} sec.")
+
+def _write_metrics_textfile():
+    while True:
+        try:
+            # Файл заменяется атомарно, поэтому сборщик не прочитает его наполовину записанным
+            _atomic_write(METRICS_TEXTFILE, metrics.render().encode("utf8"))
+        except OSError as e:
+            logger.error(f"Can not write metrics file {METRICS_TEXTFILE}: {type(e).__name__}: {e}")
+        time.sleep(METRICS_TEXTFILE_INTERVAL_SEC)
+
+def register_progress_metrics(settings: "SettingParams", runtime_data: "RuntimeData"):
+    """Gauges of watermark lag and window backlog of every log source, computed when metrics are rendered."""
+
+    def watermark_lag(log_source: str):
+        oldest_datetime = runtime_data.oldest_datetime[log_source]
+        if not oldest_datetime:
+            return None
+        date_now = datetime.now() - timedelta(hours=settings.timezone_shift)
+        return round((date_now - _parse_utc_datetime(oldest_datetime)).total_seconds(), 3)
+
+    def window_backlog(log_source: str):
+        lag = watermark_lag(log_source)
+        if lag is None:
+            return None
+        in_flight = len(runtime_data.checkpoints[log_source].in_flight) if runtime_data.checkpoints else 0
+        return math.ceil(max(lag, 0) / (runtime_data.get_window_sizer(log_source).minutes * 60)) + in_flight
+
+    for log_source in LOGS_SOURCES:
+        metrics.set("audit_watermark_lag_seconds", _metric_labels(log_source), functools.partial(watermark_lag, log_source))
+        metrics.set("audit_window_backlog", _metric_labels(log_source), functools.partial(window_backlog, log_source))
+
+
+class StatusBoard:
+    """Download progress of every organization and log source, rendered to stdout by a reporter thread.
+
+    Fetch code only updates its entry (begin, advance, finish); the reporter thread draws a progress line on
+    a terminal at most every STATUS_BAR_INTERVAL_SEC seconds, or writes JSON status lines every
+    STATUS_JSON_INTERVAL_SEC seconds otherwise, with throughput and ETA per source.
+    Downloads never wait for terminal output.
+    """
+
+    def __init__(self, stream=None):
+        # stream - None для sys.stdout на момент вывода
+        self.stream = stream
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def begin(self, log_source: str, started_at: datetime, ended_at: datetime):
+        """Start a download of log_source from started_at to ended_at (UTC) for the current organization."""
+        if STATUS_OUTPUT == "none":
+            return
+        entry = {"organization": _organization.get(), "source": log_source, "started_at": started_at, "ended_at": ended_at,
+                 "position": started_at, "records": 0, "begun": time.monotonic(), "state": "running", "reported": False}
+        with self._lock:
+            self._entries[(entry["organization"], log_source)] = entry
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._report_loop, name="status_reporter", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def advance(self, log_source: str, position: datetime, records: int = 0):
+        """Move the download position of log_source and count downloaded records."""
+        entry = self._entries.get((_organization.get(), log_source))
+        if entry is None:
+            return
+        with self._lock:
+            entry["position"] = position
+            entry["records"] += records
+
+    def finish(self, log_source: str, completed: bool = True):
+        entry = self._entries.get((_organization.get(), log_source))
+        if entry is None:
+            return
+        with self._lock:
+            if completed:
+                entry["position"] = entry["ended_at"]
+            entry["state"] = "done" if completed else "stopped"
+        self._wake.set()
+
+    def _mode(self):
+        if STATUS_OUTPUT != "auto":
+            return STATUS_OUTPUT
+        try:
+            return "bar" if (self.stream or sys.stdout).isatty() else "json"
+        except (AttributeError, ValueError):
+            return "json"
+
+    def _report_loop(self):
+        mode = self._mode()
+        interval = STATUS_BAR_INTERVAL_SEC if mode == "bar" else STATUS_JSON_INTERVAL_SEC
+        last_render = 0.0
+        bar_width = 0
+        while True:
+            woken = self._wake.wait(interval)
+            if mode == "bar":
+                # События начала и окончания загрузки не ускоряют перерисовку строки прогресса
+                time.sleep(max(0.0, last_render + interval - time.monotonic()))
+            self._wake.clear()
+            now = time.monotonic()
+            with self._lock:
+                entries = [dict(entry) for entry in self._entries.values()]
+                for key, entry in list(self._entries.items()):
+                    entry["reported"] = True
+                    if entry["state"] != "running":
+                        del self._entries[key]
+            try:
+                if mode == "bar":
+                    bar_width = self._render_bar(entries, now, bar_width)
+                else:
+                    # По событиям выводятся только новые и закончившиеся загрузки, остальные - раз в интервал
+                    self._render_json([entry for entry in entries if not woken or entry["state"] != "running" or not entry["reported"]], now)
+            except Exception as e:
+                logger.debug(f"Can not write download status: {type(e).__name__}: {e}")
+            last_render = now
+
+    @staticmethod
+    def _progress(entry: dict, now: float):
+        """Returns (progress from 0 to 1, records per second, ETA in seconds or None)."""
+        total = (entry["ended_at"] - entry["started_at"]).total_seconds()
+        if total <= 0:
+            progress = 1.0
+        else:
+            progress = min(max((entry["position"] - entry["started_at"]).total_seconds() / total, 0.0), 1.0)
+        elapsed = now - entry["begun"]
+        rate = entry["records"] / elapsed if elapsed > 0 else 0.0
+        if progress >= 1.0:
+            eta = 0.0
+        elif progress > 0:
+            eta = elapsed * (1.0 - progress) / progress
+        else:
+            eta = None
+        return progress, rate, eta
+
+    def _render_bar(self, entries: list, now: float, bar_width: int):
+        if not entries:
+            return bar_width
+        # Несколько загрузок (источники, организации) выводятся в одной строке с короткими шкалами
+        bar_length = 40 if len(entries) == 1 else 10
+        parts = []
+        for entry in entries:
+            progress, rate, eta = self._progress(entry, now)
+            filled = int(bar_length * progress)
+            label = f"{entry['organization']} {entry['source']}" if entry["organization"] else entry["source"]
+            parts.append(f"{label} [{'█' * filled}{'░' * (bar_length - filled)}] {progress * 100:5.1f}% | "
+                         f"{entry['position'].strftime('%Y-%m-%d %H:%M')} / {entry['ended_at'].strftime('%Y-%m-%d %H:%M')} | "
+                         f"{rate:.0f} rec/s | ETA {_format_duration(eta)}")
+        line = "  ".join(parts)
+        stream = self.stream or sys.stdout
+        # Пробелы стирают остаток более длинной предыдущей строки
+        stream.write(f"\r{line}{' ' * max(bar_width - len(line), 0)}")
+        if all(entry["state"] != "running" for entry in entries):
+            stream.write("\n")
+            line = ""
+        stream.flush()
+        return len(line)
+
+    def _render_json(self, entries: list, now: float):
+        if not entries:
+            return
+        fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+        time_now = datetime.now(timezone.utc).strftime(fmt)
+        lines = []
+        for entry in entries:
+            progress, rate, eta = self._progress(entry, now)
+            status = {"time": time_now, "source": entry["source"], "state": entry["state"], "progress": round(progress * 100, 1),
+                      "position": entry["position"].strftime(fmt), "ended_at": entry["ended_at"].strftime(fmt), "records": entry["records"],
+                      "records_per_sec": round(rate, 1), "eta_sec": None if eta is None else round(eta)}
+            if entry["organization"]:
+                status["organization"] = entry["organization"]
+            lines.append(json.dumps(status) + "\n")
+        stream = self.stream or sys.stdout
+        stream.write("".join(lines))
+        stream.flush()
+
+
+def _format_duration(seconds: float):
+    if seconds is None:
+        return "--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+api_sessions = ApiSessionPool()
+metrics = MetricsRegistry()
+status_board = StatusBoard()
+
 def main():
 
     logger.info("--------------------------------------------------------")
     logger.info("Starting script...")
 
-    settings = get_settings()
-    runtime_data = RuntimeData(last_records={"mail": [], "all": []}, oldest_datetime={"mail": None, "all": None})
+    settings_list = get_organizations_settings()
 
-    if settings is None:
+    if settings_list is None:
         logger.error("Settings are not set.")
         sys.exit(EXIT_CODE)
 
+    if not _check_output_settings():
+        sys.exit(EXIT_CODE)
+
     logger.info("Constants in this run:")
     logger.info(f"MAIL_LOGS_MAX_RECORDS: {MAIL_LOGS_MAX_RECORDS}")
     logger.info(f"ALL_LOGS_MAX_RECORDS: {ALL_LOGS_MAX_RECORDS}")
     logger.info(f"NEW_LOG_ONE_FETCH_CYCLE_IN_MINUTES: {NEW_LOG_ONE_FETCH_CYCLE_IN_MINUTES}")
     logger.info(f"OLD_LOG_ONE_FETCH_CYCLE_IN_MINUTES: {OLD_LOG_ONE_FETCH_CYCLE_IN_MINUTES}")
+    logger.info(f"ADAPTIVE_WINDOWS: {ADAPTIVE_WINDOWS}")
+    logger.info(f"WINDOW_TARGET_PAGES: {WINDOW_TARGET_PAGES}")
+    logger.info(f"BACKFILL_MAX_WORKERS: {BACKFILL_MAX_WORKERS}")
+    logger.info(f"BACKFILL_MIN_WINDOWS: {BACKFILL_MIN_WINDOWS}")
+    logger.info(f"USE_ASYNC_SCHEDULER: {USE_ASYNC_SCHEDULER}")
     logger.info(f"SLEEP_MINITS_AFTER_LAST_FETCH: {SLEEP_MINITS_AFTER_LAST_FETCH}")
+    logger.info(f"USE_TAIL_MODE: {USE_TAIL_MODE}")
+    logger.info(f"TAIL_MIN_POLL_SEC: {TAIL_MIN_POLL_SEC}")
+    logger.info(f"TAIL_LOOKBACK_SECONDS: {TAIL_LOOKBACK_SECONDS}")
+    logger.info(f"TAIL_API_DELAY_SECONDS: {TAIL_API_DELAY_SECONDS}")
     logger.info(f"OVERLAPPED_SECONDS: {OVERLAPPED_SECONDS}")
+    logger.info(f"DEDUP_WINDOW_SECONDS: {DEDUP_WINDOW_SECONDS}")
+    logger.info(f"USE_CHECKPOINTS: {USE_CHECKPOINTS}")
+    logger.info(f"WRITER_FSYNC_POLICY: {WRITER_FSYNC_POLICY}")
+    logger.info(f"OUTPUT_COMPRESSION: {OUTPUT_COMPRESSION}")
+    logger.info(f"LATE_EVENTS_MODE: {LATE_EVENTS_MODE}")
+    logger.info(f"PARQUET_EXPORT: {PARQUET_EXPORT}")
+    logger.info(f"USE_QUERY_INDEX: {USE_QUERY_INDEX}")
+    logger.info(f"METRICS_PORT: {METRICS_PORT}")
+    logger.info(f"METRICS_TEXTFILE: {METRICS_TEXTFILE}")
+    logger.info(f"STATUS_OUTPUT: {STATUS_OUTPUT}")
+    logger.info(f"SINK_MAX_BACKLOG_MB: {SINK_MAX_BACKLOG_MB}")
+    logger.info(f"SINK_SEND_HISTORY: {SINK_SEND_HISTORY}")
+    logger.info(f"PARQUET_PARTITIONING: {PARQUET_PARTITIONING}")
+    logger.info(f"MAX_RETRIES: {MAX_RETRIES}")
+    logger.info(f"HTTP_POOL_MAXSIZE: {HTTP_POOL_MAXSIZE}")
+    logger.info(f"JSON_BACKEND: {_import_json_backend()}")
+    logger.info(f"ORG_MAX_CONCURRENT_REQUESTS: {ORG_MAX_CONCURRENT_REQUESTS}")
     logger.info(f"FILTERED_MAIL_EVENTS: {FILTERED_MAIL_EVENTS}")
     logger.info(f"FILTERED_MAILBOXES: {FILTERED_MAILBOXES}")
 
     logger.info("--------------------------------------------------------")
 
-    download_sсheduler(settings, runtime_data)
-    
+    start_metrics_exporters()
+
+    if len(settings_list) == 1:
+        settings = settings_list[0]
+        runtime_data = create_runtime_data(settings)
+        try:
+            run_organization(settings, runtime_data)
+        finally:
+            runtime_data.close()
+    else:
+        run_organizations([(settings, create_runtime_data(settings)) for settings in settings_list])
+
+def _check_output_settings():
+    if OUTPUT_COMPRESSION != "none" and (OUTPUT_COMPRESSION not in _CODECS or (OUTPUT_COMPRESSION == "zstd" and _import_zstandard() is None)):
+        logger.error(f"OUTPUT_COMPRESSION {OUTPUT_COMPRESSION} is not supported. Use none, gzip or zstd (requires zstandard package).")
+        return False
+    if LATE_EVENTS_MODE not in ("append", "merge"):
+        logger.error(f"LATE_EVENTS_MODE {LATE_EVENTS_MODE} is not supported. Use append or merge.")
+        return False
+    if PARQUET_EXPORT and (_import_pyarrow() is None or PARQUET_PARTITIONING not in ("day", "hour")):
+        logger.error(f"PARQUET_EXPORT requires pyarrow package and PARQUET_PARTITIONING day or hour (now {PARQUET_PARTITIONING}).")
+        return False
+    return True
+
+def create_runtime_data(settings: "SettingParams"):
+    runtime_data = RuntimeData(last_records={"mail": DedupIndex(), "all": DedupIndex()}, oldest_datetime={"mail": None, "all": None}, writers=DayFileWriterPool())
+    # Файлы дней не должны одновременно изменяться другим процессом загрузки или командой compact
+    runtime_data.locks = []
+    for log_source in LOGS_SOURCES:
+        lock = LogFilesLock(settings, log_source)
+        if not lock.acquire():
+            for acquired in runtime_data.locks:
+                acquired.release()
+            raise RuntimeError(f"Log files {lock.path[:-len(LOCK_FILE_SUFFIX)]}_* are used by another process (lock file {lock.path}).")
+        runtime_data.locks.append(lock)
+    if USE_CHECKPOINTS:
+        runtime_data.checkpoints = {
+            log_source: CheckpointStore(os.path.join(settings.dir_paths[log_source], f"{settings.file_names[log_source]}{CHECKPOINT_FILE_SUFFIX}"))
+            for log_source in LOGS_SOURCES
+        }
+    # Выгрузка, индекс и получатели дочитывают файлы дней по мере фиксации окон
+    runtime_data.followers = {log_source: [] for log_source in LOGS_SOURCES}
+    if USE_QUERY_INDEX:
+        for log_source in LOGS_SOURCES:
+            runtime_data.followers[log_source].append(QueryIndex(settings, log_source))
+    if PARQUET_EXPORT and "all" in LOGS_SOURCES:
+        runtime_data.followers["all"].append(ParquetSink(settings))
+    # Получатели идут последними: фиксация может ждать подтверждения получателя
+    for url in settings.sink_urls or []:
+        for log_source in LOGS_SOURCES:
+            runtime_data.followers[log_source].append(DeliverySink(settings, log_source, url))
+    # Прогоны запоздавших событий прошлого запуска объединяются при первой фиксации (в любом режиме LATE_EVENTS_MODE),
+    # временные файлы прерванного объединения удаляются - файл дня ещё не заменён
+    for log_source in LOGS_SOURCES:
+        directory = settings.dir_paths[log_source]
+        for name in _log_file_names(settings, log_source):
+            if os.path.exists(os.path.join(directory, f"{name}.merge")):
+                os.remove(os.path.join(directory, f"{name}.merge"))
+        for name in _late_run_names(settings, log_source):
+            file_path = os.path.join(directory, name[:name.rindex(LATE_RUN_SUFFIX + "-")])
+            runtime_data.writers.add_late_run(file_path, log_source, os.path.join(directory, name))
+    return runtime_data
+
+def run_organization(settings: "SettingParams", runtime_data: "RuntimeData"):
+    register_progress_metrics(settings, runtime_data)
+    if USE_ASYNC_SCHEDULER:
+        import asyncio
+        # В режиме слежения асинхронный планировщик только загружает историю
+        asyncio.run(async_download_scheduler(settings, runtime_data, cycles=1 if USE_TAIL_MODE else None))
+    if USE_TAIL_MODE:
+        tail_scheduler(settings, runtime_data)
+    elif not USE_ASYNC_SCHEDULER:
+        download_scheduler(settings, runtime_data)
+
+def run_organizations(organizations: list, duration_sec: float = None):
+    """Download logs of several organizations in one process, one thread per organization.
+
+    Each organization has its own settings, files, checkpoints and dedup indexes. API requests of all
+    organizations share ORG_MAX_CONCURRENT_REQUESTS slots of FairRequestBudget.
+    organizations - list of (SettingParams, RuntimeData), duration_sec - run time (None - forever).
+    """
+    api_sessions.budget = FairRequestBudget(ORG_MAX_CONCURRENT_REQUESTS)
+    threads = []
+    for settings, runtime_data in organizations:
+        thread = threading.Thread(target=_organization_worker, args=(settings, runtime_data), name=f"org_{settings.name}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    stop_at = None if duration_sec is None else time.monotonic() + duration_sec
+    try:
+        while any(thread.is_alive() for thread in threads):
+            timeout = ORG_METRICS_INTERVAL_SEC if stop_at is None else min(ORG_METRICS_INTERVAL_SEC, stop_at - time.monotonic())
+            if timeout <= 0:
+                break
+            time.sleep(timeout)
+            report_organizations(organizations)
+    finally:
+        for _, runtime_data in organizations:
+            runtime_data.close()
+
+def _organization_worker(settings: "SettingParams", runtime_data: "RuntimeData"):
+    _organization.set(settings.name)
+    while True:
+        try:
+            run_organization(settings, runtime_data)
+            return
+        except Exception as e:
+            # Ошибка одной организации не останавливает загрузку остальных
+            logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+            time.sleep(SLEEP_MINITS_AFTER_LAST_FETCH * 60)
+
+def report_organizations(organizations: list):
+    budget = api_sessions.budget
+    for settings, runtime_data in organizations:
+        stats = api_sessions.organization_stats.get(settings.name) or ApiSessionStats()
+        date_now = datetime.now() - timedelta(hours=settings.timezone_shift)
+        lags = []
+        for log_source in LOGS_SOURCES:
+            oldest_datetime = runtime_data.oldest_datetime[log_source]
+            lag = f"{(date_now - _parse_utc_datetime(oldest_datetime)).total_seconds():.0f} sec" if oldest_datetime else "unknown"
+            event_filter = (settings.event_filters or {}).get(log_source)
+            filtered = f", filtered out {event_filter.summary()}" if event_filter is not None and event_filter.dropped else ""
+            lags.append(f"{log_source} - {runtime_data.last_records[log_source].added} records{filtered}, lag {lag}")
+        wait_seconds = budget.wait_seconds.get(settings.name, 0.0) if budget is not None else 0.0
+        logger.info(f"Organization {settings.name}: {', '.join(lags)}; requests - {stats.requests}, retries - {stats.retries}, "
+                    f"throttled (429) - {stats.throttled}, failed - {stats.failed}, waiting for request slot - {wait_seconds:.1f} sec")
 
 def fetch_and_save_old_logs_controller(settings: "SettingParams", runtime_data: "RuntimeData", oldest_datetime: str, label: str):
 
+    completed = False
     try:
         fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
         parsed_oldest = _parse_utc_datetime(oldest_datetime)
-        new_started_at = parsed_oldest + relativedelta(microseconds=+100)
+        new_started_at = parsed_oldest + timedelta(microseconds=100)
         logger.info(f"Started mail audit logs download process from {new_started_at.strftime(fmt)}")
 
-        progress_start_dt = _parse_utc_datetime(oldest_datetime)
-        progress_end_dt = datetime.now() + relativedelta(hours=-settings.timezone_shift)
-        print_progress_bar(progress_start_dt, progress_start_dt, progress_end_dt)
+        status_board.begin(label, parsed_oldest, datetime.now() - timedelta(hours=settings.timezone_shift))
 
+        sizer = runtime_data.get_window_sizer(label)
         exit_while = False
         while True:
 
-            parsed_oldest = _parse_utc_datetime(oldest_datetime)
-            new_started_at = parsed_oldest + relativedelta(microseconds=+1000)
+            # parsed_oldest - разобранное значение oldest_datetime, обновляется вместе с ним в конце итерации
+            new_started_at = parsed_oldest + timedelta(microseconds=1000)
             last_datetime = new_started_at.strftime(fmt)
 
-            diff_in_minutes = (datetime.now() + relativedelta(hours=-settings.timezone_shift) - parsed_oldest).total_seconds() / 60
-            if diff_in_minutes > NEW_LOG_ONE_FETCH_CYCLE_IN_MINUTES:
-                ended_at = parsed_oldest + relativedelta(minutes=+NEW_LOG_ONE_FETCH_CYCLE_IN_MINUTES)
+            date_now = datetime.now() - timedelta(hours=settings.timezone_shift)
+            if (date_now - parsed_oldest).total_seconds() / 60 > sizer.minutes:
+                ended_at = parsed_oldest + timedelta(minutes=sizer.minutes)
             else:
-                ended_at = datetime.now() + relativedelta(hours=-settings.timezone_shift)
+                ended_at = date_now
                 exit_while = True
             str_ended_at = ended_at.strftime(fmt)
 
             logger.debug(f"Start downloading data from {label} audit logs from {last_datetime} to {str_ended_at}.")
+            _checkpoint_begin(runtime_data, label, last_datetime, str_ended_at)
+            _set_request_priority(not exit_while)
             if label == "mail":
-                error, records = fetch_mail_audit_logs(settings, last_datetime, str_ended_at)
+                error, records_count, newest_date = stream_mail_logs_window(settings, runtime_data, last_datetime, str_ended_at)
 
             if error:
                 logger.error(f"Error occured during reciving records from {label} audit logs from {last_datetime} to {str_ended_at}. Force quite cycle.")
                 break
+            sizer.observe(parsed_oldest, ended_at, records_count)
 
-            if records:
-                #logger.info(f"{len(records)} records were recived from {label} audit logs from {last_datetime} to {str_ended_at}.")
-                decoded_records = [r.decode() for r in records]
-                save_old_logs_to_file(settings, label, decoded_records, runtime_data)
-                json_records = [json.loads(r) for r in decoded_records]
-                sorted_records = sorted(json_records, key=lambda x: x["date"], reverse=True)
-                occurred_at_raw = sorted_records[0]["date"]
-                match = re.match(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?)", occurred_at_raw)
-                if match:
-                    suggested_date = match.group(1)
-                else:
-                    logger.warning(f"Could not parse occurred_at field: {occurred_at_raw}")
-                    suggested_date = occurred_at_raw[:19]  # fallback, though не гарантия что корректно
+            if newest_date is not None:
+                suggested_date = _event_time_prefix(newest_date)
 
                 # Если дата последнего события в полученных событиях совпадает до секунды с конечной датой,
                 # то используем дату последнего события в полученных событиях, иначе используем конечную дату
                 if suggested_date[:19] ==   str_ended_at[:19]:
                     oldest_datetime = f"{suggested_date}Z"
+                    parsed_oldest = _parse_utc_datetime(oldest_datetime)
                 else:
                     oldest_datetime = str_ended_at
+                    parsed_oldest = ended_at
 
-            elif records == []:
+            else:
                 #logger.debug(f"No new logs received for period from {last_datetime} to {str_ended_at}. Next turn.")
                 oldest_datetime = str_ended_at
+                parsed_oldest = ended_at
+
+            if exit_while:
+                # Последнее окно доходит до текущего момента: отметка отстает от него на задержку появления событий в API
+                watermark = _head_watermark(settings, runtime_data, label, ended_at)
+                if watermark < parsed_oldest:
+                    oldest_datetime, parsed_oldest = watermark.strftime(fmt), watermark
+            _checkpoint_commit(runtime_data, label, oldest_datetime, (last_datetime, str_ended_at))
+            status_board.advance(label, ended_at, records_count)
+
+            if exit_while:
+                completed = True
+                break
+
+    except Exception as e:
+        logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+    finally:
+        status_board.finish(label, completed)
+    return completed
+
+
+def get_date_of_last_record(settings: "SettingParams", runtime_data: "RuntimeData", log_source):
+
+    fmt = '%Y-%m-%dT%H:%M:%SZ'
+    date = (datetime.now() - timedelta(hours=settings.timezone_shift, days=MAX_DAYS_AGO_FOR_API_CALLS)).strftime(fmt)
+    checkpoint = runtime_data.checkpoints[log_source] if runtime_data.checkpoints else None
+    if runtime_data.oldest_datetime[log_source] is None and checkpoint is not None and checkpoint.load(runtime_data.last_records[log_source]):
+        runtime_data.oldest_datetime[log_source] = checkpoint.watermark
+        date = checkpoint.watermark
+        logger.info(f"Resume {log_source} logs download from checkpoint {checkpoint.file_path}.")
+        if checkpoint.in_flight:
+            # Окна могли быть частично записаны в файлы до сбоя - дополняем индекс дублей по концу последнего файла
+            logger.info(f"Checkpoint has {len(checkpoint.in_flight)} unfinished windows for {log_source} logs, they will be downloaded again.")
+            newest_file = _newest_log_file(settings, log_source)
+            if newest_file:
+                rebuild_dedup_index(runtime_data, log_source, newest_file)
+            checkpoint.in_flight = []
+
+    elif runtime_data.oldest_datetime[log_source] is None:
+        files = _log_file_names(settings, log_source)
+
+        if not files:
+            logger.info(f"No files found in {settings.dir_paths[log_source]} catalog. Start full downloading data.")
+        else:
+            files.sort(reverse=True)
+            for file in files:
+                file_path = os.path.join(settings.dir_paths[log_source], file)
+                logger.debug(f"Check records in file {file_path}.")
+                last_record = _read_last_record(file_path)
+                if last_record is None:
+                    logger.debug(f"No records found in file {file_path}. Selecting previous file.")
+                else:
+                    if log_source == "mail" or log_source == "disk":
+                        occurred_at_raw = last_record["date"][0:19]
+                    else:
+                        occurred_at_raw = last_record['event']['occurred_at']
+                    # Поддержка разных форматов строки времени: YYYY-MM-DDTHH:MM:SS[.microseconds]
+                    suggested_date = _event_time_prefix(occurred_at_raw)
+                    date = f"{suggested_date}Z"
+                    runtime_data.oldest_datetime[log_source] = date
+                    rebuild_dedup_index(runtime_data, log_source, file_path)
+                    break
+
+    else:
+        date =runtime_data.oldest_datetime[log_source]
+        if checkpoint is not None:
+            # Незавершенные окна предыдущего прохода будут загружены заново от отметки последней записи
+            checkpoint.in_flight = []
+
+    logger.info(f"Last record date for {log_source} logs: {date}")
+    
+    return date
+
+@dataclass
+class SettingParams:
+    oauth_token: str
+    organization_id: int  
+    dir_paths : dict
+    ext: str
+    file_names: dict
+    timezone_shift: int
+    name: str = ""
+    parquet_dir: Path = None
+    sink_urls: list = None
+    event_filters: dict = None
+
+@dataclass
+class RuntimeData:
+    last_records: dict = None
+    oldest_datetime: str = None
+    checkpoints: dict = None
+    writers: "DayFileWriterPool" = None
+    window_sizers: dict = None
+    followers: dict = None
+    locks: list = None
+    # Наблюдаемая задержка появления событий в API (секунды) и момент, до которого источник уже запрошен
+    arrival_delays: dict = None
+    polled_until: dict = None
+    # Курсоры режима слежения по источникам: конец последнего выполненного запроса (high_water), параметры прерванного запроса
+    # с курсором следующей страницы (params), количество опросов после запроса с перекрытием (polls) и задержка API при нём (delay)
+    tail_cursors: dict = None
+
+    def get_writers(self):
+        if self.writers is None:
+            self.writers = DayFileWriterPool()
+        return self.writers
+
+    def get_window_sizer(self, log_source: str):
+        if self.window_sizers is None:
+            self.window_sizers = {}
+        if log_source not in self.window_sizers:
+            if log_source == "mail":
+                self.window_sizers[log_source] = WindowSizer(log_source, OLD_LOG_ONE_FETCH_CYCLE_IN_MINUTES, MAIL_LOGS_MAX_RECORDS)
+            else:
+                self.window_sizers[log_source] = WindowSizer(log_source, NEW_LOG_ONE_FETCH_CYCLE_IN_MINUTES, ALL_LOGS_MAX_RECORDS)
+        return self.window_sizers[log_source]
+
+    def close(self):
+        try:
+            if self.writers is not None:
+                self.writers.close()
+                if any(self.writers.due_late_runs(log_source, force=True) for log_source in LOGS_SOURCES):
+                    # Запоздавшие события объединяются с днями, когда получатели дочитают их прогоны
+                    for log_source in LOGS_SOURCES:
+                        for follower in self.get_followers(log_source):
+                            follower.export(follower.take_touched())
+                        merge_late_runs(self, log_source, force=True)
+        finally:
+            try:
+                # Выгрузка и индекс дочитывают файлы дней после сброса их буферов
+                for follower in self.get_followers():
+                    follower.close()
+            finally:
+                for lock in self.locks or []:
+                    lock.release()
+
+    def get_followers(self, log_source: str = None):
+        if not self.followers:
+            return []
+        if log_source is None:
+            return [follower for followers in self.followers.values() for follower in followers]
+        return self.followers.get(log_source, [])
+
+
+class _GzipCodec:
+    suffix = ".gz"
+    magic = b"\x1f\x8b\x08"
+
+    def compress(self, data: bytes):
+        import gzip
+        return gzip.compress(data, compresslevel=6, mtime=0)
+
+    def decompressobj(self):
+        import zlib
+        return zlib.decompressobj(wbits=31)
+
+
+class _ZstdCodec:
+    suffix = ".zst"
+    magic = b"\x28\xb5\x2f\xfd"
+
+    def compress(self, data: bytes):
+        return _import_zstandard().ZstdCompressor(level=3).compress(data)
+
+    def decompressobj(self):
+        return _import_zstandard().ZstdDecompressor().decompressobj()
+
+
+_CODECS = {"gzip": _GzipCodec(), "zstd": _ZstdCodec()}
+
+
+def _codec_of_file(file_path: str):
+    # Формат файла определяется его расширением, поэтому обычные и сжатые файлы могут лежать в одном каталоге
+    for codec in _CODECS.values():
+        if file_path.endswith(codec.suffix):
+            return codec
+    return None
+
+
+class _CompressedDayFile:
+    """Append-only day file written as a sequence of independent gzip members or zstd frames.
+
+    Data is buffered uncompressed and every flush (or full buffer) closes the current member,
+    so an interrupted write damages only the last member, which is cut off on the next open.
+    """
+
+    def __init__(self, file_path: str, codec, buffer_bytes: int):
+        self._file = open(file_path, "ab")
+        self._codec = codec
+        self._buffer = bytearray()
+        self._buffer_bytes = buffer_bytes
+
+    def write(self, data: bytes):
+        self._buffer += data
+        if len(self._buffer) >= self._buffer_bytes:
+            self._write_member()
+
+    def flush(self):
+        self._write_member()
+        self._file.flush()
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._file.close()
+
+    def _write_member(self):
+        if self._buffer:
+            self._file.write(self._codec.compress(bytes(self._buffer)))
+            self._buffer.clear()
+
+
+class DayFileWriterPool:
+    """Open day files with large write buffers, kept in LRU order and shared by all sources.
+
+    Buffers are flushed every WRITER_FLUSH_RECORDS records, every WRITER_FLUSH_INTERVAL_SEC seconds
+    and on commit() before the watermark is moved. WRITER_FSYNC_POLICY defines when data is fsynced.
+    Compressed day files (.gz, .zst) are written by members; with SEAL_CLOSED_DAYS a day file is
+    recompressed in the background once a later day of the same log is committed. With LATE_EVENTS_MODE
+    "merge" events older than the end of their day file are kept in sorted side runs until they are merged.
+    """
+
+    def __init__(self, max_open_files: int = WRITER_MAX_OPEN_FILES, buffer_bytes: int = WRITER_BUFFER_BYTES, fsync_policy: str = WRITER_FSYNC_POLICY):
+        self.max_open_files = max_open_files
+        self.buffer_bytes = buffer_bytes
+        self.fsync_policy = fsync_policy
+        self._files = OrderedDict()
+        self._dirty = set()
+        self._pending_records = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+        # Дни, записанные через пул: шаблон пути без даты -> {дата: путь}
+        self._days = {}
+        self._sealed = set()
+        self._repaired = set()
+        self._sealer = None
+        self._sealing = set()
+        # Ключ _event_sort_key последней записи файла дня или прогона
+        self._last_keys = {}
+        # Файл дня -> [источник, пути прогонов запоздавших событий, время создания первого прогона]
+        self._late_runs = {}
+
+    def write_lines(self, file_path: str, lines: list):
+        with self._lock:
+            f = self._open(file_path)
+            f.write("".join(f"{line}\n" for line in lines).encode("utf8"))
+            self._dirty.add(file_path)
+            self._remember_day(file_path)
+            self._pending_records += len(lines)
+            if self._pending_records >= WRITER_FLUSH_RECORDS or time.monotonic() - self._last_flush >= WRITER_FLUSH_INTERVAL_SEC:
+                self.flush(fsync=self.fsync_policy == "batch")
+
+    def write_events(self, file_path: str, log_source: str, events: list):
+        """Write (event_time, line) pairs of one day file. Returns written file paths and the number of late events.
+
+        With LATE_EVENTS_MODE "merge" events older than the last event of the day file are appended to the newest
+        side run of the day if they do not break its order, otherwise a new run is started. Day file and runs
+        stay sorted by event time.
+        """
+        if LATE_EVENTS_MODE != "merge":
+            self.write_lines(file_path, [line for _, line in events])
+            return [file_path], 0
+        keyed = sorted(((_event_sort_key(event_time), line) for event_time, line in events), key=lambda item: item[0])
+        with self._lock:
+            last_key = self._last_key(file_path, log_source)
+            late = 0
+            while late < len(keyed) and keyed[late][0] < last_key:
+                late += 1
+            written = []
+            if late < len(keyed):
+                self.write_lines(file_path, [line for _, line in keyed[late:]])
+                self._last_keys[file_path] = keyed[-1][0]
+                written.append(file_path)
+            if late:
+                written.append(self._write_late_run(file_path, log_source, keyed[:late]))
+            return written, late
+
+    def write_late_events(self, file_path: str, log_source: str, events: list):
+        """Write (event_time, line) pairs older than already written lines of the day file to its sorted side runs
+        (in any LATE_EVENTS_MODE). Returns written file paths and the number of late events."""
+        keyed = sorted(((_event_sort_key(event_time), line) for event_time, line in events), key=lambda item: item[0])
+        with self._lock:
+            return [self._write_late_run(file_path, log_source, keyed)], len(keyed)
+
+    def _write_late_run(self, file_path: str, log_source: str, keyed: list):
+        # Строки дописываются в последний прогон дня, если не нарушают его порядок, иначе начинается новый прогон
+        entry = self._late_runs.setdefault(file_path, [log_source, [], time.monotonic()])
+        run_path = entry[1][-1] if entry[1] else None
+        if run_path is None or keyed[0][0] < self._last_key(run_path, log_source):
+            number = int(run_path.rsplit("-", 1)[1]) + 1 if run_path else 1
+            run_path = f"{file_path}{LATE_RUN_SUFFIX}-{number:06d}"
+            entry[1].append(run_path)
+        self.write_lines(run_path, [line for _, line in keyed])
+        self._last_keys[run_path] = keyed[-1][0]
+        return run_path
+
+    def add_late_run(self, file_path: str, log_source: str, run_path: str):
+        # Прогон, оставшийся от прошлого запуска, объединяется при первой фиксации
+        with self._lock:
+            entry = self._late_runs.setdefault(file_path, [log_source, [], 0])
+            if run_path not in entry[1]:
+                entry[1].append(run_path)
+                entry[1].sort()
+
+    def due_late_runs(self, log_source: str, force: bool = False):
+        """Day files of the source whose late runs should be merged: LATE_MERGE_MAX_RUNS runs or LATE_MERGE_INTERVAL_SEC passed."""
+        with self._lock:
+            now = time.monotonic()
+            return [file_path for file_path, (source, run_paths, created) in self._late_runs.items()
+                    if source == log_source and (force or len(run_paths) >= LATE_MERGE_MAX_RUNS or now - created >= LATE_MERGE_INTERVAL_SEC)]
+
+    def merge_late_runs(self, file_path: str, followers: list):
+        """Merge the late runs into the day file and replace it atomically. Returns the merge result or None if it is postponed.
+
+        Merge is postponed while the day file is sealed or a follower has not read the day file and its runs yet;
+        read positions of the followers are moved to the end of the merged file before it replaces the day file.
+        """
+        with self._lock:
+            entry = self._late_runs.get(file_path)
+            if entry is None or file_path in self._sealing:
+                return None
+            log_source, run_paths = entry[0], list(entry[1])
+            names = [os.path.basename(path) for path in [file_path] + run_paths if os.path.exists(path)]
+            # Файлы закрываются, только если получатели уже дочитали их (после фиксации буферы сброшены)
+            if not all(follower.caught_up(names) for follower in followers):
+                return None
+            for path in [file_path] + run_paths:
+                self._close_file(path)
+            if not all(follower.caught_up(names) for follower in followers):
+                return None
+            temp_path = f"{file_path}.merge"
+            inputs = [path for path in [file_path] + run_paths if os.path.exists(path)]
+            result = _merge_late_runs(inputs[0], log_source, inputs[1:], temp_path, _codec_of_file(file_path))
+            run_names = [os.path.basename(path) for path in run_paths]
+            for follower in followers:
+                follower.files_merged(os.path.basename(file_path), [result["new_size"], result["written"], result["new_inode"]], run_names)
+            os.replace(temp_path, file_path)
+            for path in run_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+                self._last_keys.pop(path, None)
+            _fsync_directory(file_path)
+            del self._late_runs[file_path]
+            self._last_keys.pop(file_path, None)
+            result["runs"] = len(run_paths)
+            return result
+
+    def flush(self, fsync: bool = False):
+        with self._lock:
+            for file_path in list(self._dirty):
+                f = self._files.get(file_path)
+                if f is not None:
+                    f.flush()
+                    if fsync:
+                        os.fsync(f.fileno())
+                self._dirty.discard(file_path)
+            self._pending_records = 0
+            self._last_flush = time.monotonic()
+
+    def commit(self):
+        """Flush all buffers before the watermark is moved. Returns False if data could not be written."""
+        try:
+            self.flush(fsync=self.fsync_policy in ("batch", "commit"))
+        except OSError as e:
+            logger.error(f"Error during flushing audit log files: {type(e).__name__}: {e}")
+            return False
+        if SEAL_CLOSED_DAYS:
+            self._seal_closed_days()
+        return True
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            sealer, self._sealer = self._sealer, None
+        # Запись закрытых дней дожидается завершения их пережатия без блокировки пула
+        if sealer is not None:
+            sealer.shutdown(wait=True)
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+            self._dirty.clear()
+
+    def _last_key(self, file_path: str, log_source: str):
+        # Ключ читается с конца файла один раз, дальше запоминается при записи; пустой файл - пустая строка
+        if file_path not in self._last_keys:
+            key = ""
+            if os.path.exists(file_path):
+                record = _read_last_record(file_path, repair=False)
+                try:
+                    key = _event_sort_key(record["event"]["occurred_at"] if log_source == "all" else record["date"])
+                except (KeyError, TypeError):
+                    pass
+            self._last_keys[file_path] = key
+        return self._last_keys[file_path]
+
+    def _remember_day(self, file_path: str):
+        match = re.search(r"_([0-9]{4}-[0-9]{2}-[0-9]{2})\.[^/\\]*$", file_path)
+        if match is not None and _codec_of_file(file_path) is not None:
+            template = file_path[:match.start(1)] + file_path[match.end(1):]
+            self._days.setdefault(template, {})[match.group(1)] = file_path
+
+    def _seal_closed_days(self):
+        with self._lock:
+            for days in self._days.values():
+                newest = max(days)
+                for date, file_path in days.items():
+                    if date < newest and file_path not in self._sealed:
+                        self._sealed.add(file_path)
+                        if self._sealer is None:
+                            self._sealer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sealer")
+                        self._sealer.submit(contextvars.copy_context().run, self._seal, file_path)
+
+    def _seal(self, file_path: str):
+        """Recompress a closed day file into members of about SEAL_MEMBER_BYTES uncompressed data and replace it atomically."""
+        codec = _codec_of_file(file_path)
+        temp_path = f"{file_path}.seal"
+        try:
+            with self._lock:
+                # Прогоны запоздавших событий не объединяются с днём, пока он пережимается
+                self._sealing.add(file_path)
+                self._close_file(file_path)
+                sealed_size = os.path.getsize(file_path)
+            old_size, new_size = 0, 0
+            with open(file_path, "rb") as src, open(temp_path, "wb") as dst:
+                pending = bytearray()
+                for chunk in _iter_decompressed(src, codec, sealed_size):
+                    pending += chunk
+                    if len(pending) >= SEAL_MEMBER_BYTES:
+                        cut = pending.rfind(b"\n") + 1
+                        dst.write(codec.compress(bytes(pending[:cut])))
+                        del pending[:cut]
+                if pending:
+                    dst.write(codec.compress(bytes(pending)))
+                with self._lock:
+                    # Записи, добавленные в день во время пережатия (запоздавшие события), переносятся как есть - это целые блоки
+                    self._close_file(file_path)
+                    src.seek(sealed_size)
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                    old_size, new_size = src.tell(), dst.tell()
+                    os.replace(temp_path, file_path)
+            _fsync_directory(file_path)
+            logger.debug(f"Day file {file_path} sealed: {old_size} -> {new_size} bytes.")
+        except Exception as e:
+            logger.error(f"Can not seal day file {file_path}: {type(e).__name__}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        finally:
+            with self._lock:
+                self._sealing.discard(file_path)
+
+    def _close_file(self, file_path: str):
+        f = self._files.pop(file_path, None)
+        if f is not None:
+            f.flush()
+            if file_path in self._dirty and self.fsync_policy != "none":
+                os.fsync(f.fileno())
+            self._dirty.discard(file_path)
+            f.close()
+
+    def _open(self, file_path: str):
+        f = self._files.get(file_path)
+        if f is not None:
+            self._files.move_to_end(file_path)
+            return f
+        while len(self._files) >= self.max_open_files:
+            old_path, old_file = self._files.popitem(last=False)
+            old_file.flush()
+            if old_path in self._dirty and self.fsync_policy != "none":
+                os.fsync(old_file.fileno())
+            self._dirty.discard(old_path)
+            old_file.close()
+        codec = _codec_of_file(file_path)
+        if codec is None:
+            f = open(file_path, "ab", buffering=self.buffer_bytes)
+        else:
+            if file_path not in self._repaired and os.path.exists(file_path):
+                # Недописанный при сбое последний блок отрезается, иначе следующие блоки нельзя будет прочитать
+                _read_compressed_tail(file_path, codec, 1)
+            self._repaired.add(file_path)
+            f = _CompressedDayFile(file_path, codec, self.buffer_bytes)
+        self._files[file_path] = f
+        return f
+
+
+class DedupIndex:
+    """Identities of already written events, bounded to a sliding time window.
+
+    Only events not older than DEDUP_WINDOW_SECONDS from the newest indexed event are kept,
+    which covers the overlap between consecutive API requests while keeping memory flat.
+    """
+
+    def __init__(self, window_seconds: int = DEDUP_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._identities = {}
+        self._expiration = []
+        self._newest = 0.0
+        # Количество событий, добавленных после записи в файлы
+        self.added = 0
+
+    def __contains__(self, identity: bytes):
+        return identity in self._identities
+
+    def __len__(self):
+        return len(self._identities)
+
+    def add(self, identity: bytes, event_time: str):
+        self.added += 1
+        self._add(identity, _event_timestamp(event_time))
+
+    def to_state(self, since: float = None):
+        # since - только события не старше этого момента (секунды от 1970-01-01 UTC)
+        return [[identity.hex(), timestamp] for identity, timestamp in self._identities.items() if since is None or timestamp >= since]
+
+    def load_state(self, items: list):
+        for identity, timestamp in items:
+            self._add(bytes.fromhex(identity), float(timestamp))
+
+    def _add(self, identity: bytes, timestamp: float):
+        if timestamp < self._newest - self.window_seconds or identity in self._identities:
+            return
+        self._identities[identity] = timestamp
+        heapq.heappush(self._expiration, (timestamp, identity))
+        if timestamp > self._newest:
+            self._newest = timestamp
+            self._evict()
+
+    def _evict(self):
+        border = self._newest - self.window_seconds
+        while self._expiration and self._expiration[0][0] < border:
+            _, identity = heapq.heappop(self._expiration)
+            del self._identities[identity]
+
+
+def _event_identity(line: str):
+    # Идентификатор события - хэш его JSON строки в том виде, в котором она записывается в файл
+    return hashlib.blake2b(line.encode("utf8"), digest_size=16).digest()
+
+_EPOCH = datetime(1970, 1, 1)
+
+@functools.lru_cache(maxsize=1024)
+def _day_timestamp(date: str):
+    # Начало дня YYYY-MM-DD в секундах от 1970-01-01 UTC; разных дней в потоке событий немного, значения кэшируются
+    return (datetime.fromisoformat(date) - _EPOCH).days * 86400
+
+def _event_timestamp(event_time: str):
+    # Секундной точности достаточно для окна дедупликации, дробная часть и часовой пояс отбрасываются.
+    # Время считается из полей строки без создания datetime для каждой записи
+    if event_time[10:11] != "T":
+        raise ValueError(f"Invalid event time: {event_time}")
+    return _day_timestamp(event_time[0:10]) + int(event_time[11:13]) * 3600 + int(event_time[14:16]) * 60 + int(event_time[17:19])
+
+def _event_time_of_line(log_source: str, line: str):
+    record = _json_loads(line)
+    if log_source == "all":
+        return record["event"]["occurred_at"]
+    return record["date"]
+
+def _read_tail_lines(file_path: str, max_bytes: int):
+    """Read complete lines from the last max_bytes of the file without reading the whole file."""
+    codec = _codec_of_file(file_path)
+    if codec is not None:
+        # Блоки начинаются с начала строки, поэтому первая строка распакованного конца файла полная
+        return [line.decode("utf8") for line in _read_compressed_tail(file_path, codec, max_bytes).split(b"\n") if line]
+    with open(file_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        start = max(size - max_bytes, 0)
+        f.seek(start)
+        data = f.read()
+    lines = data.split(b"\n")
+    # Первая строка неполная, если чтение началось не с начала файла; последняя - пустая или недописанная
+    if start > 0:
+        lines = lines[1:]
+    lines = lines[:-1]
+    return [line.decode("utf8") for line in lines if line]
+
+def _day_file_path(settings: "SettingParams", log_source: str, date: str):
+    suffix = _CODECS[OUTPUT_COMPRESSION].suffix if OUTPUT_COMPRESSION in _CODECS else ""
+    return os.path.join(settings.dir_paths[log_source], f"{settings.file_names[log_source]}_{date}.{settings.ext}{suffix}")
+
+def _log_file_names(settings: "SettingParams", log_source: str):
+    # Обычные и сжатые файлы дней источника (имена в нижнем регистре)
+    pattern = settings.file_names[log_source] + r'_[0-9]{4}\-[0-9]{2}\-[0-9]{2}\.' + settings.ext + r'(\.gz|\.zst)?$'
+    all_names = (file_path.name.lower() for file_path in Path(settings.dir_paths[log_source]).iterdir() if file_path.is_file())
+    return [f for f in all_names if re.match(pattern, f)]
+
+def _late_run_names(settings: "SettingParams", log_source: str):
+    # Прогоны запоздавших событий файлов дней источника (режим LATE_EVENTS_MODE = "merge" и страницы окна не по возрастанию времени)
+    pattern = (settings.file_names[log_source] + r'_[0-9]{4}\-[0-9]{2}\-[0-9]{2}\.' + settings.ext + r'(\.gz|\.zst)?'
+               + re.escape(LATE_RUN_SUFFIX) + r'-[0-9]+$')
+    all_names = (file_path.name.lower() for file_path in Path(settings.dir_paths[log_source]).iterdir() if file_path.is_file())
+    return [f for f in all_names if re.match(pattern, f)]
+
+def _late_run_paths(file_path: str):
+    # Прогоны запоздавших событий одного файла дня в порядке их создания
+    directory, name = os.path.split(file_path)
+    prefix = f"{name}{LATE_RUN_SUFFIX}-"
+    return sorted(os.path.join(directory, run_name) for run_name in os.listdir(directory) if run_name.startswith(prefix))
+
+def _newest_log_file(settings: "SettingParams", log_source: str):
+    files = _log_file_names(settings, log_source)
+    if not files:
+        return None
+    return os.path.join(settings.dir_paths[log_source], max(files))
+
+def _iter_lines_reversed(f, block_size: int = 64 * 1024):
+    """Yield lines of a binary file from the end to the beginning, reading it by blocks."""
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    remainder = b""
+    while position > 0:
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        lines = (f.read(read_size) + remainder).split(b"\n")
+        remainder = lines[0]
+        for line in reversed(lines[1:]):
+            yield line
+    yield remainder
+
+def _repair_truncated_tail(file_path: str):
+    """Cut off the incomplete last line left by an interrupted write, so new records are not glued to it."""
+    with open(file_path, "r+b") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        tail = next(_iter_lines_reversed(f))
+        f.truncate(size - len(tail))
+    logger.warning(f"File {file_path} ends with incomplete record ({len(tail)} bytes). Incomplete record removed.")
+
+def _read_last_record(file_path: str, max_corrupted_lines: int = 100, repair: bool = True):
+    """Return the last complete and valid JSON record of the file or None. Cost does not depend on file size.
+
+    With repair an incomplete last line is cut off the file, otherwise the file is only read.
+    """
+    codec = _codec_of_file(file_path)
+    if codec is not None:
+        return _last_valid_record(file_path, reversed(_read_compressed_tail(file_path, codec, 1, repair).split(b"\n")), max_corrupted_lines)
+    if repair:
+        _repair_truncated_tail(file_path)
+    with open(file_path, "rb") as f:
+        return _last_valid_record(file_path, _iter_lines_reversed(f), max_corrupted_lines)
+
+def _last_valid_record(file_path: str, lines, max_corrupted_lines: int):
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            return _json_loads(line)
+        except ValueError:
+            logger.warning(f"Skip corrupted record at the end of file {file_path}.")
+            max_corrupted_lines -= 1
+            if max_corrupted_lines <= 0:
+                logger.error(f"Too many corrupted records at the end of file {file_path}. File is skipped.")
+                break
+    return None
+
+def _iter_decompressed(f, codec, size: int, chunk_size: int = 1024 * 1024):
+    """Yield uncompressed data of the first size bytes of a file made of consecutive members (frames)."""
+    decompressor = codec.decompressobj()
+    remaining = size
+    while remaining > 0:
+        data = f.read(min(chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        while data:
+            yield decompressor.decompress(data)
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = codec.decompressobj()
+            else:
+                data = b""
+
+def _decompress_members(data: bytes, codec):
+    """Decompress consecutive members from the start of data.
+
+    Returns uncompressed data of complete members and the length of data they occupy
+    (less than len(data) if the last member is incomplete). Raises on invalid data.
+    """
+    chunks = []
+    position = 0
+    while position < len(data):
+        decompressor = codec.decompressobj()
+        chunk = decompressor.decompress(data[position:])
+        if not decompressor.eof:
+            break
+        chunks.append(chunk)
+        position = len(data) - len(decompressor.unused_data)
+    return b"".join(chunks), position
+
+def _is_complete_member(data: bytes, codec):
+    decompressor = codec.decompressobj()
+    try:
+        decompressor.decompress(data)
+    except Exception:
+        return False
+    return decompressor.eof
+
+def _scan_members(data: bytes, codec):
+    """Decompress consecutive members from the start of data, skipping members that fail to decompress.
+
+    Returns uncompressed data of the valid members, their number and the position of an incomplete last member
+    (the member ends early without a decompression error - interrupted write), or len(data) if there is none.
+    """
+    chunks, decoded, position = [], 0, 0
+    while position < len(data):
+        decompressor = codec.decompressobj()
+        try:
+            chunk = decompressor.decompress(data[position:])
+        except Exception:
+            # Повреждённый блок остаётся в файле, чтение продолжается со следующего начала блока
+            position = data.find(codec.magic, position + 1)
+            if position == -1:
+                break
+            continue
+        if not decompressor.eof:
+            # Блок недописан, только если за ним нет ни одного целого блока (иначе это повреждённый блок)
+            next_position = data.find(codec.magic, position + 1)
+            while next_position != -1 and not _is_complete_member(data[next_position:], codec):
+                next_position = data.find(codec.magic, next_position + 1)
+            if next_position == -1:
+                return b"".join(chunks), decoded, position
+            position = next_position
+            continue
+        chunks.append(chunk)
+        decoded += 1
+        position = len(data) - len(decompressor.unused_data)
+    return b"".join(chunks), decoded, len(data)
+
+def _read_compressed_tail(file_path: str, codec, min_bytes: int, repair: bool = True, block_size: int = 256 * 1024):
+    """Uncompressed data of the last complete members of a compressed file, at least min_bytes if the file has them.
+
+    Member starts are found by their magic bytes from the end of the file, a false match inside compressed data
+    fails to decompress and is skipped, as well as a corrupted member. With repair only an incomplete last member
+    (interrupted write) is cut off the file; members that decompress are never removed. Without repair the file is only read.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        window = block_size
+        while True:
+            start = max(size - window, 0)
+            f.seek(start)
+            data = f.read(size - start)
+            result = None
+            position = data.find(codec.magic) if start > 0 else 0
+            while position != -1:
+                uncompressed, decoded, incomplete = _scan_members(data[position:], codec)
+                # Начало блока подтверждено, если распаковался хотя бы один блок (или это начало файла)
+                if decoded > 0 or start + position == 0:
+                    result = (uncompressed, start + position + incomplete)
+                    break
+                position = data.find(codec.magic, position + 1)
+            if result is not None and (len(result[0]) >= min_bytes or start == 0):
+                uncompressed, valid_size = result
+                break
+            if start == 0:
+                # Ни один блок не распаковался: файл не изменяется
+                uncompressed, valid_size = b"", size
+                break
+            window *= 2
+    if repair and valid_size < size:
+        with open(file_path, "r+b") as f:
+            f.truncate(valid_size)
+        logger.warning(f"File {file_path} ends with incomplete compressed block ({size - valid_size} bytes). Incomplete block removed.")
+    return uncompressed
+
+def rebuild_dedup_index(runtime_data: "RuntimeData", log_source: str, file_path: str):
+    dedup_index = runtime_data.last_records[log_source]
+    for line in _read_tail_lines(file_path, DEDUP_REBUILD_TAIL_BYTES):
+        try:
+            dedup_index.add(_event_identity(line), _event_time_of_line(log_source, line))
+        except (ValueError, KeyError, TypeError):
+            logger.debug(f"Skip malformed record in {file_path} during rebuilding of deduplication index.")
+    logger.debug(f"Deduplication index for {log_source} logs rebuilt from {file_path}: {len(dedup_index)} records.")
+
+class CheckpointStore:
+    """Durable progress of one log source: committed watermark, page cursor, recent event identities and windows in flight.
+
+    The file is replaced atomically (temporary file, fsync, rename), so after a crash it holds
+    either the previous or the new consistent state. Only identities of events not older than
+    CHECKPOINT_DEDUP_SECONDS before the watermark are saved, and only on commit.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.watermark = None
+        self.cursor = None
+        self.in_flight = []
+        # Сериализованные идентификаторы последней фиксации, начало окна их не пересчитывает
+        self._recent_events = "[]"
+
+    def load(self, dedup_index: "DedupIndex"):
+        if not os.path.exists(self.file_path):
+            return False
+        try:
+            with open(self.file_path, "r", encoding="utf8") as f:
+                state = json.load(f)
+            self.watermark = state.get("watermark")
+            self.cursor = state.get("cursor")
+            self.in_flight = [list(w) for w in state.get("in_flight", [])]
+            dedup_index.load_state(state.get("recent_events", []))
+            self._recent_events = json.dumps(state.get("recent_events", []))
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f"Can not read checkpoint file {self.file_path}: {type(e).__name__}: {e}. Checkpoint is ignored.")
+            self.watermark, self.cursor, self.in_flight = None, None, []
+            return False
+        return self.watermark is not None
+
+    def begin_window(self, started_at: str, ended_at: str):
+        # Окно, перекрывающееся с незавершёнными (повтор неудачного опроса головы), объединяется с ними,
+        # поэтому повторяющиеся ошибки записи не увеличивают файл состояния
+        window = [started_at, ended_at]
+        started, ended = _parse_utc_datetime(started_at), _parse_utc_datetime(ended_at)
+        for other in [w for w in self.in_flight if self._overlaps(w, started, ended)]:
+            self.in_flight.remove(other)
+            if _parse_utc_datetime(other[0]) < started:
+                window[0], started = other[0], _parse_utc_datetime(other[0])
+            if _parse_utc_datetime(other[1]) > ended:
+                window[1], ended = other[1], _parse_utc_datetime(other[1])
+        self.in_flight.append(window)
+        self.save()
+
+    def commit(self, watermark: str, dedup_index: "DedupIndex", window: tuple = None, cursor: dict = None):
+        self.watermark = watermark
+        self.cursor = cursor
+        if window is not None:
+            # Убирается само окно и объединённые с ним окна, которые заканчиваются не позже него
+            started, ended = _parse_utc_datetime(window[0]), _parse_utc_datetime(window[1])
+            self.in_flight = [w for w in self.in_flight if list(w) != list(window)
+                              and not (self._overlaps(w, started, ended) and _parse_utc_datetime(w[1]) <= ended)]
+        try:
+            since = _event_timestamp(watermark) - CHECKPOINT_DEDUP_SECONDS
+        except (ValueError, TypeError):
+            since = None
+        self._recent_events = json.dumps(dedup_index.to_state(since))
+        self.save()
+
+    @staticmethod
+    def _overlaps(window: list, started: datetime, ended: datetime):
+        # Окна параллельной загрузки только соприкасаются границами и не объединяются
+        return _parse_utc_datetime(window[0]) < ended and started < _parse_utc_datetime(window[1])
+
+    def save(self):
+        state = {
+            "watermark": self.watermark,
+            "cursor": self.cursor,
+            "in_flight": self.in_flight,
+            "updated_at": datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+        # Идентификаторы вставляются готовой строкой JSON
+        data = json.dumps(state)[:-1] + ', "recent_events": ' + self._recent_events + "}"
+        _atomic_write(self.file_path, data.encode("utf8"))
+
+
+def _atomic_write(file_path: str, data: bytes):
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, file_path)
+    _fsync_directory(file_path)
+
+def _fsync_directory(file_path: str):
+    # Синхронизация каталога нужна, чтобы переименование пережило сбой питания (на Windows не поддерживается)
+    if os.name != "nt":
+        dir_fd = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+class LogFilesLock:
+    """Exclusive lock of the day files of a log source, held by the process that writes them (download or compaction).
+
+    The lock is taken on the file <base name>.lock in the log catalog and is released by the OS if the process dies.
+    """
+
+    def __init__(self, settings: "SettingParams", log_source: str):
+        self.path = os.path.join(settings.dir_paths[log_source], f"{settings.file_names[log_source]}{LOCK_FILE_SUFFIX}")
+        self._file = None
+
+    def acquire(self):
+        """Take the lock without waiting. Returns False if another process holds it."""
+        f = open(self.path, "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
             else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        f, self._file = self._file, None
+        if f is not None:
+            if fcntl is None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            f.close()
+
+def _checkpoint_begin(runtime_data: "RuntimeData", log_source: str, started_at: str, ended_at: str):
+    if runtime_data.checkpoints:
+        runtime_data.checkpoints[log_source].begin_window(started_at, ended_at)
+
+def _checkpoint_commit(runtime_data: "RuntimeData", log_source: str, watermark: str, window: tuple = None, cursor: dict = None):
+    # Отметка последней записи сдвигается только после сброса буферов файлов на диск
+    followers = runtime_data.get_followers(log_source)
+    # Файлы, отмеченные до сброса буферов, будут дочитаны полностью; отмеченные позже - при следующей фиксации
+    touched = [follower.take_touched() for follower in followers]
+    started = time.perf_counter()
+    committed = runtime_data.get_writers().commit()
+    metrics.observe("audit_commit_seconds", _metric_labels(log_source), time.perf_counter() - started)
+    if not committed:
+        # Индекс мог запомнить события, которые так и не попали в файлы, - иначе при повторной загрузке они будут отброшены
+        runtime_data.last_records[log_source] = DedupIndex()
+        for follower, file_paths in zip(followers, touched):
+            follower.touch(*file_paths)
+        raise OSError(f"Can not flush {log_source} audit log files. Last record date is not moved.")
+    for follower, file_paths in zip(followers, touched):
+        started = time.perf_counter()
+        follower.export(file_paths)
+        metrics.observe("audit_follower_seconds", _metric_labels(log_source, follower=follower.kind), time.perf_counter() - started)
+    runtime_data.oldest_datetime[log_source] = watermark
+    if runtime_data.checkpoints:
+        runtime_data.checkpoints[log_source].commit(watermark, runtime_data.last_records[log_source], window, cursor)
+    merge_late_runs(runtime_data, log_source)
+
+def merge_late_runs(runtime_data: "RuntimeData", log_source: str, force: bool = False):
+    """Merge late runs of the day files that are due (all with force) into the day files. Errors are only logged."""
+    writers = runtime_data.get_writers()
+    followers = runtime_data.get_followers(log_source)
+    for file_path in writers.due_late_runs(log_source, force):
+        try:
+            started = time.perf_counter()
+            result = writers.merge_late_runs(file_path, followers)
+            if result is None:
+                logger.debug(f"Merge of late runs of {file_path} is postponed until the file is read by all followers.")
+                continue
+            seconds = time.perf_counter() - started
+            metrics.observe("audit_late_merge_seconds", _metric_labels(log_source), seconds)
+            logger.info(f"Merged {result['runs']} late runs into {file_path}: {result['written']} records, "
+                        f"{result['duplicates']} duplicates dropped ({seconds:.2f} sec).")
+            # Индекс перечитывает объединённый файл, остальные получатели уже стоят на его конце
+            for follower in followers:
+                follower.touch(file_path)
+        except Exception as e:
+            logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+
+def _event_datetime(event_time: str):
+    # Время события в UTC с точностью до микросекунд (дробная часть может быть любой длины)
+    prefix = _event_time_prefix(event_time)
+    moment = datetime.fromisoformat(prefix[0:19]).replace(tzinfo=timezone.utc)
+    if len(prefix) > 20:
+        moment = moment.replace(microsecond=int(prefix[20:26].ljust(6, "0")))
+    return moment
+
+def _iter_appended_data(f, offset: int, codec, chunk_size: int = 4 * 1024 * 1024):
+    """Yield (data, start, end) with complete lines written to an open day file after offset.
+
+    A compressed file is read by members (offset must be a member boundary), start and end are
+    the member position in the file. An incomplete last line (member) is not returned.
+    """
+    f.seek(offset)
+    pending = b""
+    while True:
+        block = f.read(chunk_size)
+        if not block:
+            break
+        pending += block
+        if codec is None:
+            used = pending.rfind(b"\n") + 1
+            if used:
+                yield pending[:used], offset, offset + used
+                offset += used
+                pending = pending[used:]
+            continue
+        while pending:
+            decompressor = codec.decompressobj()
+            data = decompressor.decompress(pending)
+            if not decompressor.eof:
                 break
+            used = len(pending) - len(decompressor.unused_data)
+            yield data, offset, offset + used
+            offset += used
+            pending = decompressor.unused_data
+
+def _iter_block_lines(data: bytes, start: int, end: int, compressed: bool):
+    # Строки данных с их положением в файле: строка обычного файла - свой диапазон байт, сжатого - диапазон его блока
+    position = start
+    for line in data.split(b"\n"):
+        if not compressed:
+            line_start, position = position, position + len(line) + 1
+        if line:
+            yield (line, start, end) if compressed else (line, line_start, position)
+
+def _int_or_none(value):
+    try:
+        return int(value) if value is not None else None
+    except (ValueError, TypeError):
+        return None
+
+def _str_or_none(value):
+    return value if value is None or isinstance(value, str) else str(value)
+
+class _DayFileFollower(ABC):
+    """Consumer of lines appended to day files of a log source (export, index, delivery).
+
+    Read positions are kept in self._offsets (file name -> [offset, lines, inode]) and saved by a subclass
+    in _flush() together with its own data, so lines read but not saved are read again after a restart.
+    On commit export() reads lines appended to the touched day files after the read positions.
+    """
+
+    kind = ""
+
+    def __init__(self, settings: "SettingParams", log_source: str, description: str):
+        self.settings = settings
+        self.log_source = log_source
+        self.description = description
+        self._lock = threading.RLock()
+        self._touched = set()
+        self._offsets = {}
+
+    def touch(self, *file_paths):
+        with self._lock:
+            self._touched.update(file_paths)
+
+    def take_touched(self):
+        with self._lock:
+            touched, self._touched = self._touched, set()
+        return touched
+
+    def export(self, file_paths):
+        """Read lines appended to the day files and save them if enough are collected. Errors are only logged."""
+        with self._lock:
+            try:
+                names = {os.path.basename(file_path) for file_path in file_paths}
+                for name in sorted(names):
+                    self._read_day_file(name)
+                # Закрытые дни пережимаются в фоне, заменённые файлы перечитываются без новых записей в них
+                for name, (_, _, inode) in list(self._offsets.items()):
+                    if name not in names and self._inode_of(name) not in (inode, None):
+                        self._read_day_file(name)
+                self._committed()
+            except Exception as e:
+                # Загрузка логов продолжается, непрочитанные строки будут обработаны при следующей фиксации
+                logger.error(f"{self.description} failed: {type(e).__name__}: {e}")
+                self._touched.update(file_paths)
+
+    def close(self):
+        with self._lock:
+            self.export(self.take_touched())
+            try:
+                self._flush()
+            except Exception as e:
+                logger.error(f"{self.description} failed: {type(e).__name__}: {e}")
+
+    def caught_up(self, names: list):
+        """True if all lines of the files are read (and processed), so positions in them can be moved."""
+        with self._lock:
+            for name in names:
+                entry = self._offsets.get(name)
+                try:
+                    stat = os.stat(os.path.join(self.settings.dir_paths[self.log_source], name))
+                except FileNotFoundError:
+                    continue
+                if entry is None or entry[0] != stat.st_size or entry[2] != stat.st_ino:
+                    return False
+            return True
+
+    def files_merged(self, name: str, entry: list, run_names: list):
+        """Late runs are merged into the day file name: read position is moved to the end of the new file and saved."""
+        with self._lock:
+            for run_name in run_names:
+                if self._offsets.pop(run_name, None) is not None:
+                    self._file_removed(run_name)
+            self._offsets[name] = list(entry)
+            self._file_merged(name)
+            self._flush()
+
+    def _catch_up(self):
+        # Строки, добавленные в файлы дней после последнего сохранения (или до включения), дочитываются
+        started = time.perf_counter()
+        names = set(_log_file_names(self.settings, self.log_source)) | set(_late_run_names(self.settings, self.log_source))
+        for name in set(self._offsets) - names:
+            self._file_removed(name)
+            del self._offsets[name]
+        for name in sorted(names):
+            self._read_day_file(name)
+        self._flush()
+        logger.info(f"{self.description} is up to date with {len(names)} day files ({time.perf_counter() - started:.1f} sec).")
+
+    def _inode_of(self, name: str):
+        try:
+            return os.stat(os.path.join(self.settings.dir_paths[self.log_source], name)).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _read_day_file(self, name: str):
+        file_path = os.path.join(self.settings.dir_paths[self.log_source], name)
+        offset, lines, inode = self._offsets.get(name, (0, 0, None))
+        try:
+            f = open(file_path, "rb")
+        except FileNotFoundError:
+            if name in self._offsets:
+                self._file_removed(name)
+                del self._offsets[name]
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            skip = 0
+            if inode is not None and (stat.st_ino != inode or stat.st_size < offset):
+                # Файл заменён (закрытый день пережат): подкласс решает, сколько уже обработанных строк пропустить
+                offset, skip, lines = 0, self._file_replaced(name, lines), 0
+            elif stat.st_size == offset:
+                return
+            codec = _codec_of_file(file_path)
+            for data, start, end in _iter_appended_data(f, offset, codec):
+                for line, line_start, line_end in _iter_block_lines(data, start, end, codec is not None):
+                    lines += 1
+                    if skip:
+                        skip -= 1
+                        self._skip_line(name, lines, line_start, line_end)
+                        continue
+                    self._add_line(name, lines, line, line_start, line_end)
+                self._offsets[name] = [end, lines, stat.st_ino]
+                self._chunk_read()
+                if self._paused():
+                    break
+
+    @abstractmethod
+    def _add_line(self, name: str, number: int, line: bytes, start: int, end: int):
+        pass
+
+    def _skip_line(self, name: str, number: int, start: int, end: int):
+        pass
+
+    def _chunk_read(self):
+        pass
+
+    def _paused(self):
+        # Подкласс может остановить чтение файла после очередного блока данных
+        return False
+
+    def _committed(self):
+        pass
+
+    def _file_replaced(self, name: str, lines: int):
+        return lines
+
+    def _file_removed(self, name: str):
+        pass
+
+    def _file_merged(self, name: str):
+        pass
+
+    @abstractmethod
+    def _flush(self):
+        pass
+
+class ParquetSink(_DayFileFollower):
+    """Columnar copy of the new format audit log: Parquet files partitioned by event day (or hour).
+
+    Lines appended to the day files are turned into typed rows: flattened common event fields and the raw
+    JSON line. Rows are written to new files, sorted by event time, once PARQUET_FILE_ROWS rows are collected
+    or PARQUET_FLUSH_INTERVAL_SEC passed, and only then the read positions are saved. Files of an export
+    interrupted before saving the positions are removed on start, so every line gets into Parquet once.
+    """
+
+    kind = "parquet"
+
+    def __init__(self, settings: "SettingParams"):
+        super().__init__(settings, "all", f"Parquet export to {settings.parquet_dir}")
+        self.directory = str(settings.parquet_dir)
+        self.state_path = os.path.join(self.directory, PARQUET_STATE_FILE)
+        self._pa = _import_pyarrow()
+        pa = self._pa
+        self._schema = pa.schema([
+            ("occurred_at", pa.timestamp("us", tz="UTC")), ("type", pa.string()), ("service", pa.string()),
+            ("status", pa.string()), ("uid", pa.int64()), ("user_login", pa.string()), ("user_name", pa.string()),
+            ("ip", pa.string()), ("is_system", pa.bool_()), ("org_id", pa.int64()), ("request_id", pa.string()),
+            ("idempotency_id", pa.string()), ("raw", pa.string()),
+        ])
+        self._sequence = 0
+        self._pending = {}
+        self._pending_rows = 0
+        self._last_flush = time.monotonic()
+        self.exported = 0
+        self.skipped = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+        self._catch_up()
+
+    def _recover(self):
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path, "r", encoding="utf8") as f:
+                    state = json.load(f)
+                self._sequence = int(state["sequence"])
+                self._offsets = {name: list(entry) for name, entry in state["files"].items()}
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                # Без отметок все файлы выгружаются заново, поэтому ранее записанные Parquet файлы удаляются
+                logger.error(f"Can not read Parquet export state {self.state_path}: {type(e).__name__}: {e}. Export is started over.")
+                self._sequence, self._offsets = 0, {}
+        removed = 0
+        for file_path in Path(self.directory).rglob("part-*"):
+            sequence = _int_or_none(file_path.name[5:15])
+            if sequence is None or sequence > self._sequence or file_path.suffix == ".tmp":
+                file_path.unlink()
+                removed += 1
+        if removed:
+            logger.warning(f"Removed {removed} Parquet files of interrupted export in {self.directory}.")
+
+    def _add_line(self, name: str, number: int, line: bytes, start: int, end: int):
+        try:
+            record = _json_loads(line)
+            event = record["event"]
+            prefix = _event_time_prefix(event["occurred_at"])
+            occurred_at = _event_datetime(prefix)
+        except (ValueError, KeyError, TypeError):
+            self.skipped += 1
+            return
+        partition = f"date={prefix[0:10]}" if PARQUET_PARTITIONING == "day" else f"date={prefix[0:10]}/hour={prefix[11:13]}"
+        is_system = event.get("is_system")
+        self._pending.setdefault(partition, []).append((
+            occurred_at, _str_or_none(event.get("type")), _str_or_none(event.get("service")), _str_or_none(event.get("status")),
+            _int_or_none(event.get("uid")), _str_or_none(record.get("user_login")), _str_or_none(record.get("user_name")),
+            _str_or_none(event.get("ip")), is_system if isinstance(is_system, bool) else None, _int_or_none(event.get("org_id")),
+            _str_or_none(event.get("request_id")), _str_or_none(event.get("idempotency_id")), line.decode("utf8"),
+        ))
+        self._pending_rows += 1
+
+    def _chunk_read(self):
+        if self._pending_rows >= PARQUET_FILE_ROWS:
+            self._flush()
+
+    def _committed(self):
+        if self._pending_rows >= PARQUET_FILE_ROWS or time.monotonic() - self._last_flush >= PARQUET_FLUSH_INTERVAL_SEC:
+            self._flush()
+
+    def _flush(self):
+        # Все собранные строки записываются одним номером выгрузки, после чего сохраняются отметки прочитанных строк
+        if self._pending:
+            self._sequence += 1
+            written = []
+            try:
+                for partition, rows in self._pending.items():
+                    written.append(self._write_partition(partition, rows))
+            except Exception:
+                # Частично записанная выгрузка удаляется, строки будут записаны повторно тем же номером
+                for file_path in written:
+                    os.remove(file_path)
+                self._sequence -= 1
+                raise
+            self.exported += self._pending_rows
+            logger.debug(f"Exported {self._pending_rows} rows in {len(self._pending)} partitions to Parquet files #{self._sequence} in {self.directory}.")
+        state = {"sequence": self._sequence, "files": self._offsets}
+        _atomic_write(self.state_path, json.dumps(state).encode("utf8"))
+        self._pending = {}
+        self._pending_rows = 0
+        self._last_flush = time.monotonic()
+
+    def _write_partition(self, partition: str, rows: list):
+        rows.sort(key=lambda row: row[0])
+        table = self._pa.Table.from_arrays(
+            [self._pa.array(values, type=field.type) for values, field in zip(zip(*rows), self._schema)], schema=self._schema)
+        directory = os.path.join(self.directory, *partition.split("/"))
+        os.makedirs(directory, exist_ok=True)
+        file_path = os.path.join(directory, f"part-{self._sequence:010d}.parquet")
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, "wb") as f:
+            self._pa.parquet.write_table(table, f, row_group_size=PARQUET_ROW_GROUP_ROWS, compression=PARQUET_COMPRESSION)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+        _fsync_directory(file_path)
+        return file_path
+
+def _index_values(log_source: str, record: dict):
+    # Значения, по которым ищутся события: пользователь (логин, email или uid), тип события и IP - в нижнем регистре
+    if log_source == "all":
+        event = record.get("event") or {}
+        values = {"user": (record.get("user_login"), event.get("uid")), "type": (event.get("type"),), "ip": (event.get("ip"),)}
+    else:
+        values = {"user": (record.get("userLogin"), record.get("userUid")), "type": (record.get("eventType"),), "ip": (record.get("clientIp"),)}
+    return {field: {str(value).lower() for value in items if value not in (None, "")} for field, items in values.items()}
+
+def _index_key(field: str, value: str):
+    # В индексе хранится 64-битный хэш значения, совпадения хэшей отсекаются проверкой самих строк
+    return int.from_bytes(hashlib.blake2b(f"{field}:{value}".encode("utf8"), digest_size=8).digest(), "big", signed=True)
+
+def _query_index_path(settings: "SettingParams", log_source: str):
+    return os.path.join(settings.dir_paths[log_source], f"{settings.file_names[log_source]}{INDEX_FILE_SUFFIX}")
+
+class QueryIndex(_DayFileFollower):
+    """Sidecar SQLite index of day files of a log source for lookups by time range, user, event type and IP.
+
+    Lines are grouped into blocks: up to INDEX_BLOCK_BYTES of a plain file or whole members of a compressed one.
+    A block keeps its byte range, line numbers and time range of its events, postings map hashes of the values
+    to blocks. Blocks, postings and read positions are saved in one transaction. When a closed day is sealed,
+    byte ranges of its blocks are moved to the new members by line numbers, postings are kept.
+    """
+
+    kind = "index"
+
+    def __init__(self, settings: "SettingParams", log_source: str):
+        self.path = _query_index_path(settings, log_source)
+        super().__init__(settings, log_source, f"Query index {self.path}")
+        import sqlite3
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, offset INTEGER, lines INTEGER, inode INTEGER)")
+            # AUTOINCREMENT не даёт повторно использовать номера удалённых блоков, на которые ещё ссылаются старые записи postings
+            self._db.execute("CREATE TABLE IF NOT EXISTS blocks (id INTEGER PRIMARY KEY AUTOINCREMENT, file TEXT, start INTEGER, end INTEGER, "
+                             "first_line INTEGER, last_line INTEGER, min_time INTEGER, max_time INTEGER)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS blocks_time ON blocks (max_time, min_time)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS blocks_file ON blocks (file, first_line)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS postings (key INTEGER, block INTEGER, PRIMARY KEY (key, block)) WITHOUT ROWID")
+        self._offsets = {name: [offset, lines, inode] for name, offset, lines, inode in self._db.execute("SELECT name, offset, lines, inode FROM files")}
+        self._saved_offsets = {name: list(entry) for name, entry in self._offsets.items()}
+        # Открытый блок: [файл, начало, конец, первая строка, последняя строка, min время, max время, значения (ключи после закрытия)]
+        self._block = None
+        self._blocks = []
+        # Файл -> новые блоки сжатия [начало, конец, первая строка, последняя строка] пережатого файла
+        self._moved = {}
+        self._removed = set()
+        self._catch_up()
+
+    def close(self):
+        with self._lock:
+            super().close()
+            self._db.close()
+
+    def _add_line(self, name: str, number: int, line: bytes, start: int, end: int):
+        try:
+            record = _json_loads(line)
+            event_time = record["event"]["occurred_at"] if self.log_source == "all" else record["date"]
+            timestamp = int(_event_timestamp(event_time))
+            values = _index_values(self.log_source, record)
+        except (ValueError, KeyError, TypeError):
+            # Повреждённая строка не попадает в ключи и время блока, но остаётся внутри его диапазона байт
+            timestamp, values = None, {}
+        block = self._block
+        if block is None or block[0] != name or not (start == block[1] or (start == block[2] and block[2] - block[1] < INDEX_BLOCK_BYTES)):
+            self._close_block()
+            block = self._block = [name, start, end, number, number, timestamp, timestamp, set()]
+        block[2] = max(block[2], end)
+        block[4] = number
+        if timestamp is not None:
+            block[5] = timestamp if block[5] is None else min(block[5], timestamp)
+            block[6] = timestamp if block[6] is None else max(block[6], timestamp)
+        # Значения повторяются в строках блока, поэтому хэши считаются один раз при закрытии блока
+        for field, items in values.items():
+            block[7].update((field, value) for value in items)
+
+    def _skip_line(self, name: str, number: int, start: int, end: int):
+        members = self._moved.setdefault(name, [])
+        if members and members[-1][0] == start:
+            members[-1][3] = number
+        else:
+            members.append([start, end, number, number])
+
+    def _close_block(self):
+        if self._block is not None:
+            if self._block[5] is not None:
+                self._block[7] = {_index_key(field, value) for field, value in self._block[7]}
+                self._blocks.append(self._block)
+            self._block = None
+
+    def _file_replaced(self, name: str, lines: int):
+        self._close_block()
+        if _codec_of_file(name) is None:
+            self._file_removed(name)
+            return 0
+        # Пережатый файл содержит те же строки в том же порядке, меняются только позиции блоков сжатия
+        self._moved[name] = []
+        return lines
+
+    def _file_removed(self, name: str):
+        self._close_block()
+        self._blocks = [block for block in self._blocks if block[0] != name]
+        self._moved.pop(name, None)
+        self._removed.add(name)
+
+    def _file_merged(self, name: str):
+        # Строки объединённого файла сдвинуты, поэтому его блоки удаляются и файл индексируется заново
+        self._file_removed(name)
+        del self._offsets[name]
+
+    def _chunk_read(self):
+        if len(self._blocks) >= INDEX_FLUSH_BLOCKS:
+            self._flush()
+
+    def _committed(self):
+        self._flush()
+
+    def _flush(self):
+        self._close_block()
+        changed = [(name, *entry) for name, entry in self._offsets.items() if self._saved_offsets.get(name) != entry]
+        if not (self._blocks or self._moved or self._removed or changed):
+            return
+        with self._db:
+            for name in self._removed:
+                # Записи postings удалённых блоков остаются и не находят блоков при поиске
+                self._db.execute("DELETE FROM blocks WHERE file = ?", (name,))
+                self._db.execute("DELETE FROM files WHERE name = ?", (name,))
+            for name, members in self._moved.items():
+                for start, end, first_line, last_line in members:
+                    self._db.execute("UPDATE blocks SET start = ? WHERE file = ? AND first_line BETWEEN ? AND ?", (start, name, first_line, last_line))
+                    self._db.execute("UPDATE blocks SET end = ? WHERE file = ? AND last_line BETWEEN ? AND ?", (end, name, first_line, last_line))
+            for name, start, end, first_line, last_line, min_time, max_time, keys in self._blocks:
+                block_id = self._db.execute("INSERT INTO blocks (file, start, end, first_line, last_line, min_time, max_time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                            (name, start, end, first_line, last_line, min_time, max_time)).lastrowid
+                self._db.executemany("INSERT OR IGNORE INTO postings (key, block) VALUES (?, ?)", ((key, block_id) for key in keys))
+            self._db.executemany("INSERT OR REPLACE INTO files (name, offset, lines, inode) VALUES (?, ?, ?, ?)", changed)
+        logger.debug(f"Query index {self.path}: {len(self._blocks)} blocks added, {len(self._moved)} files moved, {len(self._removed)} files removed.")
+        self._saved_offsets = {name: list(entry) for name, entry in self._offsets.items()}
+        self._blocks, self._moved, self._removed = [], {}, set()
+
+class SinkError(Exception):
+    """Batch is not confirmed by the receiver and will be sent again (only lines, if the receiver confirmed the rest)."""
+
+    def __init__(self, message: str, lines: list = None):
+        super().__init__(message)
+        self.lines = lines
+
+
+def _line_key(line: bytes):
+    # Ключ записи у получателя совпадает с идентификатором события при дедупликации, поэтому повторная отправка не создаёт дублей
+    return hashlib.blake2b(line, digest_size=16).hexdigest()
+
+def _sink_display(url: str):
+    # Адрес получателя без имени пользователя и пароля - для журнала, метрик и файла состояния
+    parts = urlsplit(url)
+    host = parts.hostname or ""
+    if parts.port:
+        host = f"{host}:{parts.port}"
+    return urlunsplit((parts.scheme, host, parts.path, "", ""))
+
+def _sink_transport(url: str):
+    parts = urlsplit(url)
+    if not parts.hostname:
+        raise ValueError(f"no host in sink address {_sink_display(url)}")
+    if parts.scheme in ("syslog", "syslog+tls"):
+        return _SyslogTransport(parts)
+    if parts.scheme in ("http", "https"):
+        return _HttpBulkTransport(parts)
+    if parts.scheme in ("kafka+http", "kafka+https") and parts.path.strip("/"):
+        return _KafkaRestTransport(parts)
+    raise ValueError(f"unsupported sink address {_sink_display(url)}, use syslog://, syslog+tls://, http(s):// or kafka+http(s)://topic")
+
+class _SyslogTransport:
+    """Syslog over TCP: RFC 5424 messages with octet counting framing (RFC 6587), syslog+tls:// - over TLS.
+
+    TCP syslog has no acknowledgements, so a batch is confirmed once it is written to the socket.
+    """
+
+    def __init__(self, parts):
+        self.address = (parts.hostname, parts.port or (6514 if parts.scheme == "syslog+tls" else 514))
+        self.tls = parts.scheme == "syslog+tls"
+        import socket
+        self.hostname = socket.gethostname() or "-"
+        self._socket = None
+
+    def send(self, log_source: str, lines: list):
+        frames = []
+        for line in lines:
+            try:
+                timestamp = f"{_event_time_prefix(_event_time_of_line(log_source, line))[:26]}Z"
+            except (ValueError, KeyError, TypeError):
+                timestamp = "-"
+            # local0.info, имя приложения y360-audit, MSGID - источник логов
+            message = f"<134>1 {timestamp} {self.hostname} y360-audit - {log_source} - ".encode("utf8") + line
+            frames.append(f"{len(message)} ".encode("ascii") + message)
+        if self._socket is not None and self._closed_by_peer():
+            self.close()
+        if self._socket is None:
+            import socket
+            import ssl
+            self._socket = socket.create_connection(self.address, timeout=HTTP_CONNECT_TIMEOUT_SEC)
+            if self.tls:
+                self._socket = ssl.create_default_context().wrap_socket(self._socket, server_hostname=self.address[0])
+            self._socket.settimeout(HTTP_READ_TIMEOUT_SEC)
+        try:
+            self._socket.sendall(b"".join(frames))
+        except OSError:
+            self.close()
+            raise
+        return 0
+
+    def _closed_by_peer(self):
+        # Получатель syslog ничего не присылает: пустой ответ на чтение без ожидания означает закрытое соединение
+        import select
+        import ssl
+        readable, _, _ = select.select([self._socket], [], [], 0)
+        if not readable:
+            return False
+        self._socket.setblocking(False)
+        try:
+            return not self._socket.recv(4096)
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return False
+        except OSError:
+            return True
+        finally:
+            self._socket.settimeout(HTTP_READ_TIMEOUT_SEC)
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            finally:
+                self._socket = None
+
+class _HttpBulkTransport:
+    """Batches sent by HTTP POST: Elasticsearch/OpenSearch _bulk (URL path ends with /_bulk), Splunk HEC
+    (path contains /services/collector) or NDJSON lines to any other URL.
+
+    User and password of the URL are sent as Basic authorization (the password is the token for Splunk HEC).
+    Documents are created in Elasticsearch with the event key as _id, so a resent batch does not make duplicates.
+    """
+
+    def __init__(self, parts):
+        self.url = urlunsplit(parts)
+        path = parts.path.rstrip("/")
+        self.format = "bulk" if path.endswith("/_bulk") else "hec" if "/services/collector" in path else "ndjson"
+        self.session = _import_requests().Session()
+
+    def send(self, log_source: str, lines: list):
+        if self.format == "bulk":
+            body = b"".join(b'{"create":{"_id":"%s"}}\n%s\n' % (_line_key(line).encode("ascii"), line) for line in lines)
+        elif self.format == "hec":
+            body = b"".join(self._hec_event(log_source, line) for line in lines)
+        else:
+            body = b"".join(line + b"\n" for line in lines)
+        result = self._post(body, "application/x-ndjson" if self.format != "hec" else "application/json")
+        if self.format != "bulk" or not result.get("errors"):
+            return 0
+        rejected, retry, reason = 0, [], None
+        for line, item in zip(lines, result.get("items") or []):
+            answer = next(iter(item.values()), {})
+            status = answer.get("status", 0)
+            if status == HTTPStatus.TOO_MANY_REQUESTS.value or status >= 500:
+                # Повторно отправляются только непринятые документы, уже созданные при повторе ответят 409
+                retry.append(line)
+            elif status >= 400 and status != HTTPStatus.CONFLICT.value:
+                rejected += 1
+                reason = reason or answer.get("error")
+        if rejected:
+            logger.debug(f"Bulk request to {_sink_display(self.url)}: {rejected} documents rejected, first error: {reason}")
+        if retry:
+            raise SinkError(f"{len(retry)} of {len(lines)} documents are not accepted", retry)
+        return rejected
+
+    def _hec_event(self, log_source: str, line: bytes):
+        try:
+            moment = b'"time":%.6f,' % _event_datetime(_event_time_of_line(log_source, line)).timestamp()
+        except (ValueError, KeyError, TypeError):
+            moment = b""
+        return b'{%s"sourcetype":"yandex360:audit:%s","event":%s}' % (moment, log_source.encode("ascii"), line)
+
+    def _post(self, body: bytes, content_type: str, accept: str = "application/json"):
+        response = self.session.post(self.url, data=body, headers={"Content-Type": content_type, "Accept": accept},
+                                     timeout=(HTTP_CONNECT_TIMEOUT_SEC, HTTP_READ_TIMEOUT_SEC))
+        if response.status_code >= 300:
+            raise SinkError(f"HTTP {response.status_code}: {response.text[:200]}")
+        if not response.content:
+            return {}
+        result = _json_loads(response.content)
+        return result if isinstance(result, dict) else {}
+
+    def close(self):
+        self.session.close()
+
+class _KafkaRestTransport(_HttpBulkTransport):
+    """Kafka producer through the REST Proxy API v2 (Confluent REST Proxy, Redpanda HTTP Proxy).
+
+    kafka+http://host:8082/topic sends records to the topic, the record key is the event key, so a resent
+    record can be removed by log compaction or by consumers.
+    """
+
+    def __init__(self, parts):
+        scheme = parts.scheme.split("+", 1)[1]
+        super().__init__(parts._replace(scheme=scheme, path=f"/topics/{quote(parts.path.strip('/'))}", query="", fragment=""))
+
+    def send(self, log_source: str, lines: list):
+        body = b'{"records":[' + b",".join(b'{"key":"%s","value":%s}' % (_line_key(line).encode("ascii"), line) for line in lines) + b"]}"
+        result = self._post(body, "application/vnd.kafka.json.v2+json", "application/vnd.kafka.v2+json")
+        failed = [offset for offset in result.get("offsets") or [] if offset.get("error_code")]
+        if failed:
+            raise SinkError(f"{len(failed)} records are not written: {failed[0].get('error')}")
+        return 0
+
+class DeliverySink(_DayFileFollower):
+    """Delivery of lines appended to the day files of a log source to an external receiver (SIEM, Kafka).
+
+    Lines are grouped into batches of up to SINK_BATCH_RECORDS records (SINK_BATCH_BYTES bytes) and sent by
+    a separate thread from a queue of SINK_QUEUE_BATCHES batches. When the queue is full, reading stops and
+    the lines wait in the day files, which serve as the spill buffer; with more than SINK_MAX_BACKLOG_MB waiting,
+    commits of downloaded windows wait for the receiver. Read positions are saved only after the receiver
+    confirms a batch, so unconfirmed lines are sent again after a restart (at least once delivery).
+    """
+
+    kind = "sink"
+
+    def __init__(self, settings: "SettingParams", log_source: str, url: str):
+        self.name = _sink_display(url)
+        super().__init__(settings, log_source, f"Delivery of {log_source} logs to {self.name}")
+        self.transport = _sink_transport(url)
+        key = hashlib.blake2b(self.name.encode("utf8"), digest_size=4).hexdigest()
+        self.state_path = os.path.join(settings.dir_paths[log_source], f"{settings.file_names[log_source]}.{key}{SINK_STATE_SUFFIX}")
+        # Открытый пакет: [строки, размер в байтах, позиции файлов после его строк {имя: [смещение, строки, inode]}]
+        self._batch = None
+        self._queue = queue.Queue()
+        self._reading = None
+        self._compressed = False
+        self._inode = None
+        self._lagging = set()
+        # Подтверждённые получателем позиции, сохраняются в файл состояния
+        self._acked = {}
+        self._acked_changed = threading.Condition()
+        self._queued_bytes = 0
+        self._delivered_time = None
+        self._last_save = time.monotonic()
+        self._sender = None
+        self._closing = False
+        self._stop = threading.Event()
+        self._history = False
+        self.sent = 0
+        self.rejected = 0
+        self._recover()
+        self._catch_up()
+        self._history = False
+
+    def _recover(self):
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path, "r", encoding="utf8") as f:
+                    state = json.load(f)
+                self._offsets = {name: list(entry) for name, entry in state["files"].items()}
+            except (OSError, ValueError, TypeError, KeyError) as e:
+                # Без отметок записи отправляются заново: получатель может получить дубли, но не потеряет записи
+                logger.error(f"Can not read delivery state {self.state_path}: {type(e).__name__}: {e}. Delivery is started over.")
+                self._offsets = {}
+        else:
+            # Уже сохранённые записи только пересчитываются, отправляются записи, добавленные после включения
+            self._history = not SINK_SEND_HISTORY
+        self._acked = {name: list(entry) for name, entry in self._offsets.items()}
+
+    def export(self, file_paths):
+        with self._lock:
+            self._start_sender()
+            directory = self.settings.dir_paths[self.log_source]
+            super().export(set(file_paths) | {os.path.join(directory, name) for name in self._lagging})
+            if not self._closing:
+                # Обратное давление: загрузка не уходит от получателя дальше, чем на SINK_MAX_BACKLOG_MB
+                self._wait_backlog(SINK_MAX_BACKLOG_MB * 1024 * 1024)
+
+    def close(self):
+        with self._lock:
+            self._closing = True
+            self._start_sender()
+            self.export(self.take_touched())
+            # Перед завершением получателю отправляется всё, что он успеет подтвердить за SINK_CLOSE_TIMEOUT_SEC
+            delivered = self._wait_backlog(0, SINK_CLOSE_TIMEOUT_SEC)
+        self._queue.put(None)
+        self._sender.join(SINK_CLOSE_TIMEOUT_SEC if delivered else 0)
+        if self._sender.is_alive():
+            self._stop.set()
+            logger.warning(f"{self.description}: {self.backlog_bytes() / 1024 / 1024:.1f} MB are not confirmed in {SINK_CLOSE_TIMEOUT_SEC} sec, "
+                           f"they will be sent after restart.")
+        else:
+            self.transport.close()
+        try:
+            self._flush()
+        except Exception as e:
+            logger.error(f"{self.description} failed: {type(e).__name__}: {e}")
+        logger.info(f"{self.description}: {self.sent} records delivered, {self.rejected} rejected.")
+
+    def backlog_bytes(self):
+        """Size of queued lines and of lines waiting in the day files (compressed size for compressed files)."""
+        with self._acked_changed:
+            queued = self._queued_bytes
+        waiting = 0
+        for name in list(self._lagging):
+            try:
+                size = os.path.getsize(os.path.join(self.settings.dir_paths[self.log_source], name))
+            except OSError:
+                continue
+            waiting += max(size - self._offsets.get(name, (0,))[0], 0)
+        return queued + waiting
+
+    def _start_sender(self):
+        # Поток отправки запускается при первой фиксации, чтобы журнал и метрики содержали организацию
+        if self._sender is not None:
+            return
+        labels = _metric_labels(self.log_source, sink=self.name)
+        metrics.set("audit_sink_backlog_bytes", labels, self.backlog_bytes)
+        metrics.set("audit_sink_lag_seconds", labels, self._delivery_lag)
+        self._sender = threading.Thread(target=contextvars.copy_context().run, args=(self._send_loop, labels),
+                                        name=f"sink_{self.log_source}", daemon=True)
+        self._sender.start()
+
+    def _delivery_lag(self):
+        if self._delivered_time is None:
+            return None
+        date_now = datetime.now() - timedelta(hours=self.settings.timezone_shift)
+        return round((date_now - self._delivered_time).total_seconds(), 3)
+
+    def _wait_backlog(self, limit: int, timeout: float = None):
+        # Пока ожидается получатель, записи из файлов дней дочитываются по мере освобождения очереди
+        started = reported = time.monotonic()
+        while self._sender.is_alive() and (timeout is None or time.monotonic() - started < timeout):
+            with self._acked_changed:
+                if self.backlog_bytes() <= limit:
+                    return True
+                self._acked_changed.wait(1)
+            if self._lagging and not self._paused():
+                self._read_lagging()
+            if time.monotonic() - reported >= 60:
+                reported = time.monotonic()
+                logger.warning(f"{self.description} is behind by {self.backlog_bytes() / 1024 / 1024:.1f} MB, "
+                               f"waiting for {reported - started:.0f} sec.")
+        return False
+
+    def _read_lagging(self):
+        for name in sorted(self._lagging):
+            self._read_day_file(name)
+        self._enqueue()
+
+    def _read_day_file(self, name: str):
+        if self._paused():
+            self._lagging.add(name)
+            return
+        self._reading = name
+        self._compressed = _codec_of_file(name) is not None
+        self._inode = self._inode_of(name)
+        super()._read_day_file(name)
+        if self._paused():
+            self._lagging.add(name)
+        else:
+            self._lagging.discard(name)
+
+    def _add_line(self, name: str, number: int, line: bytes, start: int, end: int):
+        if self._history:
+            return
+        if self._batch is None:
+            self._batch = [[], 0, {}]
+        batch = self._batch
+        batch[0].append(line)
+        batch[1] += len(line) + 1
+        if not self._compressed:
+            # Конец строки обычного файла - позиция, с которой можно продолжить чтение
+            batch[2][name] = [end, number, self._inode]
+        if len(batch[0]) >= SINK_BATCH_RECORDS or batch[1] >= SINK_BATCH_BYTES:
+            self._enqueue()
+
+    def _chunk_read(self):
+        # Сжатый файл можно продолжить читать только с границы блока сжатия, поэтому позиция добавляется после блока
+        if not self._history:
+            if self._batch is None:
+                self._batch = [[], 0, {}]
+            self._batch[2][self._reading] = list(self._offsets[self._reading])
+
+    def _paused(self):
+        return not self._history and self._queue.qsize() >= SINK_QUEUE_BATCHES
+
+    def _committed(self):
+        self._enqueue()
+
+    def caught_up(self, names: list):
+        # Позиции можно перенести только после подтверждения получателем всех строк файлов
+        with self._lock:
+            with self._acked_changed:
+                acked = all(self._acked.get(name) == self._offsets.get(name) for name in names)
+            return acked and not self._lagging.intersection(names) and super().caught_up(names)
+
+    def _file_removed(self, name: str):
+        self._lagging.discard(name)
+        with self._acked_changed:
+            self._acked.pop(name, None)
+
+    def _file_merged(self, name: str):
+        with self._acked_changed:
+            self._acked[name] = list(self._offsets[name])
+
+    def _enqueue(self):
+        batch, self._batch = self._batch, None
+        if batch is None:
+            return
+        with self._acked_changed:
+            self._queued_bytes += batch[1]
+        self._queue.put(batch)
+
+    def _flush(self):
+        with self._acked_changed:
+            if self._history:
+                # Уже сохранённые записи не отправляются: прочитанные позиции сразу считаются подтверждёнными
+                self._acked = {name: list(entry) for name, entry in self._offsets.items()}
+            state = {"url": self.name, "files": self._acked}
+            _atomic_write(self.state_path, json.dumps(state).encode("utf8"))
+            self._last_save = time.monotonic()
+
+    def _send_loop(self, labels: dict):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            lines, size, positions = batch
+            if lines and not self._send(lines, labels):
+                return
+            delivered_time = None
+            if lines:
+                try:
+                    delivered_time = _event_datetime(_event_time_of_line(self.log_source, lines[-1])).replace(tzinfo=None)
+                except (ValueError, KeyError, TypeError):
+                    pass
+            with self._acked_changed:
+                self._acked.update(positions)
+                self._queued_bytes -= size
+                self._delivered_time = delivered_time or self._delivered_time
+                self._acked_changed.notify_all()
+                try:
+                    # Позиции сохраняются не чаще раза в секунду: после сбоя будет повторно отправлено не больше секунды записей
+                    if time.monotonic() - self._last_save >= 1 or self._queue.empty():
+                        self._flush()
+                except OSError as e:
+                    logger.error(f"Can not save delivery state {self.state_path}: {type(e).__name__}: {e}")
+            if self._lagging and self._queue.empty() and not self._closing and self._lock.acquire(blocking=False):
+                # Записи, ожидающие в файлах дней, дочитываются сразу, когда получатель освободил очередь
+                try:
+                    self._read_lagging()
+                except Exception as e:
+                    logger.error(f"{self.description} failed: {type(e).__name__}: {e}")
+                finally:
+                    self._lock.release()
+
+    def _send(self, lines: list, labels: dict):
+        attempt = 0
+        while not self._stop.is_set():
+            started = time.perf_counter()
+            try:
+                rejected = self.transport.send(self.log_source, lines)
+            # Ошибки requests - подклассы OSError
+            except (SinkError, OSError, ValueError) as e:
+                metrics.observe("audit_sink_send_seconds", labels, time.perf_counter() - started)
+                metrics.inc("audit_sink_batches_total", {**labels, "result": "error"})
+                if isinstance(e, SinkError) and e.lines is not None:
+                    # Получатель принял часть пакета: подтверждённые записи не отправляются повторно
+                    self._confirmed(labels, len(lines) - len(e.lines), 0)
+                    lines = e.lines
+                delay = _backoff_delay(attempt)
+                attempt += 1
+                logger.error(f"{self.description}: batch of {len(lines)} records is not confirmed: {type(e).__name__}: {e}. Retrying in {delay:.1f} sec.")
+                self._stop.wait(delay)
+                continue
+            metrics.observe("audit_sink_send_seconds", labels, time.perf_counter() - started)
+            metrics.inc("audit_sink_batches_total", {**labels, "result": "ok"})
+            self._confirmed(labels, len(lines) - rejected, rejected)
+            if rejected:
+                # Отклонённые получателем записи (ошибка формата) не будут приняты и при повторе
+                logger.error(f"{self.description}: {rejected} of {len(lines)} records are rejected by the receiver and skipped.")
+            return True
+        return False
+
+    def _confirmed(self, labels: dict, sent: int, rejected: int):
+        metrics.inc("audit_sink_records_total", labels, sent)
+        if rejected:
+            metrics.inc("audit_sink_rejected_total", labels, rejected)
+        self.sent += sent
+        self.rejected += rejected
+
+def _parse_query_time(value: str):
+    # Время запроса в UTC: YYYY-MM-DD или YYYY-MM-DDTHH:MM[:SS]
+    moment = datetime.fromisoformat(value.rstrip("Z"))
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment.astimezone(timezone.utc)
+
+def _query_match(log_source: str, line: bytes, started_at: datetime, ended_at: datetime, criteria: dict):
+    if criteria:
+        # Строка без искомых значений отбрасывается без разбора JSON
+        text = line.decode("utf8").lower()
+        if not all(value in text for value in criteria.values()):
+            return False
+    try:
+        record = _json_loads(line)
+        moment = _event_datetime(record["event"]["occurred_at"] if log_source == "all" else record["date"])
+    except (ValueError, KeyError, TypeError):
+        return False
+    if (started_at is not None and moment < started_at) or (ended_at is not None and moment > ended_at):
+        return False
+    values = _index_values(log_source, record)
+    return all(value in values[field] for field, value in criteria.items())
+
+def query_audit_logs(settings: "SettingParams", log_source: str, started_at: datetime = None, ended_at: datetime = None,
+                     user: str = None, event_type: str = None, ip: str = None):
+    """Yield saved lines of the log source with event time in [started_at, ended_at] (UTC) and the given values.
+
+    Only blocks selected by the query index are read; lines appended after the indexed positions and day files
+    changed after indexing are scanned. Without the index all day files of the time range are scanned.
+    """
+    criteria = {field: value.lower() for field, value in (("user", user), ("type", event_type), ("ip", ip)) if value}
+    names = []
+    for name in sorted(_log_file_names(settings, log_source) + _late_run_names(settings, log_source)):
+        # Файлы дней и их прогоны запоздавших событий названы по дате события, поэтому файлы вне интервала не читаются
+        date = re.search(r"_([0-9]{4}-[0-9]{2}-[0-9]{2})\.", name).group(1)
+        if (started_at is None or date >= started_at.strftime("%Y-%m-%d")) and (ended_at is None or date <= ended_at.strftime("%Y-%m-%d")):
+            names.append(name)
+    index_path = _query_index_path(settings, log_source)
+    indexed, blocks = {}, {}
+    if os.path.exists(index_path):
+        import sqlite3
+        db = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+        try:
+            indexed = {name: (offset, inode) for name, offset, inode in db.execute("SELECT name, offset, inode FROM files")}
+            sql = "SELECT file, start, end FROM blocks WHERE max_time >= ? AND min_time <= ?"
+            params = [int(started_at.timestamp()) if started_at else -2 ** 62, int(ended_at.timestamp()) if ended_at else 2 ** 62]
+            for field, value in criteria.items():
+                sql += " AND id IN (SELECT block FROM postings WHERE key = ?)"
+                params.append(_index_key(field, value))
+            for name, start, end in db.execute(sql + " ORDER BY file, start", params):
+                ranges = blocks.setdefault(name, [])
+                # Блоки пережатого файла могут попасть в один блок сжатия - пересекающиеся диапазоны объединяются
+                if ranges and start <= ranges[-1][1]:
+                    ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+                else:
+                    ranges.append((start, end))
+        finally:
+            db.close()
+    else:
+        logger.warning(f"Query index {index_path} does not exist, all day files of the time range are scanned.")
+    for name in names:
+        file_path = os.path.join(settings.dir_paths[log_source], name)
+        codec = _codec_of_file(file_path)
+        with open(file_path, "rb") as f:
+            entry = indexed.get(name)
+            if entry is None or os.fstat(f.fileno()).st_ino != entry[1]:
+                ranges, offset = [], 0
+            else:
+                ranges, offset = blocks.get(name, []), entry[0]
+            for start, end in ranges:
+                f.seek(start)
+                data = f.read(end - start)
+                if codec is not None:
+                    data, _ = _decompress_members(data, codec)
+                for line in data.split(b"\n"):
+                    if line and _query_match(log_source, line, started_at, ended_at, criteria):
+                        yield line.decode("utf8")
+            for data, _, _ in _iter_appended_data(f, offset, codec):
+                for line in data.split(b"\n"):
+                    if line and _query_match(log_source, line, started_at, ended_at, criteria):
+                        yield line.decode("utf8")
+
+def query_main(argv: list):
+    """Command "query": print saved audit log records found by the query index, one JSON line per record."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="run_import.py query", description="Search saved audit logs by time range, user, event type and IP.")
+    parser.add_argument("--source", choices=("mail", "all"), default="all", help="log source")
+    parser.add_argument("--from", dest="started_at", type=_parse_query_time, help="start of time range, UTC (YYYY-MM-DD[THH:MM:SS])")
+    parser.add_argument("--to", dest="ended_at", type=_parse_query_time, help="end of time range, UTC (inclusive)")
+    parser.add_argument("--user", help="user login, email or uid")
+    parser.add_argument("--type", dest="event_type", help="event type")
+    parser.add_argument("--ip", help="client IP address")
+    parser.add_argument("--limit", type=int, default=0, help="maximum number of records (0 - no limit)")
+    parser.add_argument("--organization", help="ORGANIZATION_NAME from ORGANIZATIONS_CONFIG_FILE")
+    args = parser.parse_args(argv)
+
+    settings = _command_settings(args.organization)
+    if settings is None:
+        return EXIT_CODE
+    started = time.perf_counter()
+    count = 0
+    for line in query_audit_logs(settings, args.source, args.started_at, args.ended_at, args.user, args.event_type, args.ip):
+        print(line)
+        count += 1
+        if count == args.limit:
+            break
+    logger.info(f"Found {count} records of {args.source} audit logs in {time.perf_counter() - started:.3f} sec.")
+    return 0
+
+def _command_settings(organization: str = None):
+    # Настройки организации для служебных команд; без имени - первая организация
+    settings_list = _command_settings_list(organization)
+    return settings_list[0] if settings_list else None
+
+def _command_settings_list(organization: str = None):
+    # Настройки организации с заданным именем или всех организаций
+    settings_list = get_organizations_settings()
+    if settings_list is None:
+        logger.error("Settings are not set.")
+        return None
+    selected = [item for item in settings_list if organization in (None, item.name)]
+    if not selected:
+        logger.error(f"Organization {organization} is not found in settings.")
+        return None
+    return selected
+
+def _compaction_key(log_source: str, line: bytes):
+    # Ключ _event_sort_key строки; None - строка не разбирается
+    try:
+        return _event_sort_key(_event_time_of_line(log_source, line)).encode("ascii", "replace")
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def _write_compaction_run(file_path: str, part: list):
+    with open(file_path, "wb", buffering=1024 * 1024) as f:
+        for key, line in part:
+            f.write(key + b"\t" + line + b"\n")
+    return file_path
+
+def _iter_compaction_run(file_path: str):
+    with open(file_path, "rb", buffering=1024 * 1024) as f:
+        for row in f:
+            key, _, line = row[:-1].partition(b"\t")
+            yield key, line
+
+def _write_sorted_lines(temp_path: str, merged, codec):
+    """Write (key, line) pairs coming in key order to a new file, skipping repeated lines of the same key.
+
+    Data is written by members of SEAL_MEMBER_BYTES uncompressed bytes and fsynced.
+    Returns written, duplicates, new_size and new_inode.
+    """
+    result = {"written": 0, "duplicates": 0}
+    with open(temp_path, "wb") as dst:
+        pending, group_key, group = bytearray(), None, set()
+        for key, line in merged:
+            if key != group_key:
+                group_key, group = key, set()
+            if line in group:
+                result["duplicates"] += 1
+                continue
+            group.add(line)
+            result["written"] += 1
+            pending += line
+            pending += b"\n"
+            if len(pending) >= SEAL_MEMBER_BYTES:
+                dst.write(bytes(pending) if codec is None else codec.compress(bytes(pending)))
+                pending.clear()
+        if pending:
+            dst.write(bytes(pending) if codec is None else codec.compress(bytes(pending)))
+        dst.flush()
+        os.fsync(dst.fileno())
+        result["new_size"] = dst.tell()
+        result["new_inode"] = os.fstat(dst.fileno()).st_ino
+    return result
+
+def _iter_keyed_lines(file_path: str, log_source: str, chunk_size: int = 256 * 1024):
+    # Строки файла с ключами _compaction_key; строка, которая не разбирается, получает ключ предыдущей.
+    # Каждый вход держит в памяти один небольшой блок, поэтому память не зависит от числа и размера файлов
+    codec = _codec_of_file(file_path)
+    previous = b""
+    with open(file_path, "rb") as f:
+        for data, _, _ in _iter_appended_data(f, 0, codec, chunk_size):
+            for line in data.split(b"\n"):
+                if line:
+                    previous = _compaction_key(log_source, line) or previous
+                    yield previous, line
+
+def _merge_late_runs(file_path: str, log_source: str, run_paths: list, temp_path: str, codec):
+    """Merge the sorted day file and its sorted late runs into temp_path by a streaming k-way merge.
+
+    Every input is read sequentially and the output is written by members, so memory does not depend on the
+    size of the day. Lines of equal time keep the order of the inputs (the day file first), repeated lines are
+    written once. Returns written, duplicates, new_size and new_inode.
+    """
+    merged = heapq.merge(*(_iter_keyed_lines(path, log_source) for path in [file_path] + run_paths), key=lambda item: item[0])
+    try:
+        return _write_sorted_lines(temp_path, merged, codec)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def _compact_day_file(file_path: str, log_source: str, memory_bytes: int):
+    """Write lines of a day file sorted by event time and without repeated lines to <file><COMPACT_TEMP_SUFFIX>.
+
+    Runs in a worker process. Lines are sorted by parts of about memory_bytes; if the file does not fit,
+    sorted parts are saved to run files and merged. Lines of equal time keep their order, a line that can
+    not be parsed stays after its preceding line. The day file itself is not changed. Returns statistics
+    of the file; "temp_path" is None if the file is already sorted and has no duplicates.
+    """
+    started = time.perf_counter()
+    codec = _codec_of_file(file_path)
+    temp_path = f"{file_path}{COMPACT_TEMP_SUFFIX}"
+    stat = os.stat(file_path)
+    result = {"file_path": file_path, "temp_path": None, "size": stat.st_size, "inode": stat.st_ino, "mtime": stat.st_mtime_ns,
+              "lines": 0, "written": 0, "duplicates": 0, "out_of_order": 0, "unparsed": 0, "bytes": 0, "complete": True}
+    runs, part, part_bytes = [], [], 0
+    previous, group, end = b"", set(), 0
+    try:
+        with open(file_path, "rb") as f:
+            for data, _, end in _iter_appended_data(f, 0, codec):
+                for line in data.split(b"\n"):
+                    if not line:
+                        continue
+                    result["lines"] += 1
+                    result["bytes"] += len(line) + 1
+                    key = _compaction_key(log_source, line)
+                    if key is None:
+                        result["unparsed"] += 1
+                        key = previous
+                    elif key < previous:
+                        result["out_of_order"] += 1
+                    elif key > previous:
+                        previous, group = key, set()
+                    # Пока строки идут по порядку, повторы находятся среди строк с тем же временем ещё при чтении
+                    if not result["out_of_order"]:
+                        if line in group:
+                            result["duplicates"] += 1
+                        group.add(line)
+                    part.append((key, line))
+                    # Кортеж и две строки bytes занимают около 150 байт сверх длины строки
+                    part_bytes += len(line) + 150
+                    if part_bytes >= memory_bytes:
+                        part.sort(key=lambda item: item[0])
+                        runs.append(_write_compaction_run(f"{temp_path}-{len(runs)}", part))
+                        part, part_bytes = [], 0
+        group = None
+        if end != stat.st_size:
+            # Недописанный при сбое конец файла восстанавливает загрузка, такой файл не изменяется
+            result["complete"] = False
+        elif result["out_of_order"] or result["duplicates"]:
+            part.sort(key=lambda item: item[0])
+            merged = heapq.merge(*(_iter_compaction_run(run) for run in runs), part, key=lambda item: item[0]) if runs else part
+            result.update(_write_sorted_lines(temp_path, merged, codec))
+            result["temp_path"] = temp_path
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        for run in runs:
+            os.remove(run)
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+def _follower_states(settings: "SettingParams", log_source: str):
+    # Файлы состояния выгрузки в Parquet и получателей с позициями чтения файлов дней
+    paths = [str(path) for path in Path(settings.dir_paths[log_source]).glob(f"{settings.file_names[log_source]}.*{SINK_STATE_SUFFIX}")]
+    if log_source == "all" and settings.parquet_dir is not None:
+        paths.append(os.path.join(settings.parquet_dir, PARQUET_STATE_FILE))
+    states = {}
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf8") as f:
+                states[path] = json.load(f)
+    return states
+
+def _replace_compacted_file(settings: "SettingParams", log_source: str, result: dict):
+    """Replace a day file by its compacted copy, moving read positions of the followers to its end.
+
+    Positions are moved before the replacement: after a failure between the two steps the followers treat
+    the old file as replaced and process its last lines again, but do not lose lines. Returns False if
+    the file was changed during compaction or a follower has not read it completely.
+    """
+    file_path, name = result["file_path"], os.path.basename(result["file_path"])
+    stat = os.stat(file_path)
+    if (stat.st_size, stat.st_ino, stat.st_mtime_ns) != (result["size"], result["inode"], result["mtime"]):
+        logger.warning(f"Day file {file_path} was changed during compaction and is left as is.")
+        return False
+    states = _follower_states(settings, log_source)
+    for path, state in states.items():
+        entry = state["files"].get(name)
+        if entry is not None and (entry[0], entry[2]) != (result["size"], result["inode"]):
+            logger.warning(f"Day file {file_path} is not completely read by {path} and is left as is. Start the download to catch up.")
+            return False
+    for path, state in states.items():
+        if name in state["files"]:
+            state["files"][name] = [result["new_size"], result["written"], result["new_inode"]]
+            _atomic_write(path, json.dumps(state).encode("utf8"))
+    index_path = _query_index_path(settings, log_source)
+    if os.path.exists(index_path):
+        # Блоки файла удаляются, файл заново индексируется при следующем запуске загрузки (до этого поиск просматривает его целиком)
+        import sqlite3
+        db = sqlite3.connect(index_path)
+        try:
+            with db:
+                db.execute("DELETE FROM blocks WHERE file = ?", (name,))
+                db.execute("DELETE FROM files WHERE name = ?", (name,))
+        finally:
+            db.close()
+    os.replace(result["temp_path"], file_path)
+    _fsync_directory(file_path)
+    return True
+
+def compact_log_files(settings: "SettingParams", log_source: str, workers: int = COMPACT_WORKERS, memory_mb: int = COMPACT_MEMORY_MB,
+                      started_at: str = None, ended_at: str = None):
+    """Sort day files of the log source by event time and remove repeated lines, one file per worker process.
+
+    The newest day file is not compacted: it is still being written. Files are replaced atomically only if
+    they were not changed during compaction. Returns totals: files, rewritten, skipped, lines, bytes,
+    duplicates, out_of_order and seconds.
+    """
+    started = time.perf_counter()
+    directory = settings.dir_paths[log_source]
+    base_name = settings.file_names[log_source]
+    for path in Path(directory).glob(f"{base_name}_*{COMPACT_TEMP_SUFFIX}*"):
+        # Временные файлы прерванной команды
+        path.unlink()
+    names = []
+    for name in sorted(_log_file_names(settings, log_source))[:-1]:
+        date = re.search(r"_([0-9]{4}-[0-9]{2}-[0-9]{2})\.", name).group(1)
+        if (started_at is None or date >= started_at) and (ended_at is None or date <= ended_at):
+            names.append(name)
+    # Большие файлы запускаются первыми, чтобы процессы закончили работу примерно одновременно
+    file_paths = sorted((os.path.join(directory, name) for name in names), key=os.path.getsize, reverse=True)
+    totals = {"files": len(file_paths), "rewritten": 0, "skipped": 0, "lines": 0, "bytes": 0, "duplicates": 0, "out_of_order": 0}
+    workers = workers or os.cpu_count() or 1
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(workers, max(len(file_paths), 1))) as executor:
+        futures = [executor.submit(_compact_day_file, file_path, log_source, memory_mb * 1024 * 1024) for file_path in file_paths]
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Compaction of {log_source} day file failed: {type(e).__name__}: {e}")
+                totals["skipped"] += 1
+                continue
+            totals["lines"] += result["lines"]
+            totals["bytes"] += result["bytes"]
+            if not result["complete"]:
+                logger.warning(f"Day file {result['file_path']} ends with incomplete record and is left as is.")
+                totals["skipped"] += 1
+            elif result["temp_path"] is not None:
+                try:
+                    replaced = _replace_compacted_file(settings, log_source, result)
+                except Exception as e:
+                    logger.error(f"Replacing of day file {result['file_path']} failed: {type(e).__name__}: {e}")
+                    replaced = False
+                if replaced:
+                    totals["rewritten"] += 1
+                    totals["duplicates"] += result["duplicates"]
+                    totals["out_of_order"] += result["out_of_order"]
+                else:
+                    totals["skipped"] += 1
+                    if os.path.exists(result["temp_path"]):
+                        os.remove(result["temp_path"])
+            logger.debug(f"Day file {result['file_path']}: {result['lines']} lines, {result['duplicates']} duplicates, "
+                         f"{result['out_of_order']} out of order, {result['unparsed']} unparsed ({result['seconds']:.1f} sec).")
+    totals["seconds"] = time.perf_counter() - started
+    return totals
+
+def compact_main(argv: list):
+    """Command "compact": sort saved day files by event time and remove duplicates. The download must be stopped."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="run_import.py compact", description="Sort saved audit day files by event time and remove duplicate records.")
+    parser.add_argument("--source", choices=("mail", "all"), help="log source (default - all sources of LOGS_SOURCES)")
+    parser.add_argument("--from", dest="started_at", type=lambda value: datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d"), help="first day, YYYY-MM-DD")
+    parser.add_argument("--to", dest="ended_at", type=lambda value: datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d"), help="last day, YYYY-MM-DD")
+    parser.add_argument("--workers", type=int, default=COMPACT_WORKERS, help="worker processes (0 - number of CPU cores)")
+    parser.add_argument("--memory-mb", type=int, default=COMPACT_MEMORY_MB, help="sort memory of one worker process, MB")
+    parser.add_argument("--organization", help="ORGANIZATION_NAME from ORGANIZATIONS_CONFIG_FILE")
+    args = parser.parse_args(argv)
 
-            print_progress_bar(progress_start_dt, ended_at, progress_end_dt)
-            runtime_data.oldest_datetime["mail"] = oldest_datetime
+    settings = _command_settings(args.organization)
+    if settings is None:
+        return EXIT_CODE
+    for log_source in ([args.source] if args.source else LOGS_SOURCES):
+        lock = LogFilesLock(settings, log_source)
+        if not lock.acquire():
+            logger.error(f"Log files of {log_source} are used by a running download (lock file {lock.path}). Stop it before compaction.")
+            return EXIT_CODE
+        try:
+            totals = compact_log_files(settings, log_source, args.workers, args.memory_mb, args.started_at, args.ended_at)
+        finally:
+            lock.release()
+        seconds = max(totals["seconds"], 1e-9)
+        logger.info(f"Compacted {totals['files']} {log_source} day files in {totals['seconds']:.1f} sec: {totals['lines']} lines, "
+                    f"{totals['bytes'] / 1024 / 1024:.1f} MB ({totals['bytes'] / 1024 / 1024 / seconds:.1f} MB/s, {totals['lines'] / seconds:.0f} lines/s), "
+                    f"{totals['duplicates']} duplicates removed, {totals['out_of_order']} lines out of order, "
+                    f"{totals['rewritten']} files rewritten, {totals['skipped']} files skipped.")
+    return 0
 
-            if exit_while:
-                break
+def _day_file_histogram(file_path: str, log_source: str, bucket_seconds: int):
+    # Количество разных записей файла дня по интервалам времени {начало интервала: количество} (выполняется в процессе пула)
+    codec = _codec_of_file(file_path)
+    buckets = {}
+    with open(file_path, "rb") as f:
+        for data, _, _ in _iter_appended_data(f, 0, codec):
+            for line in data.split(b"\n"):
+                if not line:
+                    continue
+                try:
+                    timestamp = int(_event_timestamp(_event_time_of_line(log_source, line)))
+                except (ValueError, KeyError, TypeError):
+                    continue
+                buckets.setdefault(timestamp - timestamp % bucket_seconds, set()).add(hashlib.blake2b(line, digest_size=8).digest())
+    return {bucket: len(lines) for bucket, lines in buckets.items()}
 
-        print_progress_bar(progress_start_dt, progress_end_dt, progress_end_dt)
-        sys.stdout.write('\n')
-        sys.stdout.flush()
+def _bucket_identities(file_path: str, log_source: str, buckets: set, bucket_seconds: int):
+    # Идентификаторы сохранённых событий заданных интервалов {начало интервала: set}, включая прогоны запоздавших событий дня
+    identities = {bucket: set() for bucket in buckets}
+    for path in [file_path] + _late_run_paths(file_path):
+        codec = _codec_of_file(path)
+        with open(path, "rb") as f:
+            for data, _, _ in _iter_appended_data(f, 0, codec):
+                for line in data.split(b"\n"):
+                    if not line:
+                        continue
+                    try:
+                        timestamp = int(_event_timestamp(_event_time_of_line(log_source, line)))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    items = identities.get(timestamp - timestamp % bucket_seconds)
+                    if items is not None:
+                        items.add(hashlib.blake2b(line, digest_size=16).digest())
+    return identities
 
-    except Exception as e:
-        sys.stdout.write('\n')
-        sys.stdout.flush()
-        logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+def _fetch_bucket(settings: "SettingParams", log_source: str, bucket: int, bucket_seconds: int):
+    """Records of the API with event time in the bucket, passed through the filter rules. Returns None if the API request failed."""
+    started_at = datetime.fromtimestamp(bucket, tz=timezone.utc).replace(tzinfo=None)
+    ended_at = started_at + timedelta(seconds=bucket_seconds)
+    # Окно запроса шире интервала на секунду с каждой стороны, границы запросов API не влияют на результат
+    error, records = _fetch_window(settings, log_source, started_at - timedelta(seconds=1), ended_at + timedelta(seconds=1))
+    if error:
+        return None
+    records = [r for r in records if bucket <= _event_timestamp(r.event_time) < bucket + bucket_seconds]
+    # Сравниваются записи в том виде, в котором они сохраняются; отброшенные правилами записи уже учтены при загрузке
+    event_filter = (settings.event_filters or {}).get(log_source)
+    return records if event_filter is None else event_filter.apply(records, count=False)
+
+def _suspect_buckets(histogram: dict, bucket_seconds: int):
+    # Интервалы с заметно меньшим количеством записей, чем у соседних: {начало интервала: ожидаемое количество}
+    suspect = {}
+    for bucket, count in histogram.items():
+        neighbours = sorted(histogram.get(bucket + step * bucket_seconds) for step in range(-VERIFY_NEIGHBOUR_BUCKETS, VERIFY_NEIGHBOUR_BUCKETS + 1)
+                            if step and bucket + step * bucket_seconds in histogram)
+        if not neighbours:
+            continue
+        expected = neighbours[len(neighbours) // 2]
+        if expected > 0 and count < VERIFY_SUSPECT_RATIO * expected:
+            suspect[bucket] = expected
+    return suspect
 
+def verify_log_files(settings: "SettingParams", log_source: str, days: int = MAX_DAYS_AGO_FOR_API_CALLS, workers: int = COMPACT_WORKERS,
+                     runtime_data: "RuntimeData" = None, max_buckets: int = VERIFY_MAX_BUCKETS, sample_rate: float = VERIFY_SAMPLE_RATE):
+    """Compare saved records of the last days with the API by time buckets and refill missing records.
 
-def get_date_of_last_record(settings: "SettingParams", runtime_data: "RuntimeData", log_source):
+    Histograms of day files are counted by worker processes and kept in <base name>.verify.state, so only
+    changed files are read again. Suspect buckets (much fewer records than the neighbours) and a sample of
+    not yet verified buckets are requested from the API, at most max_buckets per run; buckets matching the API
+    are remembered as verified. With runtime_data missing records are written to the day files. Returns
+    totals: buckets, records, suspect, checked, missing, refilled, errors, holes (list) and seconds.
+    """
+    started = time.perf_counter()
+    bucket_seconds = VERIFY_BUCKET_MINUTES * 60
+    directory = settings.dir_paths[log_source]
+    state_path = os.path.join(directory, f"{settings.file_names[log_source]}{VERIFY_STATE_SUFFIX}")
+    state = {"bucket_seconds": bucket_seconds, "files": {}, "verified": {}}
+    if os.path.exists(state_path):
+        try:
+            with open(state_path, "r", encoding="utf8") as f:
+                saved = json.load(f)
+            if saved["bucket_seconds"] == bucket_seconds:
+                state = saved
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Can not read verification state {state_path}: {type(e).__name__}: {e}. Day files are counted again.")
+    # Проверяются полные дни, которые ещё хранит API
+    first_date = (datetime.now() - timedelta(hours=settings.timezone_shift) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    names = {}
+    # Прогоны запоздавших событий считаются вместе с файлами дней (файл дня идёт первым)
+    for name in sorted(_log_file_names(settings, log_source)) + sorted(_late_run_names(settings, log_source)):
+        date = re.search(r"_([0-9]{4}-[0-9]{2}-[0-9]{2})\.", name).group(1)
+        if date >= first_date:
+            stat = os.stat(os.path.join(directory, name))
+            names[name] = [stat.st_size, stat.st_ino, stat.st_mtime_ns]
+    files = {name: entry for name, entry in state["files"].items() if name in names and entry[:3] == names[name]}
+    changed = sorted(set(names) - set(files))
+    if changed:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(changed))) as executor:
+            for name, histogram in zip(changed, executor.map(_day_file_histogram, [os.path.join(directory, name) for name in changed],
+                                                             [log_source] * len(changed), [bucket_seconds] * len(changed))):
+                files[name] = names[name] + [{str(bucket): count for bucket, count in histogram.items()}]
+    state["files"] = files
 
-    fmt = '%Y-%m-%dT%H:%M:%SZ'
-    date_now = datetime.now() + relativedelta(hours=-settings.timezone_shift)
-    date = (date_now + relativedelta(days=-MAX_DAYS_AGO_FOR_API_CALLS)).strftime(fmt)
-    existing_records = []
-    if runtime_data.oldest_datetime[log_source] is None:
-        all_files = Path(settings.dir_paths[log_source]).glob(f"*.{settings.ext}")
-        all_names = (file_path.name.lower() for file_path in all_files)
-        files = [f for f in all_names if re.match(settings.file_names[log_source] + r'_[0-9]{4}\-[0-9]{2}\-[0-9]{2}\.' + settings.ext, f)]
+    histogram = {}
+    for *_, buckets in files.values():
+        for bucket, count in buckets.items():
+            histogram[int(bucket)] = histogram.get(int(bucket), 0) + count
+    totals = {"buckets": 0, "records": 0, "suspect": 0, "checked": 0, "missing": 0, "refilled": 0, "errors": 0, "holes": []}
+    if histogram:
+        # Интервал с последней сохранённой записью ещё дописывается и не проверяется, пустые интервалы между записями - проверяются
+        first = int(datetime.strptime(first_date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+        histogram = {bucket: histogram.get(bucket, 0) for bucket in range(max(first, min(histogram)), max(histogram), bucket_seconds)}
+    totals["buckets"], totals["records"] = len(histogram), sum(histogram.values())
+    verified = {int(bucket): count for bucket, count in state["verified"].items() if int(bucket) in histogram}
+    suspect = _suspect_buckets(histogram, bucket_seconds)
+    totals["suspect"] = len(suspect)
+    # Сначала интервалы с наибольшей нехваткой записей, затем случайная выборка ещё не сверенных
+    candidates = sorted((bucket for bucket in suspect if verified.get(bucket) != histogram[bucket]), key=lambda bucket: histogram[bucket] / suspect[bucket])
+    candidates += [bucket for bucket in histogram if bucket not in verified and bucket not in suspect and random.random() < sample_rate]
+    candidates = sorted(candidates[:max_buckets])
 
-        if not files:
-            logger.info(f"No files found in {settings.dir_paths[log_source]} catalog. Start full downloading data.")
+    with ThreadPoolExecutor(max_workers=BACKFILL_MAX_WORKERS, thread_name_prefix="verify") as executor:
+        fetched = list(executor.map(functools.partial(_fetch_bucket, settings, log_source, bucket_seconds=bucket_seconds), candidates))
+    by_file = {}
+    for bucket in candidates:
+        date = datetime.fromtimestamp(bucket, tz=timezone.utc).strftime("%Y-%m-%d")
+        name = next((name for name in names if f"_{date}." in name), None)
+        by_file.setdefault(name, set()).add(bucket)
+    local = {}
+    for name, buckets in by_file.items():
+        if name is None:
+            local.update({bucket: set() for bucket in buckets})
         else:
-            files.sort(reverse=True)
-            for file in files:
-                logger.debug(f"Check records in file {os.path.join(settings.dir_paths[log_source], file)}.")
-                with open(os.path.join(settings.dir_paths[log_source], file), 'r', encoding="utf8") as f:
-                    for line in f:
-                        existing_records.append(line.replace('\n', ''))
-                if not existing_records:
-                    logger.debug(f"No records found in file {os.path.join(settings.dir_paths[log_source], file)}. Selecting previous file.")
+            local.update(_bucket_identities(os.path.join(directory, name), log_source, buckets, bucket_seconds))
+    for bucket, records in zip(candidates, fetched):
+        if records is None:
+            totals["errors"] += 1
+            continue
+        totals["checked"] += 1
+        missing, identities = [], set(local[bucket])
+        for r in records:
+            identity = _event_identity(r.line)
+            if identity not in identities:
+                identities.add(identity)
+                missing.append(r)
+        moment = datetime.fromtimestamp(bucket, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M")
+        if missing:
+            totals["missing"] += len(missing)
+            totals["holes"].append((moment, histogram[bucket], len(missing)))
+            logger.warning(f"Bucket {moment} of {log_source} audit logs: {histogram[bucket]} records saved, {len(missing)} missing.")
+            if runtime_data is None or not _save_records(settings, log_source, missing, runtime_data, filtered=True):
+                continue
+            totals["refilled"] += len(missing)
+        elif len(local[bucket]) > len(records):
+            logger.info(f"Bucket {moment} of {log_source} audit logs: {len(local[bucket]) - len(records)} saved records are not returned by API.")
+        verified[bucket] = histogram[bucket] + len(missing)
+    state["verified"] = {str(bucket): count for bucket, count in verified.items()}
+    _atomic_write(state_path, json.dumps(state).encode("utf8"))
+    totals["seconds"] = time.perf_counter() - started
+    return totals
+
+def verify_main(argv: list):
+    """Command "verify": check saved logs against the API by time buckets, report and optionally refill missing records."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="run_import.py verify", description="Check saved audit logs against the API and refill missing records.")
+    parser.add_argument("--source", choices=("mail", "all"), help="log source (default - all sources of LOGS_SOURCES)")
+    parser.add_argument("--days", type=int, default=MAX_DAYS_AGO_FOR_API_CALLS, help="number of last days to check")
+    parser.add_argument("--max-buckets", type=int, default=VERIFY_MAX_BUCKETS, help="maximum number of buckets requested from API")
+    parser.add_argument("--sample-rate", type=float, default=VERIFY_SAMPLE_RATE, help="share of not yet verified buckets requested from API")
+    parser.add_argument("--workers", type=int, default=COMPACT_WORKERS, help="worker processes counting day files (0 - number of CPU cores)")
+    parser.add_argument("--refill", action="store_true", help="write missing records to day files (the download must be stopped)")
+    parser.add_argument("--organization", help="ORGANIZATION_NAME from ORGANIZATIONS_CONFIG_FILE")
+    args = parser.parse_args(argv)
+
+    settings = _command_settings(args.organization)
+    if settings is None:
+        return EXIT_CODE
+    sources = [args.source] if args.source else LOGS_SOURCES
+    runtime_data = None
+    if args.refill:
+        try:
+            runtime_data = create_runtime_data(settings)
+        except RuntimeError as e:
+            logger.error(f"{e} Stop the download before refilling or run without --refill.")
+            return EXIT_CODE
+    unresolved = 0
+    try:
+        for log_source in sources:
+            totals = verify_log_files(settings, log_source, args.days, args.workers, runtime_data, args.max_buckets, args.sample_rate)
+            unresolved += totals["missing"] - totals["refilled"] + totals["errors"]
+            logger.info(f"Verified {log_source} audit logs in {totals['seconds']:.1f} sec: {totals['records']} records in {totals['buckets']} buckets "
+                        f"of {VERIFY_BUCKET_MINUTES} min, {totals['suspect']} suspect, {totals['checked']} checked against API ({totals['errors']} failed), "
+                        f"{totals['missing']} missing records in {len(totals['holes'])} buckets, {totals['refilled']} refilled.")
+    finally:
+        if runtime_data is not None:
+            runtime_data.close()
+    return EXIT_CODE if unresolved else 0
+
+def sync_main(argv: list):
+    """Command "sync": download every log source once from its last record up to now and exit (cron and batch jobs)."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="run_import.py sync", description="Download new audit logs once and exit.")
+    parser.add_argument("--source", choices=("mail", "all"), help="log source (default - all sources of LOGS_SOURCES)")
+    parser.add_argument("--organization", help="ORGANIZATION_NAME from ORGANIZATIONS_CONFIG_FILE (default - all organizations)")
+    args = parser.parse_args(argv)
+
+    settings_list = _command_settings_list(args.organization)
+    if settings_list is None or not _check_output_settings():
+        return EXIT_CODE
+    failed = 0
+    for settings in settings_list:
+        # Организации загружаются по очереди, имя организации указывается в сообщениях лога
+        _organization.set(settings.name if len(settings_list) > 1 else "")
+        try:
+            runtime_data = create_runtime_data(settings)
+        except RuntimeError as e:
+            logger.error(f"{e} The download is already running.")
+            failed += 1
+            continue
+        try:
+            for log_source in ([args.source] if args.source else LOGS_SOURCES):
+                started = time.perf_counter()
+                added_before = runtime_data.last_records[log_source].added
+                last_datetime = get_date_of_last_record(settings, runtime_data, log_source)
+                if log_source == "all":
+                    completed = fetch_and_save_new_logs_controller(settings, runtime_data, last_datetime)
                 else:
-                    temp_list = [json.loads(r) for r in existing_records]
-                    if log_source == "mail" or log_source == "disk":
-                        occurred_at_raw = temp_list[-1]["date"][0:19]
-                    else:
-                        occurred_at_raw = temp_list[-1]['event']['occurred_at']
-                    # Поддержка разных форматов строки времени: YYYY-MM-DDTHH:MM:SS[.microseconds]
-                    match = re.match(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?)", occurred_at_raw)
-                    if match:
-                        suggested_date = match.group(1)
-                    else:
-                        logger.warning(f"Could not parse occurred_at field: {occurred_at_raw}")
-                        suggested_date = occurred_at_raw[:19]  # fallback, though не гарантия что корректно
-                    runtime_data.oldest_datetime[log_source] = suggested_date
-                    date = f"{suggested_date}Z"
+                    completed = fetch_and_save_old_logs_controller(settings, runtime_data, last_datetime, log_source)
+                failed += not completed
+                event_filter = (settings.event_filters or {}).get(log_source)
+                filtered = f" (filtered out since start: {event_filter.summary()})" if event_filter is not None and event_filter.dropped else ""
+                logger.info(f"{'Synced' if completed else 'Failed to sync'} {log_source} audit logs in {time.perf_counter() - started:.1f} sec: "
+                            f"{runtime_data.last_records[log_source].added - added_before} records{filtered}, last record date {runtime_data.oldest_datetime[log_source]}.")
+        finally:
+            runtime_data.close()
+    _organization.set("")
+    return EXIT_CODE if failed else 0
+
+def daemon_main(argv: list):
+    """Command "daemon" (default without a command): download logs continuously with the configured scheduler."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="run_import.py daemon", description="Download audit logs continuously (tail mode or cycles with pauses).")
+    parser.parse_args(argv)
+    main()
+    return 0
+
+def backfill_log_range(settings: "SettingParams", runtime_data: "RuntimeData", log_source: str, started_at: datetime, ended_at: datetime):
+    """Download records of log_source from started_at to ended_at (UTC) and write the ones missing in the day files.
+
+    The range is requested by buckets of VERIFY_BUCKET_MINUTES in parallel, one day at a time, and compared with
+    the saved records of the day by identity, so the range may overlap saved logs without making duplicates.
+    The watermark of the source does not move. Returns totals: buckets, received, added, errors and seconds.
+    """
+    started = time.perf_counter()
+    bucket_seconds = VERIFY_BUCKET_MINUTES * 60
+    first = int((started_at - _EPOCH).total_seconds())
+    last = math.ceil((ended_at - _EPOCH).total_seconds())
+    directory = settings.dir_paths[log_source]
+    names = _log_file_names(settings, log_source)
+    totals = {"buckets": 0, "received": 0, "added": 0, "errors": 0}
+    status_board.begin(log_source, started_at, ended_at)
+    completed = False
+    try:
+        with ThreadPoolExecutor(max_workers=BACKFILL_MAX_WORKERS, thread_name_prefix="backfill") as executor:
+            for day in range(first - first % 86400, last, 86400):
+                buckets = [bucket for bucket in range(max(day, first - first % bucket_seconds), min(day + 86400, last), bucket_seconds)]
+                fetched = list(executor.map(functools.partial(_fetch_bucket, settings, log_source, bucket_seconds=bucket_seconds), buckets))
+                date = datetime.fromtimestamp(day, tz=timezone.utc).strftime("%Y-%m-%d")
+                name = next((name for name in names if f"_{date}." in name), None)
+                local = _bucket_identities(os.path.join(directory, name), log_source, set(buckets), bucket_seconds) if name else {}
+                missing = []
+                for bucket, records in zip(buckets, fetched):
+                    totals["buckets"] += 1
+                    if records is None:
+                        totals["errors"] += 1
+                        continue
+                    identities = local.get(bucket, set())
+                    for r in records:
+                        if not first <= _event_timestamp(r.event_time) < last:
+                            continue
+                        totals["received"] += 1
+                        identity = _event_identity(r.line)
+                        if identity not in identities:
+                            identities.add(identity)
+                            missing.append(r)
+                if missing and not _save_records(settings, log_source, missing, runtime_data, filtered=True):
+                    logger.error(f"Error occured during saving records of {log_source} audit logs for {date}. Stop backfill.")
+                    totals["errors"] += 1
                     break
+                totals["added"] += len(missing)
+                status_board.advance(log_source, min(datetime.fromtimestamp(day + 86400, tz=timezone.utc).replace(tzinfo=None), ended_at), len(missing))
+        completed = not totals["errors"]
+    finally:
+        status_board.finish(log_source, completed)
+    totals["seconds"] = time.perf_counter() - started
+    return totals
 
-    else:
-        date =runtime_data.oldest_datetime[log_source]
+def backfill_main(argv: list):
+    """Command "backfill": download a time range again and write records missing in the day files. The download must be stopped."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="run_import.py backfill", description="Download audit logs of a time range and add missing records to day files.")
+    parser.add_argument("--source", choices=("mail", "all"), help="log source (default - all sources of LOGS_SOURCES)")
+    parser.add_argument("--from", dest="started_at", type=_parse_query_time, required=True, help="start of time range, UTC (YYYY-MM-DD[THH:MM:SS])")
+    parser.add_argument("--to", dest="ended_at", type=_parse_query_time, help="end of time range, UTC (exclusive, default - now)")
+    parser.add_argument("--organization", help="ORGANIZATION_NAME from ORGANIZATIONS_CONFIG_FILE")
+    args = parser.parse_args(argv)
 
-    logger.info(f"Last record date for {log_source} logs: {date}")
-    
-    return date
+    settings = _command_settings(args.organization)
+    if settings is None or not _check_output_settings():
+        return EXIT_CODE
+    started_at = args.started_at.replace(tzinfo=None)
+    ended_at = args.ended_at.replace(tzinfo=None) if args.ended_at else datetime.now() - timedelta(hours=settings.timezone_shift)
+    if started_at >= ended_at:
+        logger.error(f"Empty time range from {started_at} to {ended_at}.")
+        return EXIT_CODE
+    try:
+        runtime_data = create_runtime_data(settings)
+    except RuntimeError as e:
+        logger.error(f"{e} Stop the download before backfilling.")
+        return EXIT_CODE
+    errors = 0
+    try:
+        for log_source in ([args.source] if args.source else LOGS_SOURCES):
+            totals = backfill_log_range(settings, runtime_data, log_source, started_at, ended_at)
+            errors += totals["errors"]
+            logger.info(f"Backfilled {log_source} audit logs from {started_at} to {ended_at} in {totals['seconds']:.1f} sec: {totals['received']} records "
+                        f"received in {totals['buckets']} buckets ({totals['errors']} failed), {totals['added']} missing records added.")
+    finally:
+        runtime_data.close()
+    return EXIT_CODE if errors else 0
 
-@dataclass
-class SettingParams:
-    oauth_token: str
-    organization_id: int  
-    dir_paths : dict
-    ext: str
-    file_names: dict
-    timezone_shift: int
+def log_source_status(settings: "SettingParams", log_source: str):
+    """State of a log source read from its files without changing them: last record, lag, day files and a running download."""
+    fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+    directory = settings.dir_paths[log_source]
+    status = {"organization": settings.name, "source": log_source, "watermark": None, "lag_sec": None, "in_flight": 0, "files": 0, "bytes": 0, "late_runs": 0, "running": False}
+    checkpoint_path = os.path.join(directory, f"{settings.file_names[log_source]}{CHECKPOINT_FILE_SUFFIX}")
+    if USE_CHECKPOINTS and os.path.exists(checkpoint_path):
+        try:
+            with open(checkpoint_path, "r", encoding="utf8") as f:
+                state = json.load(f)
+            status["watermark"] = state.get("watermark")
+            status["in_flight"] = len(state.get("in_flight", []))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Can not read checkpoint file {checkpoint_path}: {type(e).__name__}: {e}")
+    if os.path.isdir(directory):
+        names = _log_file_names(settings, log_source)
+        status["files"] = len(names)
+        status["bytes"] = sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+        status["late_runs"] = len(_late_run_names(settings, log_source))
+        if status["watermark"] is None and names:
+            # Без файла состояния - дата последней записи самого нового файла; файл не исправляется, его может дописывать загрузка
+            record = _read_last_record(os.path.join(directory, max(names)), repair=False)
+            if record is not None:
+                status["watermark"] = f"{_event_time_prefix(record['event']['occurred_at'] if log_source == 'all' else record['date'])}Z"
+        lock = LogFilesLock(settings, log_source)
+        if lock.acquire():
+            lock.release()
+        else:
+            status["running"] = True
+    if status["watermark"]:
+        date_now = datetime.now() - timedelta(hours=settings.timezone_shift)
+        status["lag_sec"] = round((date_now - _parse_utc_datetime(status["watermark"])).total_seconds())
+        status["watermark"] = _parse_utc_datetime(status["watermark"]).strftime(fmt)
+    return status
 
-@dataclass
-class RuntimeData:
-    last_records: dict = None
-    oldest_datetime: str = None
+def status_main(argv: list):
+    """Command "status": print the state of every log source without network requests."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="run_import.py status", description="Show last saved record, lag and day files of every log source.")
+    parser.add_argument("--organization", help="ORGANIZATION_NAME from ORGANIZATIONS_CONFIG_FILE (default - all organizations)")
+    parser.add_argument("--json", action="store_true", help="print one JSON line per log source")
+    args = parser.parse_args(argv)
+
+    settings_list = _command_settings_list(args.organization)
+    if settings_list is None:
+        return EXIT_CODE
+    for settings in settings_list:
+        for log_source in LOGS_SOURCES:
+            status = log_source_status(settings, log_source)
+            if args.json:
+                print(json.dumps(status))
+                continue
+            lag = _format_duration(status["lag_sec"]) if status["lag_sec"] is not None else "unknown"
+            print(f"{settings.name + ' ' if len(settings_list) > 1 else ''}{log_source}: last record {status['watermark'] or 'none'}, lag {lag}, "
+                  f"{status['files']} day files ({status['bytes'] / 1024 / 1024:.1f} MB), download {'running' if status['running'] else 'stopped'}"
+                  + (f", {status['in_flight']} unfinished windows" if status["in_flight"] else "")
+                  + (f", {status['late_runs']} late event runs" if status["late_runs"] else ""))
+    return 0
 
-def get_settings():
+# Команды: run_import.py <команда> [параметры]; без команды - непрерывная загрузка (daemon)
+_COMMANDS = {
+    "sync": sync_main,
+    "daemon": daemon_main,
+    "backfill": backfill_main,
+    "status": status_main,
+    "query": query_main,
+    "compact": compact_main,
+    "verify": verify_main,
+}
+
+def get_settings(overrides: dict = None):
+    # overrides - значения переменных окружения для одной организации из ORGANIZATIONS_CONFIG_FILE
+    env = dict(os.environ)
+    if overrides:
+        env.update({name: str(value) for name, value in overrides.items()})
     exit_flag = False
     try:
         settings = SettingParams (
-            oauth_token = os.environ.get("OAUTH_TOKEN_ARG"),
-            organization_id = int(os.environ.get("ORGANIZATION_ID_ARG")),
+            oauth_token = env.get("OAUTH_TOKEN_ARG"),
+            organization_id = int(env.get("ORGANIZATION_ID_ARG")),
             dir_paths = {},
             file_names = {},
-            ext = os.environ.get("LOG_FILE_EXTENSION"),
+            ext = env.get("LOG_FILE_EXTENSION"),
             timezone_shift = 3,
         )
     except ValueError:
@@ -255,7 +4160,7 @@ def get_settings():
         logger.error("ORGANIZATION_ID_ARG is not set")
         exit_flag = True
     
-    mail_dir_path = Path(os.environ.get("MAIL_LOG_CATALOG_LOCATION"))
+    mail_dir_path = Path(env.get("MAIL_LOG_CATALOG_LOCATION"))
     if not mail_dir_path:
         logger.error("MAIL_LOG_CATALOG_LOCATION is not set")
         exit_flag = True
@@ -267,7 +4172,7 @@ def get_settings():
             print(f"!!! ERROR !!! The path '{mail_dir_path}' is not a directory. Exit.")
             exit_flag = True
 
-    all_dir_path = Path(os.environ.get("NEW_LOG_CATALOG_LOCATION"))
+    all_dir_path = Path(env.get("NEW_LOG_CATALOG_LOCATION"))
     if not all_dir_path:
         logger.error("NEW_LOG_CATALOG_LOCATION is not set")
         exit_flag = True
@@ -283,10 +4188,10 @@ def get_settings():
         logger.error("LOG_FILE_EXTENSION is not set")
         exit_flag = True
     
-    mail_file_name = os.environ.get("MAIL_LOG_FILE_BASE_NAME")
-    all_file_name = os.environ.get("NEW_LOG_FILE_BASE_NAME")
+    mail_file_name = env.get("MAIL_LOG_FILE_BASE_NAME")
+    all_file_name = env.get("NEW_LOG_FILE_BASE_NAME")
 
-    temp_timezone_shift = int(os.environ.get("TIMEZONE_SHIFT_IN_HOURS"))
+    temp_timezone_shift = int(env.get("TIMEZONE_SHIFT_IN_HOURS"))
     if temp_timezone_shift >= 12 or temp_timezone_shift <= -12:
          logger.error("TIMEZONE_SHIFT_IN_HOURS is wrong. Exit.")
          exit_flag = True
@@ -295,6 +4200,8 @@ def get_settings():
 
     if exit_flag:
         return None
+
+    settings.name = env.get("ORGANIZATION_NAME") or str(settings.organization_id)
     
     settings.dir_paths["mail"] = mail_dir_path
     settings.dir_paths["all"] = all_dir_path
@@ -302,206 +4209,425 @@ def get_settings():
     settings.file_names["mail"] = mail_file_name
     settings.file_names["all"] = all_file_name
 
+    settings.parquet_dir = Path(env.get("PARQUET_CATALOG_LOCATION") or all_dir_path / "parquet")
+
+    # Адреса получателей разделяются запятыми или пробелами
+    settings.sink_urls = [url for url in re.split(r"[,\s]+", env.get("AUDIT_SINK_URLS") or "") if url]
+    for url in settings.sink_urls:
+        try:
+            _sink_transport(url)
+        except ValueError as e:
+            logger.error(f"AUDIT_SINK_URLS is wrong: {e}")
+            return None
+
+    try:
+        settings.event_filters = load_event_filters(env.get("EVENT_FILTERS_FILE"))
+    except (OSError, ValueError, re.error) as e:
+        logger.error(f"EVENT_FILTERS_FILE is wrong: {type(e).__name__}: {e}")
+        return None
+
+    logger.info(f"Settings: ORGANIZATION_NAME - {settings.name}")
     logger.info(f"Settings: ORGANIZATION_ID_ARG - {settings.organization_id}")
     logger.info(f"Settings: MAIL_LOG_CATALOG_LOCATION - {settings.dir_paths['mail']}")
     logger.info(f"Settings: NEW_LOG_CATALOG_LOCATION - {settings.dir_paths['all']}")
     logger.info(f"Settings: MAIL_LOG_FILE_BASE_NAME - {settings.file_names['mail']}")
     logger.info(f"Settings: NEW_LOG_FILE_BASE_NAME - {settings.file_names['all']}")
     logger.info(f"Settings: LOG_FILE_EXTENSION - {settings.ext}")
+    if PARQUET_EXPORT:
+        logger.info(f"Settings: PARQUET_CATALOG_LOCATION - {settings.parquet_dir}")
+    if settings.event_filters:
+        logger.info(f"Settings: EVENT_FILTERS_FILE - {env.get('EVENT_FILTERS_FILE') or 'not set'}, rules: "
+                    f"{', '.join(f'{log_source} - {len(item.includes) + len(item.excludes)} filters, {len(item.operations)} field operations' for log_source, item in settings.event_filters.items())}")
+    if settings.sink_urls:
+        logger.info(f"Settings: AUDIT_SINK_URLS - {', '.join(_sink_display(url) for url in settings.sink_urls)}")
     logger.info(f"Settings: TIMEZONE_SHIFT_IN_HOURS - {settings.timezone_shift}")
     
     return settings
 
-def fetch_mail_audit_logs(settings: "SettingParams", last_date: str = "", ended_at: str = ""):
-  
-    log_records = set()
-    params = {}
-    error = False
+def get_organizations_settings():
+    """Settings of all organizations to download logs for.
+
+    If ORGANIZATIONS_CONFIG_FILE is set, it is a JSON list of objects with the same keys as the environment
+    variables (plus ORGANIZATION_NAME), missing keys are taken from the environment. Otherwise the only
+    organization is configured by the environment. Returns None if any settings are wrong.
+    """
+    config_file = os.environ.get("ORGANIZATIONS_CONFIG_FILE")
+    if not config_file:
+        settings = get_settings()
+        return [settings] if settings is not None else None
+
+    try:
+        with open(config_file, "r", encoding="utf8") as f:
+            organizations = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Can not read ORGANIZATIONS_CONFIG_FILE {config_file}: {type(e).__name__}: {e}")
+        return None
+    if not isinstance(organizations, list) or not organizations or not all(isinstance(item, dict) for item in organizations):
+        logger.error(f"ORGANIZATIONS_CONFIG_FILE {config_file} must contain a non-empty list of objects.")
+        return None
+
+    settings_list = []
+    used_files = set()
+    for number, organization in enumerate(organizations, start=1):
+        settings = get_settings(organization)
+        if settings is None:
+            logger.error(f"Settings of organization #{number} in {config_file} are wrong.")
+            return None
+        if settings.name in {item.name for item in settings_list}:
+            logger.error(f"ORGANIZATION_NAME {settings.name} is used for several organizations in {config_file}.")
+            return None
+        for log_source in LOGS_SOURCES:
+            # Организации не должны писать в одни и те же файлы
+            log_files = (os.path.abspath(settings.dir_paths[log_source]), settings.file_names[log_source])
+            if log_files in used_files:
+                logger.error(f"Organization {settings.name} uses the same {log_source} log files as another organization in {config_file}.")
+                return None
+            used_files.add(log_files)
+        if PARQUET_EXPORT:
+            parquet_dir = os.path.abspath(settings.parquet_dir)
+            if parquet_dir in used_files:
+                logger.error(f"Organization {settings.name} uses the same PARQUET_CATALOG_LOCATION as another organization in {config_file}.")
+                return None
+            used_files.add(parquet_dir)
+        settings_list.append(settings)
+    return settings_list
+
+def _observe_page(log_source: str, records: list, parse_seconds: float):
+    labels = _metric_labels(log_source)
+    metrics.observe("audit_parse_seconds", labels, parse_seconds)
+    metrics.inc("audit_pages_total", labels)
+    metrics.inc("audit_records_fetched_total", labels, len(records))
+
+def _fetch_mail_range(settings: "SettingParams", started_at: datetime, ended_at: datetime, max_pages: int = None):
+    """Fetch mail audit log records with started_at <= event time < ended_at, following page tokens.
+
+    The API returns the newest records first. If the range has more than max_pages pages, returns the records
+    newer than the oldest read one, the time of that record and the number of read records; the rest of the
+    range (up to and including that time) is left to the caller. Otherwise the second value is None.
+    Raises AuditApiError if a page can not be received.
+    """
     fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+    url = f"{DEFAULT_360_API_URL}/security/v1/org/{settings.organization_id}/audit_log/mail"
+    headers = {"Authorization": f"OAuth {settings.oauth_token}"}
+    # Границы запроса шире диапазона на миллисекунду, поэтому не важно, включает ли их API: лишние записи отбрасываются по времени
+    params = {"pageSize": MAIL_LOGS_MAX_RECORDS, "afterDate": (started_at - timedelta(milliseconds=1)).strftime(fmt),
+              "beforeDate": (ended_at + timedelta(milliseconds=1)).strftime(fmt)}
+    records = []
+    pages_count = 0
+    while True:
+        response = api_sessions.get(DEFAULT_360_API_URL, url, headers=headers, params=params, source="mail")
+        if response is None:
+            raise AuditApiError("Forcing exit without getting data.")
+        # Ответ разбирается один раз, дальше используются уже разобранные записи
+        started = time.perf_counter()
+        data = _json_loads(response.content)
+        temp_list = [AuditRecord.from_mail(d) for d in data.get("events") or []]
+        _observe_page("mail", temp_list, time.perf_counter() - started)
+        pages_count += 1
+        records.extend((_event_datetime(r.event_time).replace(tzinfo=None), r) for r in temp_list)
+        if temp_list:
+            logger.debug(f'Received {len(temp_list)} records, from {min(r.event_time for r in temp_list)} to {max(r.event_time for r in temp_list)}')
+        if not temp_list or not data.get("nextPageToken"):
+            return [r for moment, r in records if started_at <= moment < ended_at], None, len(records)
+        if max_pages is not None and pages_count >= max_pages:
+            # Записи самой старой прочитанной миллисекунды могут продолжаться на следующей странице, они загружаются с остатком диапазона
+            oldest = min(moment for moment, _ in records)
+            return [r for moment, r in records if oldest < moment < ended_at], oldest, len(records)
+        params["pageToken"] = data["nextPageToken"]
+
+def _split_mail_range(started_at: datetime, ended_at: datetime, records_count: int, read_span: timedelta):
+    # Части равной длины, в каждой - около WINDOW_TARGET_PAGES страниц при плотности прочитанных записей
+    if read_span > timedelta(0):
+        expected = records_count * ((ended_at - started_at) / read_span)
+        parts = math.ceil(expected / (WINDOW_TARGET_PAGES * MAIL_LOGS_MAX_RECORDS))
+    else:
+        parts = MAIL_SPLIT_MAX_PARTS
+    parts = min(max(parts, 2), MAIL_SPLIT_MAX_PARTS)
+    step = (ended_at - started_at) / parts
+    bounds = [started_at + step * number for number in range(parts)] + [ended_at]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def iter_mail_audit_logs(settings: "SettingParams", started_at: datetime, ended_at: datetime):
+    """Yield lists of mail audit log records with started_at <= event time < ended_at, lists follow in time order.
+
+    A range that does not fit into OLD_LOG_MAX_PAGES pages is split by time into parts (recursively, if a part
+    is still too dense), parts are fetched by MAIL_SPLIT_MAX_WORKERS threads and yielded as soon as all earlier
+    parts are received. Every record is downloaded once, except records of the millisecond where a range
+    was split. Raises AuditApiError if a page can not be received.
+    """
+    executor = ThreadPoolExecutor(max_workers=MAIL_SPLIT_MAX_WORKERS, thread_name_prefix="mail-range")
+
+    def submit(part_started_at: datetime, part_ended_at: datetime):
+        # Диапазон в одну миллисекунду делить нельзя, он читается по pageToken целиком
+        max_pages = OLD_LOG_MAX_PAGES if part_ended_at - part_started_at > timedelta(milliseconds=1) else None
+        return executor.submit(contextvars.copy_context().run, _fetch_mail_range, settings, part_started_at, part_ended_at, max_pages)
+
     try:
-        params["pageSize"] = MAIL_LOGS_MAX_RECORDS
-        if last_date:
-            params["afterDate"] = last_date
-        if ended_at:
-            params["beforeDate"] = ended_at
-        url = f"{DEFAULT_360_API_URL}/security/v1/org/{settings.organization_id}/audit_log/mail"
-        headers = {"Authorization": f"OAuth {settings.oauth_token}"}
-        pages_count = 0
-        retries = 0
-        while True:           
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code != HTTPStatus.OK.value:
-                logger.error(f"Error during GET request: {response.status_code}. Error message: {response.text}")
-                logger.debug(f"Error during GET request. url - {url}. Params - {params}")
-                logger.debug(f'X-Request-Id: {response.headers.get("X-Request-Id","")}')
-                if retries < MAX_RETRIES:
-                    logger.error(f"Retrying ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    logger.error("Forcing exit without getting data.")
-                    error = True
-                    return error, []
-            else:
-                if response.json()["events"] is not None and response.json()["events"] != []:
-                    retries = 1
-                    temp_list = response.json()["events"]
-                    sorted_list = sorted(temp_list, key=lambda x: x["date"], reverse=True)
-                    if temp_list:
-                        logger.debug(f'Received {len(sorted_list)} records, from {sorted_list[-1]["date"]} to {sorted_list[0]["date"]}')
-                        temp_json = [json.dumps(d, ensure_ascii=False).encode('utf8') for d in sorted_list]
-                        log_records.update(temp_json)
-                    
-                    if response.json()["nextPageToken"] == "":
-                        break
-                    else:
-                        if pages_count < OLD_LOG_MAX_PAGES:
-                            pages_count += 1
-                            params["pageToken"] = response.json()["nextPageToken"]
-                        else:
-                            if params.get('pageToken') : del params['pageToken']
-                            if temp_list:
-                                occurred_at_raw = sorted_list[-1]["date"]
-                                match = re.match(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?)", occurred_at_raw)
-                                if match:
-                                    suggested_date = match.group(1)
-                                else:
-                                    logger.warning(f"Could not parse occurred_at field: {occurred_at_raw}")
-                                    suggested_date = occurred_at_raw[:19]  # fallback, though не гарантия что корректно
-
-                                suggested_date = f'{suggested_date}Z'
-                                msg_date = datetime.strptime(suggested_date, fmt) + relativedelta(microseconds=-1000)
-                                params["beforeDate"] = msg_date.strftime(fmt)
-                            else:
-                                logger.debug("No data returned from API request. Exit from cycle.")
-                                logger.debug(f"Data for GET request: url - {url}. Params - {params}")
-                                logger.debug(f'X-Request-Id: {response.headers.get("X-Request-Id","")}')
-                                break
-                            params["pageSize"] = 100
-                            pages_count = 0
-                elif response.json()["events"] == []:
-                    logger.debug("API returned empty list of events. Exit from cycle.")
-                    return False, []
+        # Части диапазона в порядке времени: [начало, конец, future или полученные записи]
+        ranges = [[started_at, ended_at, submit(started_at, ended_at)]]
+        while ranges:
+            expanded = []
+            for part_started_at, part_ended_at, result in ranges:
+                if isinstance(result, list) or not result.done():
+                    expanded.append([part_started_at, part_ended_at, result])
+                    continue
+                records, oldest, records_count = result.result()
+                if oldest is not None:
+                    split_at = oldest + timedelta(microseconds=1)
+                    parts = _split_mail_range(part_started_at, split_at, records_count, part_ended_at - oldest)
+                    logger.debug(f"Mail audit logs from {part_started_at} to {split_at} are split into {len(parts)} parts.")
+                    expanded.extend([started, ended, submit(started, ended)] for started, ended in parts)
+                    part_started_at = split_at
+                expanded.append([part_started_at, part_ended_at, records])
+            ranges = expanded
+            while ranges and isinstance(ranges[0][2], list):
+                records = ranges.pop(0)[2]
+                if records:
+                    yield sorted(records, key=lambda r: r.event_time)
+            if ranges:
+                wait([result for _, _, result in ranges if not isinstance(result, list)], return_when=FIRST_COMPLETED)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def fetch_mail_audit_logs(settings: "SettingParams", last_date: str = "", ended_at: str = ""):
+    """Fetch mail audit log records from last_date to ended_at inclusive. Returns (error, records)."""
+    try:
+        started_at = _parse_utc_datetime(last_date) if last_date else datetime.now() - timedelta(hours=settings.timezone_shift, days=MAX_DAYS_AGO_FOR_API_CALLS)
+        ended_at = _parse_utc_datetime(ended_at) if ended_at else datetime.now() - timedelta(hours=settings.timezone_shift)
+        log_records = []
+        # Даты почтовых событий - с точностью до миллисекунд, событие в миллисекунду ended_at входит в диапазон
+        for records in iter_mail_audit_logs(settings, started_at, ended_at + timedelta(milliseconds=1)):
+            log_records.extend(records)
+    except AuditApiError as e:
+        logger.error(str(e))
+        return True, []
+    except Exception as e:
+        logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+        return True, []
 
+    return False, log_records
+
+def stream_mail_logs_window(settings: "SettingParams", runtime_data: "RuntimeData", started_at: str, ended_at: str, parts=None):
+    """Fetch one window of mail audit logs (ended_at inclusive) and write records to files part by part as they arrive.
+
+    parts - parts of the window already being fetched by another thread (default - requested here).
+    Returns error flag, number of received records and date of the newest record (None if there are no records).
+    """
+    records_count = 0
+    newest_date = None
+    try:
+        if parts is None:
+            parts = iter_mail_audit_logs(settings, _parse_utc_datetime(started_at), _parse_utc_datetime(ended_at) + timedelta(milliseconds=1))
+        for records in parts:
+            if not save_old_logs_to_file(settings, "mail", records, runtime_data):
+                logger.error(f"Error occured during saving records from mail audit logs from {started_at} to {ended_at}.")
+                return True, records_count, None
+            records_count += len(records)
+            newest_date = max(newest_date or "", records[-1].event_time)
+    except AuditApiError as e:
+        logger.error(str(e))
+        return True, records_count, None
     except Exception as e:
         logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
-        error = True
-        return []
-        
-    return error, log_records
+        return True, records_count, None
+
+    return False, records_count, newest_date
 
 
 def save_old_logs_to_file(settings: "SettingParams", label: str, log_records: list, runtime_data: "RuntimeData" ):
+    return _save_records(settings, label, log_records, runtime_data)
 
-    result = False
-    existing_records = runtime_data.last_records[label]
+def _save_records(settings: "SettingParams", label: str, log_records: list, runtime_data: "RuntimeData", filtered: bool = False, side_runs: bool = False):
+    """Append not yet saved records to day files sorted by event time.
+
+    Records are passed through the filter rules of the source first (filtered - already passed).
+    side_runs - records are older than already written ones and go to sorted side runs of the day files.
+    Returns True if all records are saved (including the case when there is nothing to save).
+    """
+    result = True
+    labels = _metric_labels(label)
+    event_filter = (settings.event_filters or {}).get(label)
+    if event_filter is not None and not filtered:
+        records_count = len(log_records)
+        log_records = event_filter.apply(log_records)
+        if len(log_records) < records_count:
+            logger.debug(f"Filtered out {records_count - len(log_records)} records of {label} audit logs.")
+    started = time.perf_counter()
+    dedup_index = runtime_data.last_records[label]
+    batch_identities = set()
+    duplicates = 0
     separated_list = {}
     for r in log_records:
-        # logger.info(f"source - {r}")
-        # for ex in existing_records:
-        #     if r == ex:
-        #         continue
-        #     else:
-        #         logger.info(f"existing - {ex}")
-        #         diff_chars = [(i, char1, char2) for i, (char1, char2) in enumerate(zip(r, ex)) if char1 != char2]
-        #         logger.info(f"diff_chars - {diff_chars}")
-        if r in existing_records:
+        identity = _event_identity(r.line)
+        if identity in dedup_index or identity in batch_identities:
+            duplicates += 1
             continue
+        batch_identities.add(identity)
+        date_part = r.event_time[0:10]
+        if date_part not in separated_list:
+            separated_list[date_part] = []
+        separated_list[date_part].append((r, identity))
+    if duplicates:
+        logger.debug(f"Skipped {duplicates} already saved records of {label} audit logs.")
+        metrics.inc("audit_duplicates_dropped_total", labels, duplicates)
+    metrics.observe("audit_dedup_seconds", labels, time.perf_counter() - started)
 
-        search_result = re.search(r".+\"date\"\:\s\"(.+)\".+", r)
-        if search_result:
-            date_part = search_result.group(1)[0:10]
-            if date_part not in separated_list.keys():
-                separated_list[date_part] = []
-            sorted_dict = {}
-            sorted_dict["full_time"] = search_result.group(1)
-            sorted_dict["data"] = r
-            separated_list[date_part].append(sorted_dict)
-        else:
-            logger.error(f"No date found in record: {r}")
-    
+    writers = runtime_data.get_writers()
     for date, records in separated_list.items():
-        file_path = os.path.join(settings.dir_paths[label], f"{settings.file_names[label]}_{date}.{settings.ext}")
-        if len(records) > 0:
-            logger.debug(f"Writing {len(records)} records to {label} audit file {file_path}")
-            try:
-                with open(file_path, 'a', encoding="utf8") as f:
-                    for r in sorted(records, key=lambda d: d['full_time']):
-                        f.write(f"{r['data']}\n")
-                    result = True
-            except Exception as e:
-                logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+        file_path = _day_file_path(settings, label, date)
+        records.sort(key=lambda item: item[0].event_time)
+        logger.debug(f"Writing {len(records)} records to {label} audit file {file_path}")
+        try:
+            started = time.perf_counter()
+            if side_runs:
+                written, late = writers.write_late_events(file_path, label, [(r.event_time, r.line) for r, _ in records])
+            else:
+                written, late = writers.write_events(file_path, label, [(r.event_time, r.line) for r, _ in records])
+            metrics.observe("audit_write_seconds", labels, time.perf_counter() - started)
+            metrics.inc("audit_records_written_total", labels, len(records))
+            if late:
+                logger.debug(f"{late} late records of {label} audit logs are written to a side run of {file_path}")
+                metrics.inc("audit_late_records_total", labels, late)
+        except Exception as e:
+            logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+            result = False
+            continue
+        # В индекс попадают только записанные события, иначе при повторной загрузке окна они будут потеряны
+        for r, identity in records:
+            dedup_index.add(identity, r.event_time)
+        for follower in runtime_data.get_followers(label):
+            follower.touch(*written)
             
     return result
 
-def fetch_all_audit_logs_by_params(settings: "SettingParams", query_params: dict):
-    error = False
+class AuditApiError(Exception):
+    pass
+
+def iter_all_audit_log_pages(settings: "SettingParams", query_params: dict):
+    """Yield pages of new audit log records as (records, iteration_key) while the API returns iteration_key.
+
+    Raises AuditApiError if a page can not be received.
+    """
     params = query_params.copy()
     params["count"] = ALL_LOGS_MAX_RECORDS
     if not params.get("ended_at"):
-        logger.error("Param ended_at for gettion new audit logs not set.")
-        return []
+        raise AuditApiError("Param ended_at for gettion new audit logs not set.")
 
-    log_records = []
     url = f"{NEW_360_API_URL}/auditlog/organizations/{settings.organization_id}/events"
     headers = {"Authorization": f"OAuth {settings.oauth_token}"}
-    try:
-        retries = 0
-        while True:           
-            response = requests.get(url, headers=headers, params=params)
-            if response.status_code != HTTPStatus.OK.value:
-                logger.error(f"Error during GET request: {response.status_code}. Error message: {response.text}")
-                logger.debug(f"Error during GET request. url - {url}. Params - {params}")
-                if retries < MAX_RETRIES:
-                    logger.error(f"Retrying ({retries+1}/{MAX_RETRIES})")
-                    time.sleep(RETRIES_DELAY_SEC * retries)
-                    retries += 1
-                else:
-                    logger.error("Forcing exit without getting data.")
-                    error = True
-                    return []
-            else:
-                retries = 1
-                temp_list = response.json()["items"]
-                if temp_list:
-                    sorted_list = sorted(temp_list, key=lambda d: d["event"]["occurred_at"], reverse=True)
-                    logger.debug(f'Received {len(temp_list)} records, from {sorted_list[-1]["event"]["occurred_at"][0:19]} to {sorted_list[0]["event"]["occurred_at"][0:19]}')
-                    log_records.extend(temp_list)
-                else:
-                    logger.debug("No data returned from API request.")
-                    logger.debug(f"Data for GET request: url - {url}. Params - {params}")
-                    logger.debug(f"Received data: {response.json()}")
+    while True:
+        response = api_sessions.get(NEW_360_API_URL, url, headers=headers, params=params, source="all")
+        if response is None:
+            raise AuditApiError("Forcing exit without getting data.")
+        # Ответ разбирается один раз, дальше используются уже разобранные записи
+        started = time.perf_counter()
+        data = _json_loads(response.content)
+        temp_list = [AuditRecord.from_new(d) for d in data.get("items") or []]
+        _observe_page("all", temp_list, time.perf_counter() - started)
+        if temp_list:
+            logger.debug(f'Received {len(temp_list)} records, from {min(r.event_time for r in temp_list)[0:19]} to {max(r.event_time for r in temp_list)[0:19]}')
+        else:
+            logger.debug("No data returned from API request.")
+            logger.debug(f"Data for GET request: url - {url}. Params - {params}")
+            logger.debug(f"Received data: {data}")
 
-                if response.json().get("iteration_key") is None or response.json()["iteration_key"] == "":
-                    break
-                else:
-                    params["iteration_key"] = response.json()["iteration_key"]
+        iteration_key = data.get("iteration_key") or None
+        yield temp_list, iteration_key
+        if iteration_key is None:
+            break
+        params["iteration_key"] = iteration_key
+
+def fetch_all_audit_logs_by_params(settings: "SettingParams", query_params: dict):
+    error = False
+    log_records = []
+    try:
+        for temp_list, _ in iter_all_audit_log_pages(settings, query_params):
+            log_records.extend(temp_list)
 
+    except AuditApiError as e:
+        logger.error(str(e))
+        error = True
+        return error, []
     except Exception as e:
         logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
         error = True
-        return []
+        return error, []
         
     return error, log_records
 
-def print_progress_bar(start_dt, current_dt, end_dt, bar_length=40):
-    total_seconds = (end_dt - start_dt).total_seconds()
-    if total_seconds <= 0:
-        progress = 1.0
-    else:
-        elapsed_seconds = (current_dt - start_dt).total_seconds()
-        progress = min(max(elapsed_seconds / total_seconds, 0.0), 1.0)
+def stream_new_logs_window(settings: "SettingParams", runtime_data: "RuntimeData", params: dict, pages=None):
+    """Fetch one window of new audit logs page by page and write records to files as they arrive.
+
+    pages - pages of the window already being fetched by another thread (default - requested here).
+
+    Records pass through a reorder buffer of at most STREAM_REORDER_BUFFER_RECORDS records, so memory
+    does not depend on the window size. Pages are expected in ascending time: a record older than records
+    already flushed from the buffer (pages in descending or interleaved order) is written to sorted side runs
+    of the day file, which are merged into it later, so day files stay ordered by time. Every STREAM_FLUSH_PAGES
+    pages the buffer is flushed completely and the page cursor is saved to the checkpoint, so an interrupted
+    window can be continued from that page.
+    Returns error flag, number of received records and occurred_at of the newest record (None if there are no records).
+    """
+    reorder_buffer = []
+    late_records = []
+    sequence = 0
+    records_count = 0
+    late_count = 0
+    newest_occurred_at = None
+    flushed_until = None
+
+    def flush(records_to_keep: int):
+        nonlocal flushed_until
+        records = []
+        while len(reorder_buffer) > records_to_keep:
+            records.append(heapq.heappop(reorder_buffer)[2])
+        if records and (flushed_until is None or records[-1].event_time > flushed_until):
+            flushed_until = records[-1].event_time
+        late = late_records[:]
+        late_records.clear()
+        if records and not save_new_logs_to_file(records, settings, runtime_data):
+            return False
+        return not late or _save_records(settings, "all", late, runtime_data, side_runs=True)
 
-    filled = int(bar_length * progress)
-    bar = '█' * filled + '░' * (bar_length - filled)
-    percent = progress * 100
+    try:
+        if pages is None:
+            pages = iter_all_audit_log_pages(settings, params)
+        for page_number, (temp_list, iteration_key) in enumerate(pages, start=1):
+            for record in temp_list:
+                occurred_at = record.event_time
+                if flushed_until is not None and occurred_at < flushed_until:
+                    # Страница пришла не по возрастанию времени: запись старше уже записанных в файлы
+                    late_records.append(record)
+                    late_count += 1
+                    continue
+                heapq.heappush(reorder_buffer, (occurred_at, sequence, record))
+                sequence += 1
+                if newest_occurred_at is None or occurred_at > newest_occurred_at:
+                    newest_occurred_at = occurred_at
+            records_count += len(temp_list)
+
+            if len(reorder_buffer) + len(late_records) > STREAM_REORDER_BUFFER_RECORDS and not flush(STREAM_REORDER_BUFFER_RECORDS // 2):
+                return True, records_count, None
+            if iteration_key is not None and page_number % STREAM_FLUSH_PAGES == 0:
+                if not flush(0):
+                    return True, records_count, None
+                cursor = {"started_at": params["started_at"], "ended_at": params["ended_at"], "iteration_key": iteration_key}
+                _checkpoint_commit(runtime_data, "all", runtime_data.oldest_datetime["all"], cursor=cursor)
 
-    sys.stdout.write(
-        f'\r[{bar}] {percent:5.1f}% | '
-        f'{current_dt.strftime("%Y-%m-%d %H:%M")} / {end_dt.strftime("%Y-%m-%d %H:%M")}'
-    )
-    sys.stdout.flush()
+        if not flush(0):
+            return True, records_count, None
+        if late_count:
+            logger.debug(f"Pages of window from {params['started_at']} to {params['ended_at']} are not in ascending time order: "
+                         f"{late_count} records older than already written ones are written to side runs of the day files.")
+
+    except AuditApiError as e:
+        logger.error(str(e))
+        return True, records_count, None
+    except Exception as e:
+        logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+        return True, records_count, None
 
+    return False, records_count, newest_occurred_at
 
 def _parse_utc_datetime(dt_str):
     if isinstance(dt_str, datetime):
@@ -515,47 +4641,77 @@ def _parse_utc_datetime(dt_str):
 
 def fetch_and_save_new_logs_controller(settings: "SettingParams", runtime_data: "RuntimeData", oldest_datetime : str = ""):
 
+    completed = False
     try:
         fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
         params = {}
         parsed_oldest = _parse_utc_datetime(oldest_datetime)
-        new_started_at = parsed_oldest + relativedelta(microseconds=+1)
+        new_started_at = parsed_oldest + timedelta(microseconds=1)
         logger.info(f"Started new log download process from {new_started_at.strftime(fmt)}")
         exit_while = False
 
-        progress_start_dt = _parse_utc_datetime(oldest_datetime)
-        progress_end_dt = datetime.now() + relativedelta(hours=-settings.timezone_shift)
-        print_progress_bar(progress_start_dt, progress_start_dt, progress_end_dt)
+        progress_start_dt = parsed_oldest
+        progress_end_dt = datetime.now() - timedelta(hours=settings.timezone_shift)
+        status_board.begin("all", progress_start_dt, progress_end_dt)
+
+        # Курсор страницы прерванного окна используется только один раз, при ошибке окно загружается заново целиком
+        checkpoint = runtime_data.checkpoints["all"] if runtime_data.checkpoints else None
+        resume_cursor = checkpoint.cursor if checkpoint is not None else None
+        if checkpoint is not None:
+            checkpoint.cursor = None
+
+        sizer = runtime_data.get_window_sizer("all")
+        backfill = BACKFILL_MAX_WORKERS > 1
 
         while True:
             #Добавляем микросекунду, т.к. в API запрос для начальной даты учитывет микросекунды
-            parsed_oldest = _parse_utc_datetime(oldest_datetime)
-            new_started_at = parsed_oldest + relativedelta(microseconds=+1)
+            # parsed_oldest - разобранное значение oldest_datetime, обновляется вместе с ним в конце итерации
+            new_started_at = parsed_oldest + timedelta(microseconds=1)
             params["started_at"] = new_started_at.strftime(fmt)
+            resuming = resume_cursor is not None and resume_cursor.get("started_at") == params["started_at"] and resume_cursor.get("iteration_key")
+
+            date_now = datetime.now() - timedelta(hours=settings.timezone_shift)
+            if backfill and not resuming:
+                # Полные окна загружаем параллельно (после окна, продолженного с сохраненной страницы), оставшийся хвост диапазона - в этом цикле
+                backfill = False
+                if date_now - parsed_oldest > timedelta(minutes=sizer.minutes * BACKFILL_MIN_WINDOWS):
+                    windows = _adaptive_time_windows(parsed_oldest, date_now, sizer)
+                    oldest_datetime, backfilled = backfill_new_logs(settings, runtime_data, oldest_datetime, windows)
+                    if not backfilled:
+                        return False
+                    parsed_oldest = _parse_utc_datetime(oldest_datetime)
+                    params["started_at"] = (parsed_oldest + timedelta(microseconds=1)).strftime(fmt)
+                    date_now = datetime.now() - timedelta(hours=settings.timezone_shift)
 
-            diff_in_minutes = (datetime.now() + relativedelta(hours=-settings.timezone_shift) - parsed_oldest).total_seconds() / 60
-            if diff_in_minutes > NEW_LOG_ONE_FETCH_CYCLE_IN_MINUTES:
-                ended_at = parsed_oldest + relativedelta(minutes=+NEW_LOG_ONE_FETCH_CYCLE_IN_MINUTES)
+            if (date_now - parsed_oldest).total_seconds() / 60 > sizer.minutes:
+                ended_at = parsed_oldest + timedelta(minutes=sizer.minutes)
             else:
-                ended_at = datetime.now() + relativedelta(hours=-settings.timezone_shift)
+                ended_at = date_now
                 exit_while = True
             params["ended_at"] = ended_at.strftime(fmt)
+            params.pop("iteration_key", None)
+            resumed = False
+            if resuming:
+                # Продолжаем прерванное окно со страницы, сохраненной в файле состояния
+                params["ended_at"] = resume_cursor["ended_at"]
+                ended_at = _parse_utc_datetime(params["ended_at"])
+                exit_while = ended_at >= date_now
+                params["iteration_key"] = resume_cursor["iteration_key"]
+                resumed = True
+                logger.info(f"Continue interrupted window from {params['started_at']} to {params['ended_at']} from saved page cursor.")
+            resume_cursor = None
             logger.debug(f"Fetch new logs cycle from {params['started_at']} to {params['ended_at']}")
-            error, log_records = fetch_all_audit_logs_by_params(settings, params)
+            _checkpoint_begin(runtime_data, "all", params["started_at"], params["ended_at"])
+            _set_request_priority(not exit_while)
+            error, records_count, newest_occurred_at = stream_new_logs_window(settings, runtime_data, params)
             if error:
                 logger.error(f"Error occured during reciving records from new audit logs from  {params['started_at']} to {params['ended_at']}. Force quite cycle.")
                 break
-            if log_records:
-                #logger.debug(f'Received {len(log_records)} records, from {log_records[-1]["event"]["occurred_at"][0:19]} to {log_records[0]["event"]["occurred_at"][0:19]}')
-                save_new_logs_to_file(log_records, settings, runtime_data)
-                sorted_log_records = sorted(log_records, key=lambda d: d["event"]["occurred_at"], reverse=True)
-                occurred_at_raw = sorted_log_records[0]["event"]["occurred_at"]
-                match = re.match(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?)", occurred_at_raw)
-                if match:
-                    suggested_date = match.group(1)
-                else:
-                    logger.warning(f"Could not parse occurred_at field: {occurred_at_raw}")
-                    suggested_date = occurred_at_raw[:19]  # fallback, though не гарантия что корректно
+            if not resumed:
+                # Продолженное окно загружено не полностью и не показывает плотность событий
+                sizer.observe(parsed_oldest, ended_at, records_count)
+            if newest_occurred_at is not None:
+                suggested_date = _event_time_prefix(newest_occurred_at)
                 
                 occurred_at_zero_milliseconds = f"{suggested_date[:19]}Z"
                 # Сравнение нужно для того, чтобы понять, какую дату нужно использовать для следующего запроса
@@ -563,61 +4719,187 @@ def fetch_and_save_new_logs_controller(settings: "SettingParams", runtime_data:
                 # то используем дату последнего события (с микросекундами), иначе используем дату окончания текущего запроса
                 if occurred_at_zero_milliseconds == params["ended_at"]:
                     oldest_datetime = f"{suggested_date}Z"
+                    parsed_oldest = _parse_utc_datetime(oldest_datetime)
                 else:
                     oldest_datetime = ended_at.strftime(fmt)
+                    parsed_oldest = ended_at
                 
-            elif log_records == []:
+            else:
                 logger.debug(f"No new logs received for period from {params['started_at']} to {params['ended_at']}. Next turn.")
                 oldest_datetime = ended_at.strftime(fmt)
-            else:
-                break
+                parsed_oldest = ended_at
 
-            print_progress_bar(progress_start_dt, ended_at, progress_end_dt)
-            runtime_data.oldest_datetime["all"] = oldest_datetime
+            if exit_while:
+                # Последнее окно доходит до текущего момента: отметка отстает от него на задержку появления событий в API
+                watermark = _head_watermark(settings, runtime_data, "all", ended_at)
+                if watermark < parsed_oldest:
+                    oldest_datetime, parsed_oldest = watermark.strftime(fmt), watermark
+            _checkpoint_commit(runtime_data, "all", oldest_datetime, (params["started_at"], params["ended_at"]))
+            status_board.advance("all", ended_at, records_count)
 
             if exit_while:
+                completed = True
                 break
 
-        print_progress_bar(progress_start_dt, progress_end_dt, progress_end_dt)
-        sys.stdout.write('\n')
-        sys.stdout.flush()
-
     except Exception as e:
-        sys.stdout.write('\n')
-        sys.stdout.flush()
         logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+    finally:
+        status_board.finish("all", completed)
+    return completed
 
-def save_new_logs_to_file(log_records: list, settings: "SettingParams", runtime_data: "RuntimeData"):
-    result = False
-    fmt = '%Y-%m-%dT%H:%M:%SZ'
-    existing_records = runtime_data.last_records["all"]
-    separated_list = {}
-    for r in log_records:
-        if r in existing_records:
+class WindowSizer:
+    """Length of the request window for one log source derived from the observed event density.
+
+    The window is sized to hold about WINDOW_TARGET_PAGES pages of records: wider over sparse ranges,
+    narrower over dense ones. A denser window is taken into account at once, a sparser one smoothly
+    and with at most WINDOW_MAX_GROWTH times growth per window.
+    """
+
+    def __init__(self, name: str, initial_minutes: float, page_size: int):
+        self.name = name
+        self.minutes = float(initial_minutes)
+        self.target_records = WINDOW_TARGET_PAGES * page_size
+        # Записей в минуту
+        self.density = None
+        self._lock = threading.Lock()
+
+    def observe(self, started_at: datetime, ended_at: datetime, records_count: int):
+        span_minutes = (ended_at - started_at).total_seconds() / 60
+        # Короткие окна (хвост диапазона до текущего момента) почти ничего не говорят о плотности
+        if not ADAPTIVE_WINDOWS or span_minutes < WINDOW_MIN_MINUTES:
+            return
+        density = records_count / span_minutes
+        with self._lock:
+            if self.density is None or density > self.density:
+                self.density = density
+            else:
+                self.density += WINDOW_DENSITY_SMOOTHING * (density - self.density)
+            minutes = self.target_records / self.density if self.density > 0 else WINDOW_MAX_MINUTES
+            minutes = min(max(min(minutes, self.minutes * WINDOW_MAX_GROWTH), WINDOW_MIN_MINUTES), WINDOW_MAX_MINUTES)
+            if abs(minutes - self.minutes) >= 1:
+                logger.debug(f"{self.name}: {self.density:.2f} records per minute, window changed from {self.minutes:.0f} to {minutes:.0f} minutes.")
+            self.minutes = minutes
+
+def _adaptive_time_windows(start_dt: datetime, end_dt: datetime, sizer: "WindowSizer", full_windows_only: bool = True):
+    """Yield consecutive windows from start_dt to end_dt, each one sized by the sizer when it is requested.
+
+    With full_windows_only the incomplete tail of the range is not yielded, it is handled by the sequential loop.
+    """
+    window_start = start_dt
+    while window_start < end_dt:
+        window_end = window_start + timedelta(minutes=sizer.minutes)
+        if window_end >= end_dt:
+            if full_windows_only:
+                return
+            window_end = end_dt
+        yield window_start, window_end
+        window_start = window_end
+
+def _put_page(pages: queue.Queue, item, stop: threading.Event):
+    # Ожидание места в очереди прерывается, когда загрузка остановлена
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=1)
+            return True
+        except queue.Full:
             continue
-        date_part = datetime.strptime(f"{r['event']['occurred_at'][0:19]}Z", fmt).strftime("%Y-%m-%d")
-        if date_part not in separated_list.keys():
-            separated_list[date_part] = []
-        sorted_dict = {}
-        sorted_dict["full_time"] = f'{r["event"]["occurred_at"][0:19]}Z'
-        sorted_dict["data"] = r
-        separated_list[date_part].append(sorted_dict)
+    return False
 
-    for date, records in separated_list.items():
-        file_path = os.path.join(settings.dir_paths["all"], f'{settings.file_names["all"]}_{date}.{settings.ext}')
-        if len(records) > 0:
-            logger.debug(f"Writing {len(records)} records of new audit log format logs to file {file_path}")
-            try:
-                with open(file_path, 'a', encoding="utf8") as f:
-                    for r in sorted(records, key=lambda d: d["full_time"]):
-                        f.write(f"{json.dumps(r['data'], ensure_ascii=False).encode('utf8').decode()}\n")
-                    result = True
-            except Exception as e:
-                logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+def _prefetch_pages(page_iter, pages: queue.Queue, stop: threading.Event):
+    # Поток окна: страницы передаются через ограниченную очередь, ошибка - последним элементом, None - конец окна
+    try:
+        for page in page_iter:
+            if not _put_page(pages, page, stop):
+                return
+    except Exception as e:
+        _put_page(pages, e, stop)
+        return
+    finally:
+        # Остановленный генератор освобождает свои ресурсы (потоки частей почтового диапазона) сразу
+        page_iter.close()
+    _put_page(pages, None, stop)
 
-    return result
+def _iter_queued_pages(pages: queue.Queue, stop: threading.Event = None):
+    while True:
+        try:
+            item = pages.get(timeout=1 if stop is not None else None)
+        except queue.Empty:
+            # Загрузка остановлена, страниц окна больше не будет: окно не фиксируется
+            if stop.is_set():
+                raise AuditApiError("Download of the window was stopped.")
+            continue
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def backfill_new_logs(settings: "SettingParams", runtime_data: "RuntimeData", oldest_datetime: str, windows: list):
+    """Fetch independent time windows of new audit logs with a bounded worker pool.
+
+    Workers fetch pages of the windows ahead into queues of BACKFILL_PREFETCH_PAGES pages; the windows are
+    written by stream_new_logs_window (bounded reorder buffer) and committed strictly in time order,
+    so after an error or a crash there is no gap behind runtime_data.oldest_datetime["all"].
+    Returns the new watermark and a flag that all windows were committed.
+    """
+    fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+    logger.info(f"Start parallel backfill of new audit logs: {BACKFILL_MAX_WORKERS} workers.")
+    windows_iter = iter(windows)
+    pending = deque()
+    sizer = runtime_data.get_window_sizer("all")
+    executor = ThreadPoolExecutor(max_workers=BACKFILL_MAX_WORKERS, thread_name_prefix="backfill")
+    stop = threading.Event()
+
+    def submit_next_window():
+        window = next(windows_iter, None)
+        if window is None:
+            return
+        started_at, ended_at = window
+        # Добавляем микросекунду, т.к. в API запрос для начальной даты учитывет микросекунды
+        params = {
+            "started_at": (started_at + timedelta(microseconds=1)).strftime(fmt),
+            "ended_at": ended_at.strftime(fmt),
+        }
+        _checkpoint_begin(runtime_data, "all", params["started_at"], params["ended_at"])
+        # Потоки загрузки получают организацию и приоритет запросов из контекста вызывающего потока
+        context = contextvars.copy_context()
+        context.run(_set_request_priority, True)
+        pages = queue.Queue(maxsize=BACKFILL_PREFETCH_PAGES)
+        executor.submit(context.run, _prefetch_pages, iter_all_audit_log_pages(settings, params), pages, stop)
+        pending.append((params, started_at, ended_at, pages))
+
+    try:
+        # Ограничиваем количество окон в работе, чтобы не держать в памяти весь диапазон
+        for _ in range(BACKFILL_MAX_WORKERS * 2):
+            submit_next_window()
+
+        while pending:
+            params, started_at, ended_at, pages = pending.popleft()
+            # Первое окно очереди записывается по мере получения страниц, следующие окна загружаются заранее
+            error, records_count, _ = stream_new_logs_window(settings, runtime_data, params, _iter_queued_pages(pages))
+            if error:
+                logger.error(f"Error occured during reciving or saving records from new audit logs from {params['started_at']} to {params['ended_at']}. Stop backfill.")
+                return oldest_datetime, False
+            sizer.observe(started_at, ended_at, records_count)
+            logger.debug(f"Backfill window from {params['started_at']} to {params['ended_at']} committed, {records_count} records.")
+
+            oldest_datetime = ended_at.strftime(fmt)
+            _checkpoint_commit(runtime_data, "all", oldest_datetime, (params["started_at"], params["ended_at"]))
+            status_board.advance("all", ended_at, records_count)
+            submit_next_window()
+    finally:
+        # Потоки, ожидающие места в очередях окон, завершаются
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    return oldest_datetime, True
+
+def save_new_logs_to_file(log_records: list, settings: "SettingParams", runtime_data: "RuntimeData"):
+    return _save_records(settings, "all", log_records, runtime_data)
 
-def download_sсheduler(settings: "SettingParams", runtime_data: "RuntimeData"):
+def download_scheduler(settings: "SettingParams", runtime_data: "RuntimeData", cycles: int = None):
+    # cycles - количество циклов загрузки (None - бесконечно), после последнего цикла пауза не выполняется
+    cycle = 0
     while True:
         for log_source in LOGS_SOURCES:
             last_datetime = get_date_of_last_record(settings, runtime_data, log_source)
@@ -626,17 +4908,407 @@ def download_sсheduler(settings: "SettingParams", runtime_data: "RuntimeData"):
             elif log_source == "mail":
                 fetch_and_save_old_logs_controller(settings, runtime_data, last_datetime, "mail")
 
+        api_sessions.report()
+        cycle += 1
+        if cycles is not None and cycle >= cycles:
+            break
         logger.info(f"Start sleeping for {SLEEP_MINITS_AFTER_LAST_FETCH} minutes.")
         time.sleep(SLEEP_MINITS_AFTER_LAST_FETCH * 60)
 
+# Прежнее имя с кириллической "с" оставлено для совместимости
+download_sсheduler = download_scheduler
+
+def _arrival_delay(runtime_data: "RuntimeData", log_source: str):
+    # Не меньше заданной задержки API, не больше окна индекса дублей за вычетом перекрытия запросов
+    delay = (runtime_data.arrival_delays or {}).get(log_source, TAIL_API_DELAY_SECONDS)
+    return min(max(delay, TAIL_API_DELAY_SECONDS), DEDUP_WINDOW_SECONDS - TAIL_LOOKBACK_SECONDS)
+
+def _late_arrivals(settings: "SettingParams", runtime_data: "RuntimeData", log_source: str, records: list):
+    """Not yet saved records older than the end of the previous request of the source as (lag seconds, identity).
+
+    Such a record was not returned by that request, so the lag is a lower bound of its delay in the API.
+    """
+    polled_until = (runtime_data.polled_until or {}).get(log_source)
+    if polled_until is None or not records:
+        return []
+    border = (polled_until - _EPOCH).total_seconds()
+    delay = _arrival_delay(runtime_data, log_source)
+    records = [r for r in records if border - _event_timestamp(r.event_time) > delay]
+    # Идентификатор считается по строке после правил фильтра, как при записи
+    event_filter = (settings.event_filters or {}).get(log_source)
+    if event_filter is not None and records:
+        records = event_filter.apply(records, count=False)
+    dedup_index = runtime_data.last_records[log_source]
+    arrivals = [(border - _event_timestamp(r.event_time), _event_identity(r.line)) for r in records]
+    return [(lag, identity) for lag, identity in arrivals if identity not in dedup_index]
+
+def _observe_arrival_delay(runtime_data: "RuntimeData", log_source: str, arrivals: list, polled_until: datetime):
+    # Учитываются только события, попавшие в файлы (отброшенные фильтром в индекс дублей не попадают)
+    if runtime_data.arrival_delays is None:
+        runtime_data.arrival_delays = {}
+    if runtime_data.polled_until is None:
+        runtime_data.polled_until = {}
+    dedup_index = runtime_data.last_records[log_source]
+    lags = [lag for lag, identity in arrivals if identity in dedup_index]
+    if lags and max(lags) > _arrival_delay(runtime_data, log_source):
+        runtime_data.arrival_delays[log_source] = max(lags)
+        logger.info(f"{log_source}: events reach the API up to {max(lags):.0f} sec late, head watermark lags {_arrival_delay(runtime_data, log_source):.0f} sec behind now.")
+    runtime_data.polled_until[log_source] = max(polled_until, runtime_data.polled_until.get(log_source, polled_until))
+
+def _head_watermark(settings: "SettingParams", runtime_data: "RuntimeData", log_source: str, ended_at: datetime):
+    """Watermark to commit after a window ending at ended_at: not later than now minus the arrival delay of the API.
+
+    Events of the last seconds may still be missing in the API, so the next request starts before them
+    (the overlap is within DEDUP_WINDOW_SECONDS and fetched again events are dropped by the dedup index).
+    """
+    date_now = datetime.now() - timedelta(hours=settings.timezone_shift)
+    watermark = min(ended_at, date_now - timedelta(seconds=_arrival_delay(runtime_data, log_source)))
+    if runtime_data.oldest_datetime[log_source]:
+        # Отметка не сдвигается назад
+        watermark = max(watermark, _parse_utc_datetime(runtime_data.oldest_datetime[log_source]))
+    return watermark
+
+def _head_pages(settings: "SettingParams", log_source: str, params: dict):
+    # Страницы запроса режима слежения как (записи, курсор следующей страницы); у почтовых логов - части диапазона (ended_at включительно) без курсора
+    if log_source == "mail":
+        for records in iter_mail_audit_logs(settings, _parse_utc_datetime(params["started_at"]), _parse_utc_datetime(params["ended_at"]) + timedelta(milliseconds=1)):
+            yield records, None
+        return
+    yield from iter_all_audit_log_pages(settings, params)
+
+def poll_source_head(settings: "SettingParams", runtime_data: "RuntimeData", log_source: str):
+    """Fetch only new records of one source: from the end of its previous poll up to now.
+
+    The end of the previous request and the page cursor of an interrupted one are kept in runtime_data.tail_cursors,
+    so an idle poll costs one request without records. Once in TAIL_OVERLAP_POLLS polls, when the arrival delay
+    estimate grows and before the overlap leaves the dedup window, the poll starts from the last record date minus
+    TAIL_LOOKBACK_SECONDS instead: events that reached the API late are fetched there, the arrival delay is measured,
+    and the last record date is committed up to now minus that delay. Other polls do not move the last record date.
+    A source that is behind by more than one window is caught up by its regular controller.
+    Returns the number of written records or None on error.
+    """
+    fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+    oldest_datetime = runtime_data.oldest_datetime[log_source]
+    if oldest_datetime is None:
+        oldest_datetime = get_date_of_last_record(settings, runtime_data, log_source)
+    watermark = _parse_utc_datetime(oldest_datetime)
+    added_before = runtime_data.last_records[log_source].added
+    date_now = datetime.now() - timedelta(hours=settings.timezone_shift)
+    if runtime_data.tail_cursors is None:
+        runtime_data.tail_cursors = {}
+    cursor = runtime_data.tail_cursors.get(log_source)
+    delay = _arrival_delay(runtime_data, log_source)
+
+    # Отставание считается от конца предыдущего опроса, а без курсора - от отметки последней записи
+    lag = date_now - (cursor["high_water"] if cursor else watermark + timedelta(seconds=delay))
+    if lag > timedelta(minutes=runtime_data.get_window_sizer(log_source).minutes):
+        runtime_data.tail_cursors.pop(log_source, None)
+        if log_source == "mail":
+            fetch_and_save_old_logs_controller(settings, runtime_data, oldest_datetime, "mail")
+        else:
+            fetch_and_save_new_logs_controller(settings, runtime_data, oldest_datetime)
+        if runtime_data.oldest_datetime[log_source] == oldest_datetime:
+            return None
+        return max(0, runtime_data.last_records[log_source].added - added_before)
+
+    # Конец запроса включается в диапазон. У почтовых логов он берется перед границей миллисекунды: события текущей миллисекунды,
+    # появившиеся после запроса, получит следующий опрос. high_water - исключенный конец выполненного запроса
+    ended_dt = date_now
+    if log_source == "mail":
+        ended_dt = date_now.replace(microsecond=date_now.microsecond // 1000 * 1000) - timedelta(milliseconds=1)
+    overlap = (cursor is None or cursor["polls"] + 1 >= TAIL_OVERLAP_POLLS or delay > cursor["delay"]
+               or (date_now - watermark).total_seconds() + TAIL_LOOKBACK_SECONDS >= DEDUP_WINDOW_SECONDS)
+    if overlap:
+        # Перекрытие не должно выходить за окно индекса дублей, иначе повторно полученные события попадут в файлы
+        params = {"started_at": (watermark - timedelta(seconds=min(TAIL_LOOKBACK_SECONDS, DEDUP_WINDOW_SECONDS))).strftime(fmt), "ended_at": ended_dt.strftime(fmt)}
+    elif cursor["params"] is not None:
+        # Прерванный запрос продолжается со следующей страницы
+        params = cursor["params"]
+    else:
+        params = {"started_at": cursor["high_water"].strftime(fmt), "ended_at": ended_dt.strftime(fmt)}
+    started_at, ended_at = params["started_at"], params["ended_at"]
+    # Даты почтовых событий с точностью до миллисекунд
+    high_water = _parse_utc_datetime(ended_at) + timedelta(microseconds=1000 if log_source == "mail" else 1)
+
+    _set_request_priority(False)
+    arrivals = []
+    saved = False
+    try:
+        for records, iteration_key in _head_pages(settings, log_source, params):
+            if records:
+                # Окно отмечается в файле состояния только перед записью, неудачный запрос ничего не записывает
+                if not saved:
+                    _checkpoint_begin(runtime_data, log_source, started_at, ended_at)
+                    saved = True
+                if overlap:
+                    arrivals += _late_arrivals(settings, runtime_data, log_source, records)
+                if not _save_window_records(settings, runtime_data, log_source, records):
+                    logger.error(f"Error occured during saving records from {log_source} audit logs from {started_at} to {ended_at}.")
+                    return None
+            if cursor is not None and not overlap and iteration_key is not None:
+                cursor["params"] = {"started_at": started_at, "ended_at": ended_at, "iteration_key": iteration_key}
+        if overlap:
+            _observe_arrival_delay(runtime_data, log_source, arrivals, date_now)
+            watermark = _head_watermark(settings, runtime_data, log_source, date_now)
+        if overlap or saved:
+            _checkpoint_commit(runtime_data, log_source, watermark.strftime(fmt), (started_at, ended_at))
+    except AuditApiError as e:
+        logger.error(str(e))
+        logger.error(f"Error occured during reciving records from {log_source} audit logs from {started_at} to {ended_at}.")
+        return None
+    except Exception as e:
+        logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+        return None
+    runtime_data.tail_cursors[log_source] = {
+        "high_water": max(high_water, cursor["high_water"]) if cursor else high_water,
+        "params": None,
+        "polls": 0 if overlap else cursor["polls"] + 1,
+        "delay": _arrival_delay(runtime_data, log_source) if overlap else cursor["delay"],
+    }
+    return max(0, runtime_data.last_records[log_source].added - added_before)
+
+def tail_scheduler(settings: "SettingParams", runtime_data: "RuntimeData", duration_sec: float = None):
+    """Follow the head of every source instead of full passes with a fixed sleep between them.
+
+    A source that returned new records is polled again after TAIL_MIN_POLL_SEC seconds, an idle or failed one
+    TAIL_BACKOFF_FACTOR times later than before, up to SLEEP_MINITS_AFTER_LAST_FETCH minutes.
+    duration_sec - time to follow the sources (None - forever).
+    """
+    max_interval = SLEEP_MINITS_AFTER_LAST_FETCH * 60
+    intervals = {log_source: TAIL_MIN_POLL_SEC for log_source in LOGS_SOURCES}
+    next_poll = {log_source: 0.0 for log_source in LOGS_SOURCES}
+    stop_at = None if duration_sec is None else time.monotonic() + duration_sec
+    last_report = time.monotonic()
+    logger.info(f"Start following audit logs: poll interval from {TAIL_MIN_POLL_SEC} sec to {SLEEP_MINITS_AFTER_LAST_FETCH} min.")
+    while stop_at is None or time.monotonic() < stop_at:
+        for log_source in LOGS_SOURCES:
+            if next_poll[log_source] > time.monotonic():
+                continue
+            records_count = poll_source_head(settings, runtime_data, log_source)
+            if records_count:
+                intervals[log_source] = TAIL_MIN_POLL_SEC
+            else:
+                intervals[log_source] = min(max_interval, max(TAIL_MIN_POLL_SEC, intervals[log_source] * TAIL_BACKOFF_FACTOR))
+            next_poll[log_source] = time.monotonic() + intervals[log_source]
+            logger.debug(f"{log_source}: {records_count} new records, last record date {runtime_data.oldest_datetime[log_source]}, next poll in {intervals[log_source]:.0f} sec.")
+
+        if time.monotonic() - last_report >= max_interval:
+            api_sessions.report()
+            last_report = time.monotonic()
+        wake_at = min(next_poll.values())
+        if stop_at is not None:
+            wake_at = min(wake_at, stop_at)
+        time.sleep(max(0.0, wake_at - time.monotonic()))
+    api_sessions.report()
+
+class AimdLimiter:
+    """Adaptive concurrency limit for one API (additive increase, multiplicative decrease).
+
+    The limit grows by about one slot per round of successful windows and is cut by
+    AIMD_DECREASE_FACTOR when the API answers 429 or the request latency climbs.
+    """
+
+    def __init__(self, name: str, stats: "ApiSessionStats"):
+        self.name = name
+        self.stats = stats
+        self.limit = float(AIMD_INITIAL_CONCURRENCY)
+        self._in_flight = 0
+        self._min_latency = None
+        self._last_decrease = 0.0
+        import asyncio
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+        return self.stats.throttled
+
+    async def release(self, throttled_before: int):
+        async with self._condition:
+            self._in_flight -= 1
+            self._adjust(self.stats.throttled > throttled_before, self.stats.latency_ewma)
+            self._condition.notify_all()
+
+    def _adjust(self, throttled: bool, latency: float):
+        if latency > 0 and (self._min_latency is None or latency < self._min_latency):
+            self._min_latency = latency
+        congested = throttled or (self._min_latency is not None and latency > max(self._min_latency * AIMD_LATENCY_TOLERANCE, AIMD_LATENCY_FLOOR_SEC))
+        now = time.monotonic()
+        if congested:
+            # Одновременно завершившиеся окна видят одну и ту же перегрузку, поэтому уменьшаем не чаще раза за время запроса
+            if now - self._last_decrease > max(latency, 1.0):
+                self.limit = max(float(AIMD_MIN_CONCURRENCY), self.limit * AIMD_DECREASE_FACTOR)
+                self._last_decrease = now
+                logger.debug(f"{self.name}: API is overloaded (throttled - {throttled}, latency - {latency:.2f} sec). Concurrency decreased to {int(self.limit)}.")
+        else:
+            self.limit = min(float(AIMD_MAX_CONCURRENCY), self.limit + 1.0 / self.limit)
+
+
+def _fetch_window(settings: "SettingParams", log_source: str, started_at: datetime, ended_at: datetime):
+    fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+    if log_source == "mail":
+        return fetch_mail_audit_logs(settings, started_at.strftime(fmt), ended_at.strftime(fmt))
+    params = {"started_at": (started_at + timedelta(microseconds=1)).strftime(fmt), "ended_at": ended_at.strftime(fmt)}
+    return fetch_all_audit_logs_by_params(settings, params)
+
+def _save_window_records(settings: "SettingParams", runtime_data: "RuntimeData", log_source: str, records):
+    if log_source == "mail":
+        return save_old_logs_to_file(settings, "mail", records, runtime_data)
+    return save_new_logs_to_file(records, settings, runtime_data)
+
+def _window_pages(settings: "SettingParams", log_source: str, started_at: datetime, ended_at: datetime):
+    # Страницы окна в порядке времени: части почтового диапазона (ended_at включительно) или страницы API нового формата
+    fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+    if log_source == "mail":
+        return iter_mail_audit_logs(settings, started_at, ended_at + timedelta(milliseconds=1))
+    params = {"started_at": (started_at + timedelta(microseconds=1)).strftime(fmt), "ended_at": ended_at.strftime(fmt)}
+    return iter_all_audit_log_pages(settings, params)
+
+def _measured_pages(settings: "SettingParams", runtime_data: "RuntimeData", log_source: str, pages, arrivals: list):
+    # Запоздавшие записи определяются до записи страницы, пока их ещё нет в индексе сохранённых записей
+    for page in pages:
+        arrivals.extend(_late_arrivals(settings, runtime_data, log_source, page if log_source == "mail" else page[0]))
+        yield page
+
+def _write_window(settings: "SettingParams", runtime_data: "RuntimeData", log_source: str, started_at: datetime, ended_at: datetime, pages: queue.Queue,
+                  stop: threading.Event):
+    """Write one window of the async scheduler from its page queue and commit it.
+
+    Runs in an executor thread: records go through the same streaming writers as the sequential download, and
+    the checkpoint commit (flush and fsync of files, exports of followers) does not block the event loop.
+    Returns error flag and number of received records.
+    """
+    fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+    arrivals = []
+    window_pages = _measured_pages(settings, runtime_data, log_source, _iter_queued_pages(pages, stop), arrivals)
+    if log_source == "mail":
+        error, records_count, _ = stream_mail_logs_window(settings, runtime_data, started_at.strftime(fmt), ended_at.strftime(fmt), window_pages)
+    else:
+        params = {"started_at": (started_at + timedelta(microseconds=1)).strftime(fmt), "ended_at": ended_at.strftime(fmt)}
+        error, records_count, _ = stream_new_logs_window(settings, runtime_data, params, window_pages)
+    if error:
+        return True, records_count
+    try:
+        _observe_arrival_delay(runtime_data, log_source, arrivals, ended_at)
+        # Окна у текущего момента фиксируются с отставанием на задержку API, иначе запоздавшие события теряются
+        watermark = _head_watermark(settings, runtime_data, log_source, ended_at)
+        _checkpoint_commit(runtime_data, log_source, watermark.strftime(fmt), (started_at.strftime(fmt), ended_at.strftime(fmt)))
+    except Exception as e:
+        logger.error(f"{type(e).__name__} at line {e.__traceback__.tb_lineno} of {__file__}: {e}")
+        return True, records_count
+    return False, records_count
+
+async def async_sync_source(settings: "SettingParams", runtime_data: "RuntimeData", log_source: str, limiter: "AimdLimiter", executor: ThreadPoolExecutor):
+    """Download one log source from its watermark up to now with several windows in flight.
+
+    Windows are fetched concurrently within the limiter budget into queues of BACKFILL_PREFETCH_PAGES pages and
+    written and committed strictly in time order by _write_window in the executor.
+    """
+    import asyncio
+    fmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+    loop = asyncio.get_running_loop()
+    oldest_datetime = await loop.run_in_executor(executor, get_date_of_last_record, settings, runtime_data, log_source)
+    start_dt = _parse_utc_datetime(oldest_datetime)
+    end_dt = datetime.now() - timedelta(hours=settings.timezone_shift)
+    if start_dt >= end_dt:
+        return
+    sizer = runtime_data.get_window_sizer(log_source)
+    if log_source == "mail":
+        # Даты почтовых событий с точностью до миллисекунд: сдвигаем только начало первого окна, чтобы не получить повторно последнюю запись,
+        # границы следующих окон не совпадают с датами событий и не сдвигаются, иначе теряются события внутри сдвига
+        start_dt += timedelta(microseconds=1000)
+    windows = _adaptive_time_windows(start_dt, end_dt, sizer, full_windows_only=False)
+    logger.info(f"Started {log_source} audit logs download process from {oldest_datetime}, window {sizer.minutes:.0f} minutes.")
+    status_board.begin(log_source, start_dt, end_dt)
+
+    stop = threading.Event()
+
+    async def fetch(started_at, ended_at, pages):
+        throttled_before = await limiter.acquire()
+        # run_in_executor не передает контекст (организацию и приоритет запросов) в поток, передаем явно
+        context = contextvars.copy_context()
+        context.run(_set_request_priority, ended_at < end_dt)
+        try:
+            await loop.run_in_executor(executor, context.run, _prefetch_pages, _window_pages(settings, log_source, started_at, ended_at), pages, stop)
+        finally:
+            await limiter.release(throttled_before)
+
+    windows_iter = iter(windows)
+    pending = deque()
+
+    def submit_next_window():
+        window = next(windows_iter, None)
+        if window is not None:
+            _checkpoint_begin(runtime_data, log_source, window[0].strftime(fmt), window[1].strftime(fmt))
+            # Окно загружается в ограниченную очередь страниц, в памяти не бывает всех записей окна
+            pages = queue.Queue(maxsize=BACKFILL_PREFETCH_PAGES)
+            pending.append((window, pages, asyncio.create_task(fetch(*window, pages))))
+
+    for _ in range(AIMD_MAX_CONCURRENCY * 2):
+        submit_next_window()
+
+    records_count = 0
+    completed = False
+    try:
+        while pending:
+            (started_at, ended_at), pages, task = pending[0]
+            # Первое окно очереди записывается и фиксируется в потоке по мере получения страниц, следующие загружаются заранее
+            error, window_count = await loop.run_in_executor(executor, _write_window, settings, runtime_data, log_source, started_at, ended_at, pages, stop)
+            if error:
+                logger.error(f"Error occured during reciving or saving records from {log_source} audit logs from {started_at.strftime(fmt)} to {ended_at.strftime(fmt)}. Force quite cycle.")
+                return
+            await task
+            pending.popleft()
+            sizer.observe(started_at, ended_at, window_count)
+            records_count += window_count
+            status_board.advance(log_source, ended_at, window_count)
+            logger.debug(f"{log_source}: window from {started_at.strftime(fmt)} to {ended_at.strftime(fmt)} committed, {window_count} records, concurrency {int(limiter.limit)}.")
+            submit_next_window()
+        completed = True
+    finally:
+        status_board.finish(log_source, completed)
+        # Потоки, ожидающие места в очередях окон, завершаются
+        stop.set()
+        for _, _, task in pending:
+            task.cancel()
+        await asyncio.gather(*(task for _, _, task in pending), return_exceptions=True)
+        logger.info(f"Finished {log_source} audit logs download process: {records_count} records, last record date {runtime_data.oldest_datetime[log_source]}.")
+
+async def async_download_scheduler(settings: "SettingParams", runtime_data: "RuntimeData", cycles: int = None):
+    import asyncio
+    base_urls = {"mail": DEFAULT_360_API_URL, "all": NEW_360_API_URL}
+    for log_source in LOGS_SOURCES:
+        api_sessions.session(base_urls[log_source])
+    limiters = {log_source: AimdLimiter(log_source, api_sessions.stats[base_urls[log_source]]) for log_source in LOGS_SOURCES}
+    with ThreadPoolExecutor(max_workers=AIMD_MAX_CONCURRENCY * len(LOGS_SOURCES) + len(LOGS_SOURCES), thread_name_prefix="async_fetch") as executor:
+        cycle = 0
+        while True:
+            await asyncio.gather(*(async_sync_source(settings, runtime_data, log_source, limiters[log_source], executor) for log_source in LOGS_SOURCES))
+            api_sessions.report()
+            cycle += 1
+            if cycles is not None and cycle >= cycles:
+                break
+            logger.info(f"Start sleeping for {SLEEP_MINITS_AFTER_LAST_FETCH} minutes.")
+            await asyncio.sleep(SLEEP_MINITS_AFTER_LAST_FETCH * 60)
+
 if __name__ == "__main__":
 
     denv_path = os.path.join(os.path.dirname(__file__), '.env')
 
     if os.path.exists(denv_path):
+        from dotenv import load_dotenv
         load_dotenv(dotenv_path=denv_path,verbose=True, override=True)
 
     try:
+        if sys.argv[1:2] in (["-h"], ["--help"]):
+            print(f"usage: run_import.py [{{{','.join(_COMMANDS)}}}] ...\n")
+            for name, command in _COMMANDS.items():
+                print(f"  {name:<10}{command.__doc__.split(': ', 1)[1].split('. ')[0].rstrip('.')}")
+            sys.exit(0)
+        command = _COMMANDS.get(sys.argv[1]) if len(sys.argv) > 1 else None
+        if command is not None:
+            sys.exit(command(sys.argv[2:]))
         main()
     except KeyboardInterrupt:
         logger.info("\nCtrl+C pressed. До свидания!")
@@ -0,0 +1,51 @@
+import os
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, ".."))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmarks"))
+
+import mock_api  # noqa: E402
+import run_import  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def log_file(tmp_path):
+    # Журнал загрузки пишется во временный каталог теста
+    run_import.set_log_file(str(tmp_path / run_import.LOG_FILE))
+
+
+@pytest.fixture
+def settings(tmp_path):
+    """Settings of one organization with day files in the temporary directory of the test."""
+    shift = round(datetime.now().astimezone().utcoffset().total_seconds() / 3600)
+    dir_paths = {"mail": Path(tmp_path, "mail"), "all": Path(tmp_path, "all")}
+    for path in dir_paths.values():
+        path.mkdir()
+    return run_import.SettingParams(oauth_token="test", organization_id=1, dir_paths=dir_paths, ext="json",
+                                    file_names={"mail": "mail_audit", "all": "y360_audit"}, timezone_shift=shift)
+
+
+@pytest.fixture
+def audit_api(monkeypatch):
+    """Start benchmarks/mock_api.py in a thread with the given MockConfig and direct run_import to it."""
+    servers = []
+
+    def start(config: "mock_api.MockConfig"):
+        server = mock_api.MockAuditApi(("127.0.0.1", 0), config)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        monkeypatch.setattr(run_import, "DEFAULT_360_API_URL", base_url)
+        monkeypatch.setattr(run_import, "NEW_360_API_URL", f"{base_url}/v1")
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
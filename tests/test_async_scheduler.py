@@ -0,0 +1,58 @@
+"""Async scheduler: windows are streamed through page queues and committed outside the event loop thread."""
+import asyncio
+import json
+import os
+import threading
+
+import mock_api
+import run_import
+
+
+def saved_ids(settings, log_source: str):
+    ids = []
+    for name in sorted(run_import._log_file_names(settings, log_source)):
+        with open(os.path.join(settings.dir_paths[log_source], name), "r", encoding="utf8") as f:
+            for line in f:
+                data = json.loads(line)
+                ids.append(data["event"]["idempotency_id"] if log_source == "all" else data["uniqId"])
+    return ids
+
+
+def test_windows_are_committed_outside_event_loop(settings, audit_api, monkeypatch):
+    monkeypatch.setattr(run_import, "LOGS_SOURCES", ["mail", "all"])
+    monkeypatch.setattr(run_import, "MAX_DAYS_AGO_FOR_API_CALLS", 2)
+    monkeypatch.setattr(run_import, "STREAM_REORDER_BUFFER_RECORDS", 150)
+    server = audit_api(mock_api.MockConfig(events=5000, days=1.5))
+    commit_threads = set()
+    checkpoint_commit = run_import._checkpoint_commit
+
+    def counted_commit(*args, **kwargs):
+        commit_threads.add(threading.current_thread() is threading.main_thread())
+        return checkpoint_commit(*args, **kwargs)
+
+    monkeypatch.setattr(run_import, "_checkpoint_commit", counted_commit)
+    runtime_data = run_import.create_runtime_data(settings)
+    asyncio.run(run_import.async_download_scheduler(settings, runtime_data, cycles=1))
+    runtime_data.close()
+
+    # Фиксация окон (fsync файлов и файла состояния) не выполняется в потоке цикла событий
+    assert commit_threads == {False}
+    for log_source in ("mail", "all"):
+        ids = saved_ids(settings, log_source)
+        assert len(ids) == len(set(ids))
+    assert set(saved_ids(settings, "all")) == {json.loads(item[1])["event"]["idempotency_id"] for item in server.new}
+    assert set(saved_ids(settings, "mail")) == {json.loads(item[1])["uniqId"] for item in server.mail}
+
+
+def test_failed_window_stops_source_without_commit(settings, audit_api, monkeypatch):
+    monkeypatch.setattr(run_import, "LOGS_SOURCES", ["all"])
+    monkeypatch.setattr(run_import, "MAX_DAYS_AGO_FOR_API_CALLS", 1)
+    monkeypatch.setattr(run_import, "RETRIES_DELAY_SEC", 0.01)
+    monkeypatch.setattr(run_import, "RETRIES_MAX_DELAY_SEC", 0.05)
+    audit_api(mock_api.MockConfig(events=1000, days=1, error_rate=1.0))
+    runtime_data = run_import.create_runtime_data(settings)
+    # Потоки окон, ожидающие места в очередях страниц, завершаются вместе с загрузкой источника
+    asyncio.run(asyncio.wait_for(run_import.async_download_scheduler(settings, runtime_data, cycles=1), 60))
+    assert runtime_data.oldest_datetime["all"] is None
+    assert runtime_data.checkpoints["all"].watermark is None
+    runtime_data.close()
@@ -0,0 +1,65 @@
+"""Parallel backfill of new format logs: a window interrupted by a restart is finished from its saved page cursor."""
+import json
+import os
+from datetime import datetime, timezone
+
+import mock_api
+import run_import
+
+FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def utc(micros: int):
+    return datetime.fromtimestamp(micros / 1000000, tz=timezone.utc).replace(tzinfo=None)
+
+
+def saved_ids(settings):
+    ids = []
+    for name in run_import._log_file_names(settings, "all"):
+        with open(os.path.join(settings.dir_paths["all"], name), "r", encoding="utf8") as f:
+            ids += [json.loads(line)["event"]["idempotency_id"] for line in f]
+    return ids
+
+
+def test_interrupted_window_is_resumed_before_backfill(settings, audit_api, monkeypatch):
+    monkeypatch.setattr(run_import, "LOGS_SOURCES", ["all"])
+    monkeypatch.setattr(run_import, "ADAPTIVE_WINDOWS", False)
+    server = audit_api(mock_api.MockConfig(events=20000, days=1))
+    # Прерванное окно: первые 300 событий записаны до сбоя, курсор указывает на следующую страницу
+    watermark, window_end = utc(server.new_keys[4000]), utc(server.new_keys[5000])
+    cursor = {"started_at": (watermark + run_import.timedelta(microseconds=1)).strftime(FMT), "ended_at": window_end.strftime(FMT), "iteration_key": "300"}
+    checkpoint_path = os.path.join(settings.dir_paths["all"], f"{settings.file_names['all']}{run_import.CHECKPOINT_FILE_SUFFIX}")
+    run_import.CheckpointStore(checkpoint_path).commit(watermark.strftime(FMT), run_import.DedupIndex(), cursor=cursor)
+
+    backfills = []
+    backfill_new_logs = run_import.backfill_new_logs
+
+    def counted_backfill(settings, runtime_data, oldest_datetime, windows):
+        backfills.append(oldest_datetime)
+        return backfill_new_logs(settings, runtime_data, oldest_datetime, windows)
+
+    monkeypatch.setattr(run_import, "backfill_new_logs", counted_backfill)
+    runtime_data = run_import.create_runtime_data(settings)
+    last_datetime = run_import.get_date_of_last_record(settings, runtime_data, "all")
+    assert run_import.fetch_and_save_new_logs_controller(settings, runtime_data, last_datetime) is True
+    runtime_data.close()
+
+    # Параллельная загрузка начинается от конца продолженного окна
+    assert backfills == [window_end.strftime(FMT)]
+    window = [json.loads(item[1])["event"]["idempotency_id"] for item in server.new if watermark < utc(item[0]) <= window_end]
+    expected = {json.loads(item[1])["event"]["idempotency_id"] for item in server.new if utc(item[0]) > watermark} - set(window[:300])
+    ids = saved_ids(settings)
+    assert len(ids) == len(set(ids))
+    assert set(ids) == expected
+
+
+def test_failed_backfill_returns_false(settings, audit_api, monkeypatch):
+    monkeypatch.setattr(run_import, "LOGS_SOURCES", ["all"])
+    monkeypatch.setattr(run_import, "MAX_DAYS_AGO_FOR_API_CALLS", 1)
+    monkeypatch.setattr(run_import, "RETRIES_DELAY_SEC", 0.01)
+    monkeypatch.setattr(run_import, "RETRIES_MAX_DELAY_SEC", 0.05)
+    audit_api(mock_api.MockConfig(events=1000, days=1, error_rate=1.0))
+    runtime_data = run_import.create_runtime_data(settings)
+    last_datetime = run_import.get_date_of_last_record(settings, runtime_data, "all")
+    assert run_import.fetch_and_save_new_logs_controller(settings, runtime_data, last_datetime) is False
+    runtime_data.close()
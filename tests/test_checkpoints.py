@@ -0,0 +1,48 @@
+"""Checkpoint file of a log source: windows in flight stay bounded when writes fail, watermark after a successful poll."""
+import json
+from datetime import datetime, timedelta
+
+import mock_api
+import run_import
+
+FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def test_windows_in_flight_are_removed_one_by_one(tmp_path):
+    checkpoint = run_import.CheckpointStore(str(tmp_path / "state"))
+    # Соседние окна параллельной загрузки не объединяются: каждое убирается своей фиксацией
+    windows = [("2025-01-01T00:00:00.000001Z", "2025-01-01T01:00:00.000000Z"),
+               ("2025-01-01T01:00:00.000001Z", "2025-01-01T02:00:00.000000Z"),
+               ("2025-01-01T02:00:00.000000Z", "2025-01-01T03:00:00.000000Z")]
+    for window in windows:
+        checkpoint.begin_window(*window)
+    assert len(checkpoint.in_flight) == 3
+    checkpoint.commit(windows[1][1], run_import.DedupIndex(), windows[1])
+    assert checkpoint.in_flight == [list(windows[0]), list(windows[2])]
+    checkpoint.commit(windows[0][1], run_import.DedupIndex(), windows[0])
+    checkpoint.commit(windows[2][1], run_import.DedupIndex(), windows[2])
+    assert checkpoint.in_flight == []
+
+
+def test_failed_head_polls_do_not_grow_checkpoint(settings, audit_api, monkeypatch):
+    monkeypatch.setattr(run_import, "LOGS_SOURCES", ["all"])
+    audit_api(mock_api.MockConfig(events=10, days=0.01, live_rate=200))
+    runtime_data = run_import.create_runtime_data(settings)
+    checkpoint = runtime_data.checkpoints["all"]
+    date_now = datetime.now() - timedelta(hours=settings.timezone_shift)
+    runtime_data.oldest_datetime["all"] = (date_now - timedelta(seconds=30)).strftime(FMT)
+
+    save_window_records = run_import._save_window_records
+    monkeypatch.setattr(run_import, "_save_window_records", lambda *args: False)
+    for _ in range(20):
+        assert run_import.poll_source_head(settings, runtime_data, "all") is None
+    # Каждый неудачный опрос начинает окно, перекрывающееся с предыдущим: в файле состояния остаётся одно окно
+    assert len(checkpoint.in_flight) == 1
+    with open(checkpoint.file_path, "r", encoding="utf8") as f:
+        assert len(json.load(f)["in_flight"]) == 1
+
+    monkeypatch.setattr(run_import, "_save_window_records", save_window_records)
+    assert run_import.poll_source_head(settings, runtime_data, "all")
+    assert checkpoint.in_flight == []
+    assert checkpoint.watermark == runtime_data.oldest_datetime["all"]
+    runtime_data.close()
@@ -0,0 +1,201 @@
+"""Delivery sinks against the local stand-ins of benchmarks/mock_sinks.py: syslog TCP, Elasticsearch bulk, Splunk HEC, Kafka REST.
+
+Records are written to the day files and committed the way the download does, the stand-ins keep what they received.
+
+Usage: python -m pytest -q tests
+"""
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, ".."))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmarks"))
+
+import mock_api  # noqa: E402
+import mock_sinks  # noqa: E402
+import run_import  # noqa: E402
+
+START_US = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp() * 1000000)
+
+
+@pytest.fixture(autouse=True)
+def fast_sinks(monkeypatch, tmp_path):
+    monkeypatch.setattr(run_import, "LOGS_SOURCES", ["all"])
+    monkeypatch.setattr(run_import, "SINK_BATCH_RECORDS", 100)
+    monkeypatch.setattr(run_import, "SINK_CLOSE_TIMEOUT_SEC", 5)
+    # Повторы отправки без многосекундных пауз
+    monkeypatch.setattr(run_import, "RETRIES_DELAY_SEC", 0.01)
+    monkeypatch.setattr(run_import, "RETRIES_MAX_DELAY_SEC", 0.1)
+    run_import.set_log_file(str(tmp_path / run_import.LOG_FILE))
+
+
+def start(config: mock_sinks.SinkConfig = None):
+    syslog_server, http_server, received = mock_sinks.start_sinks(config or mock_sinks.SinkConfig())
+    return syslog_server, http_server, received
+
+
+def make_settings(directory: Path, sink_urls: list):
+    dir_paths = {"mail": directory / "mail", "all": directory / "all"}
+    for path in dir_paths.values():
+        path.mkdir(parents=True, exist_ok=True)
+    return run_import.SettingParams(oauth_token="test", organization_id=1, dir_paths=dir_paths, ext="json",
+                                    file_names={"mail": "mail_audit", "all": "y360_audit"}, timezone_shift=0, sink_urls=sink_urls)
+
+
+def make_records(first: int, count: int):
+    lines = [mock_api.make_events(number, START_US + number * 1000000)[1][1] for number in range(first, first + count)]
+    return [run_import.AuditRecord.from_new(json.loads(line)) for line in lines]
+
+
+def identities(records: list):
+    return [json.loads(r.line)["event"]["idempotency_id"] for r in records]
+
+
+def save_and_commit(runtime_data, settings, records: list):
+    assert run_import._save_records(settings, "all", records, runtime_data)
+    run_import._checkpoint_commit(runtime_data, "all", records[-1].event_time)
+
+
+def received_ids(received: mock_sinks.ReceivedRecords, kind: str):
+    with received.lock:
+        return [identity for identity, _ in received.records.get(kind, [])]
+
+
+def wait_for(condition, timeout: float = 10):
+    stop_at = time.monotonic() + timeout
+    while time.monotonic() < stop_at:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+@pytest.mark.parametrize("kind", ["syslog", "bulk", "hec", "kafka"])
+def test_records_are_delivered_once(tmp_path, kind):
+    syslog_server, http_server, received = start()
+    try:
+        settings = make_settings(tmp_path, mock_sinks.sink_urls(syslog_server, http_server, [kind]))
+        runtime_data = run_import.create_runtime_data(settings)
+        records = make_records(0, 250)
+        save_and_commit(runtime_data, settings, records[:120])
+        save_and_commit(runtime_data, settings, records[120:])
+        runtime_data.close()
+        assert wait_for(lambda: len(received_ids(received, kind)) >= len(records))
+        assert sorted(received_ids(received, kind)) == sorted(identities(records))
+    finally:
+        syslog_server.shutdown()
+        http_server.shutdown()
+
+
+def test_batches_are_limited_by_records_and_bytes(tmp_path, monkeypatch):
+    syslog_server, http_server, received = start()
+    try:
+        settings = make_settings(tmp_path, mock_sinks.sink_urls(syslog_server, http_server, ["bulk"]))
+        runtime_data = run_import.create_runtime_data(settings)
+        save_and_commit(runtime_data, settings, make_records(0, 450))
+        assert wait_for(lambda: len(received_ids(received, "bulk")) == 450)
+        # 450 записей пакетами по SINK_BATCH_RECORDS = 100
+        assert received.stats["requests"] == 5
+
+        records = make_records(450, 100)
+        monkeypatch.setattr(run_import, "SINK_BATCH_BYTES", sum(len(r.line) + 1 for r in records[:10]))
+        save_and_commit(runtime_data, settings, records)
+        runtime_data.close()
+        assert len(received_ids(received, "bulk")) == 550
+        assert received.stats["requests"] == 5 + 10
+    finally:
+        syslog_server.shutdown()
+        http_server.shutdown()
+
+
+def test_only_rejected_bulk_items_are_sent_again(tmp_path):
+    syslog_server, http_server, received = start(mock_sinks.SinkConfig(item_error_rate=0.2))
+    try:
+        settings = make_settings(tmp_path, mock_sinks.sink_urls(syslog_server, http_server, ["bulk"]))
+        runtime_data = run_import.create_runtime_data(settings)
+        records = make_records(0, 500)
+        save_and_commit(runtime_data, settings, records)
+        runtime_data.close()
+        assert received.stats["item_errors"] > 0
+        # Принятые документы не отправляются повторно: получатель не отвечал 409 на уже созданные
+        assert received.stats["duplicates_refused"] == 0
+        assert sorted(received_ids(received, "bulk")) == sorted(identities(records))
+    finally:
+        syslog_server.shutdown()
+        http_server.shutdown()
+
+
+def test_failed_kafka_batches_are_sent_again(tmp_path):
+    syslog_server, http_server, received = start(mock_sinks.SinkConfig(item_error_rate=0.3))
+    try:
+        settings = make_settings(tmp_path, mock_sinks.sink_urls(syslog_server, http_server, ["kafka"]))
+        runtime_data = run_import.create_runtime_data(settings)
+        records = make_records(0, 500)
+        save_and_commit(runtime_data, settings, records)
+        runtime_data.close()
+        assert received.stats["item_errors"] > 0
+        assert sorted(received_ids(received, "kafka")) == sorted(identities(records))
+    finally:
+        syslog_server.shutdown()
+        http_server.shutdown()
+
+
+def test_unconfirmed_records_are_sent_after_restart(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_import, "SINK_CLOSE_TIMEOUT_SEC", 1)
+    syslog_server, http_server, received = start()
+    try:
+        settings = make_settings(tmp_path, mock_sinks.sink_urls(syslog_server, http_server, ["bulk"]))
+        runtime_data = run_import.create_runtime_data(settings)
+        confirmed, unconfirmed = make_records(0, 200), make_records(200, 150)
+        save_and_commit(runtime_data, settings, confirmed)
+        assert wait_for(lambda: len(received_ids(received, "bulk")) == 200)
+        # Получатель недоступен: записи остаются в файлах дней, файл состояния не отмечает их подтверждёнными
+        http_server.set_outage(60)
+        save_and_commit(runtime_data, settings, unconfirmed)
+        runtime_data.close()
+        assert len(received_ids(received, "bulk")) == 200
+
+        http_server.set_outage(0)
+        runtime_data = run_import.create_runtime_data(settings)
+        runtime_data.close()
+        assert sorted(received_ids(received, "bulk")) == sorted(identities(confirmed + unconfirmed))
+        # Подтверждённые до перезапуска записи не отправляются повторно
+        assert received.stats["duplicates_refused"] == 0
+    finally:
+        syslog_server.shutdown()
+        http_server.shutdown()
+
+
+def test_watermark_waits_for_sink_confirmation(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_import, "SINK_MAX_BACKLOG_MB", 0)
+    syslog_server, http_server, received = start()
+    try:
+        settings = make_settings(tmp_path, mock_sinks.sink_urls(syslog_server, http_server, ["hec"]))
+        runtime_data = run_import.create_runtime_data(settings)
+        records = make_records(0, 150)
+        assert run_import._save_records(settings, "all", records, runtime_data)
+        http_server.set_outage(60)
+        commit = threading.Thread(target=run_import._checkpoint_commit, args=(runtime_data, "all", records[-1].event_time))
+        commit.start()
+        # Пока получатель не подтвердил записи, отметка последней записи не сдвигается ни в памяти, ни в файле состояния
+        assert wait_for(lambda: received.stats["errors"] >= 3)
+        assert commit.is_alive()
+        assert runtime_data.oldest_datetime["all"] is None
+        assert not run_import.CheckpointStore(runtime_data.checkpoints["all"].file_path).load(run_import.DedupIndex())
+
+        http_server.set_outage(0)
+        commit.join(10)
+        assert not commit.is_alive()
+        assert runtime_data.oldest_datetime["all"] == records[-1].event_time
+        assert sorted(received_ids(received, "hec")) == sorted(identities(records))
+        runtime_data.close()
+    finally:
+        syslog_server.shutdown()
+        http_server.shutdown()
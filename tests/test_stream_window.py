@@ -0,0 +1,52 @@
+"""Streaming write of a window of new format logs when the API returns pages not in ascending time order."""
+import json
+import os
+import random
+from datetime import datetime, timezone
+
+import pytest
+
+import mock_api
+import run_import
+
+START_US = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp() * 1000000)
+
+
+def make_pages(order: str):
+    records = [run_import.AuditRecord.from_new(json.loads(mock_api.make_events(number, START_US + number * 1000000)[1][1]))
+               for number in range(1000)]
+    pages = [records[start:start + 100] for start in range(0, len(records), 100)]
+    if order == "descending":
+        pages.reverse()
+    elif order == "interleaved":
+        random.Random(1).shuffle(pages)
+    return records, [(page, None) for page in pages]
+
+
+def read_day_files(settings):
+    lines = []
+    for name in sorted(run_import._log_file_names(settings, "all")):
+        with open(os.path.join(settings.dir_paths["all"], name), "r", encoding="utf8") as f:
+            lines += [json.loads(line)["event"] for line in f]
+    return lines
+
+
+@pytest.mark.parametrize("mode", ["append", "merge"])
+@pytest.mark.parametrize("order", ["ascending", "descending", "interleaved"])
+def test_window_lines_stay_ordered(settings, monkeypatch, order, mode):
+    monkeypatch.setattr(run_import, "LOGS_SOURCES", ["all"])
+    monkeypatch.setattr(run_import, "LATE_EVENTS_MODE", mode)
+    monkeypatch.setattr(run_import, "STREAM_REORDER_BUFFER_RECORDS", 150)
+    records, pages = make_pages(order)
+    runtime_data = run_import.create_runtime_data(settings)
+    params = {"started_at": "2025-01-01T00:00:00.000000Z", "ended_at": "2025-01-02T00:00:00.000000Z"}
+    error, records_count, newest_occurred_at = run_import.stream_new_logs_window(settings, runtime_data, params, iter(pages))
+    assert not error and records_count == len(records)
+    assert newest_occurred_at == records[-1].event_time
+    run_import._checkpoint_commit(runtime_data, "all", newest_occurred_at)
+    # Прогоны записей, пришедших после более новых, объединяются с файлом дня при завершении
+    runtime_data.close()
+
+    assert run_import._late_run_names(settings, "all") == []
+    events = read_day_files(settings)
+    assert [event["idempotency_id"] for event in events] == [f"all-{number}" for number in range(len(records))]
@@ -0,0 +1,118 @@
+"""Tail mode: polls fetch only new events from the cursor kept between them, the arrival delay overlap is requested occasionally."""
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import mock_api
+import run_import
+
+FMT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def utc(micros: int):
+    return datetime.fromtimestamp(micros / 1000000, tz=timezone.utc).replace(tzinfo=None)
+
+
+def start_tail(settings, audit_api, monkeypatch, log_source: str, config: "mock_api.MockConfig"):
+    monkeypatch.setattr(run_import, "LOGS_SOURCES", [log_source])
+    server = audit_api(config)
+    runtime_data = run_import.create_runtime_data(settings)
+    date_now = datetime.now() - timedelta(hours=settings.timezone_shift)
+    runtime_data.oldest_datetime[log_source] = (date_now - timedelta(seconds=30)).strftime(FMT)
+    return server, runtime_data
+
+
+def poll(settings, runtime_data, server, log_source: str):
+    """One poll as (written records, requests, records served by the API)."""
+    before = dict(server.stats)
+    added = run_import.poll_source_head(settings, runtime_data, log_source)
+    return added, server.stats[f"{log_source}_requests"] - before[f"{log_source}_requests"], server.stats["events_served"] - before["events_served"]
+
+
+def saved_ids(settings, log_source: str):
+    ids = []
+    for name in run_import._log_file_names(settings, log_source):
+        with open(os.path.join(settings.dir_paths[log_source], name), "r", encoding="utf8") as f:
+            for line in f:
+                data = json.loads(line)
+                ids.append(data["event"]["idempotency_id"] if log_source == "all" else data["uniqId"])
+    return ids
+
+
+@pytest.mark.parametrize("log_source", ["mail", "all"])
+def test_idle_poll_is_one_request_without_records(settings, audit_api, monkeypatch, log_source):
+    monkeypatch.setattr(run_import, "TAIL_OVERLAP_POLLS", 100)
+    server, runtime_data = start_tail(settings, audit_api, monkeypatch, log_source, mock_api.MockConfig(events=10, days=1))
+    assert poll(settings, runtime_data, server, log_source)[1] == 1
+    watermark = runtime_data.oldest_datetime[log_source]
+    for _ in range(5):
+        assert poll(settings, runtime_data, server, log_source) == (0, 1, 0)
+    # Опросы без перекрытия не сдвигают отметку последней записи
+    assert runtime_data.oldest_datetime[log_source] == watermark
+    runtime_data.close()
+
+
+@pytest.mark.parametrize("log_source", ["mail", "all"])
+def test_active_poll_fetches_only_new_records(settings, audit_api, monkeypatch, log_source):
+    monkeypatch.setattr(run_import, "TAIL_OVERLAP_POLLS", 4)
+    server, runtime_data = start_tail(settings, audit_api, monkeypatch, log_source, mock_api.MockConfig(events=10, days=1, live_rate=200))
+    overlaps = 0
+    for number in range(12):
+        time.sleep(0.1)
+        added, requests, served = poll(settings, runtime_data, server, log_source)
+        if number % 4 == 0:
+            # Запрос с перекрытием повторно получает записанные после прошлого перекрытия события
+            overlaps += served > added
+        else:
+            # Запрос почтовых логов шире диапазона на миллисекунду с каждой стороны, записи этих миллисекунд отбрасываются по времени
+            assert requests == 1 and 0 < added <= served <= added + (2 if log_source == "mail" else 0)
+    assert overlaps == 2
+    ids = saved_ids(settings, log_source)
+    assert len(ids) == len(set(ids))
+    # Сохранены все новые события до конца последнего запроса
+    high_water = runtime_data.tail_cursors[log_source]["high_water"]
+    if log_source == "mail":
+        live = {json.loads(item[1])["uniqId"] for item in server.mail[server.config.events:] if utc(item[0]) < high_water}
+    else:
+        live = {json.loads(item[1])["event"]["idempotency_id"] for item in server.new[server.config.events:] if utc(item[0]) < high_water}
+    assert live and live <= set(ids)
+    runtime_data.close()
+
+
+def test_interrupted_poll_resumes_from_page_cursor(settings, audit_api, monkeypatch):
+    monkeypatch.setattr(run_import, "TAIL_OVERLAP_POLLS", 100)
+    server, runtime_data = start_tail(settings, audit_api, monkeypatch, "all", mock_api.MockConfig(events=10, days=1, live_rate=2000))
+    poll(settings, runtime_data, server, "all")
+    time.sleep(0.2)
+    iter_pages = run_import.iter_all_audit_log_pages
+    requested = []
+
+    def failing_pages(settings, params):
+        # Ошибка при получении второй страницы запроса
+        requested.append(dict(params))
+        pages = iter_pages(settings, params)
+        yield next(pages)
+        raise run_import.AuditApiError("Page is not received.")
+
+    monkeypatch.setattr(run_import, "iter_all_audit_log_pages", failing_pages)
+    assert poll(settings, runtime_data, server, "all") == (None, 1, 100)
+    cursor = runtime_data.tail_cursors["all"]["params"]
+    assert cursor["iteration_key"] == "100"
+
+    monkeypatch.setattr(run_import, "iter_all_audit_log_pages", iter_pages)
+    requests_before, served_before = server.stats["all_requests"], server.stats["events_served"]
+    added = run_import.poll_source_head(settings, runtime_data, "all")
+    # Продолжение запрашивает только оставшиеся страницы прерванного запроса
+    assert server.stats["events_served"] - served_before == added
+    assert server.stats["all_requests"] - requests_before == -(-added // 100)
+    assert runtime_data.tail_cursors["all"]["params"] is None
+    assert runtime_data.tail_cursors["all"]["high_water"] > run_import._parse_utc_datetime(cursor["ended_at"])
+    ids = saved_ids(settings, "all")
+    assert len(ids) == len(set(ids))
+    window = {json.loads(item[1])["event"]["idempotency_id"] for item in server.new
+              if run_import._parse_utc_datetime(requested[0]["started_at"]) <= utc(item[0]) <= run_import._parse_utc_datetime(cursor["ended_at"])}
+    assert len(window) > 100 and window <= set(ids)
+    runtime_data.close()